@@ -1,4 +1,6 @@
 from .agent_model import (AgentModel)
 
 from .initializer import AgentModelInitializer
-
+from .ensemble import run_ensemble
+from .batch import BatchedAgentModel
+from .sweep import run_sweep
@@ -1,8 +1,12 @@
 r"""Describes Agent Model interface and behaviour,
 """
 
+import copy
+import math
+import zlib
 import random
 import datetime
+from time import perf_counter
 from abc import ABCMeta, abstractmethod
 
 import numpy as np
@@ -11,11 +15,19 @@ from mesa.time import RandomActivation
 
 # from simoc_server import app  # TODO: Fix logger
 from agent_model.initializer import AgentModelInitializer
-from agent_model.agents.core import GeneralAgent, PlantAgent, ConcreteAgent
-from agent_model.agents.data_collector import AgentDataCollector
+from agent_model.agents.core import GeneralAgent, PlantAgent, ConcreteAgent, \
+    CohortAgent, PlantCohortAgent
+from agent_model.agents.data_collector import AgentDataCollector, parse_plan, parse_resolution
+from agent_model.columnar import to_columns
+from agent_model.exchange import ExchangeKernel
+from agent_model.ledger import StorageLedger, StorageRatios
+from agent_model.partition import ModelPartition
+from agent_model.profiler import StepProfiler
 from agent_model.attribute_meta import AttributeHolder
-from agent_model.util import timedelta_to_hours, location_to_day_length_minutes
-from agent_model.exceptions import AgentModelConfigError, AgentModelInitializationError
+from agent_model.util import timedelta_to_hours, location_to_day_length_minutes, \
+    random_generator
+from agent_model.exceptions import AgentModelConfigError, AgentModelInitializationError, \
+    AgentModelError
 
 class AgentModel(Model, AttributeHolder):
     """The core class that describes the SIMOC's Agent Model interface.
@@ -30,6 +42,8 @@ class AgentModel(Model, AttributeHolder):
     ``seed``               int            Initialize ``random_state``
     ``global_entropy``     float          0-1: Activate and scale variation & event
     ``single_agent``       int            1
+    ``cohorts``            bool           If single_agent is 0, step each agent type as one :ref:`cohort-agent`
+    ``rng_streams``        bool           Give each agent its own random streams; see :ref:`rng-streams`
     ``termination``        list           ``[<termination_case>]``
     ``priorities``         list           ``[<agent class>]``
     ``location``           str            'mars'
@@ -37,20 +51,31 @@ class AgentModel(Model, AttributeHolder):
     ``hours_per_step``     float          1
     ``currency_dict``      dict           ``{<currency>, <currency class>}``
     ``data_collection``    bool           False
+    ``data_resolution``    dict           ``{<family>: (<every>, <aggregate>)}``; see :ref:`data-resolution`
+    ``collection_plan``    dict           ``{<agent_type>: [<field>]}``, or None for all; see :ref:`collection-plan`
     ``random_state``       np.RandomState
+    ``scheduler_rng``      Generator      Shuffles agents with rng_streams; otherwise random_state
+    ``agent_streams``      dict           ``{<agent_type>: int}`` agent streams spawned, with rng_streams
     ``time``               timdelta
     ``starting_step_num``  int
-    ``storage_ratios``     dict           ``{<agent>: {<currency>: 0.5}}``
+    ``storage_ratios``     StorageRatios  ``{<agent>: {<currency>: 0.5}}``, computed lazily
     ``is_terminated``      bool
     ``termination_reason`` str
     ``scheduler``          mesa.Scheduler
+    ``engine``             str            'scalar' or 'vectorized'
+    ``profiler``           StepProfiler   Times the phases of each step, or None; see :ref:`step-profiler`
+    ``ledger``             StorageLedger  Storage balances of all agents; see :ref:`storage-ledger`
+    ``agents_by_type``     dict           ``{<agent_type>: [<agent>]}``, maintained by add_agent/remove
+    ``agents_by_class``    dict           ``{<agent_class>: [<agent>]}``, maintained by add_agent/remove
+    ``agents_by_uid``      dict           ``{<unique_id>: <agent>}``, maintained by add_agent/remove
     ====================== ============== ===============
     """
 
     @classmethod
     def from_config(cls, config, data_collection=True, currency_desc=None,
                     agent_desc=None, agent_conn=None, agent_variation=None,
-                    agent_events=None):
+                    agent_events=None, engine='scalar', data_resolution=None,
+                    collection_plan=None):
         """Takes configuration files, return an initialized model
 
         Args:
@@ -63,6 +88,11 @@ class AgentModel(Model, AttributeHolder):
             * ``agent_conn``: :ref:`agent-conn`
             * ``agent_variation``: :ref:`agent-variation`
             * ``agent_events``: :ref:`agent-events`
+            * ``engine``: str, 'scalar' (default) or 'vectorized'; see :ref:`exchange-kernel`
+            * ``data_resolution``: int, 'daily' or dict, record data every Nth
+              step or as daily aggregates; see :ref:`data-resolution`
+            * ``collection_plan``: list or dict, the fields to collect of
+              each agent type; see :ref:`collection-plan`
 
         Returns:
             * ``AgentModel``: :ref:`agent-model`
@@ -74,22 +104,74 @@ class AgentModel(Model, AttributeHolder):
         categories = ['model', 'agents', 'currencies']
         if any(len(errors[c]) > 0 for c in categories):
             raise AgentModelConfigError(errors)
-        return cls(initializer, data_collection)
+        return cls(initializer, data_collection, engine, data_resolution, collection_plan)
 
     def save(self):
         """Exports current model as an AgentModelInitializer"""
         initializer = AgentModelInitializer.from_model(self)
         return initializer.serialize()
 
+    def fork(self):
+        """Return an independent copy of the model, e.g. to branch a run
+
+        Mutable state (storage balances, agent state, the random state and
+        collected data) is copied. Structures which don't change after
+        initialization (currency_dict, agent attrs and attr_details, and
+        step values) are shared with the copy rather than rebuilt.
+        """
+        memo = {id(self.currency_dict): self.currency_dict}
+        for currency_data in self.currency_dict.values():
+            memo[id(currency_data)] = currency_data
+        for agent in self.scheduler.agents:
+            for shared in [agent.attrs, agent.attr_details, *agent.step_values.values()]:
+                memo[id(shared)] = shared
+        return copy.deepcopy(self, memo)
+
+    def save_checkpoint(self, file, descs=None):
+        """Exports current model to a binary checkpoint file
+
+        Args:
+            * ``file``: str, path or file-like object
+            * ``descs``: dict, if given, agent descriptions are stored in it by
+              content hash rather than in the file; see
+              ``AgentModelInitializer.to_checkpoint``
+        """
+        initializer = AgentModelInitializer.from_model(self)
+        initializer.to_checkpoint(file, descs)
+
     @classmethod
-    def load(cls, saved, data_collection=False):
-        """Takes a save file and returns an initialized AgentModel"""
-        initializer = AgentModelInitializer.deserialize(saved)
-        return cls(initializer, data_collection)
+    def load(cls, saved, data_collection=False, engine='scalar', descs=None,
+             data_resolution=None, collection_plan=None):
+        """Takes a save file or checkpoint and returns an initialized AgentModel
 
-    def __init__(self, initializer, data_collection=False):
+        Args:
+            * ``saved``: dict from ``save``, or path or file-like object
+              written by ``save_checkpoint``
+            * ``descs``: dict, agent descriptions of the checkpoint, if they
+              weren't stored in it
+        """
+        if isinstance(saved, dict):
+            initializer = AgentModelInitializer.deserialize(saved)
+        else:
+            initializer = AgentModelInitializer.from_checkpoint(saved, descs)
+        return cls(initializer, data_collection, engine, data_resolution, collection_plan)
+
+    def __init__(self, initializer, data_collection=False, engine='scalar',
+                 data_resolution=None, collection_plan=None):
         """Creates an Agent Model object."""
         super(Model, self).__init__()
+        if engine not in ['scalar', 'vectorized']:
+            raise AgentModelInitializationError(f"Unrecognized engine: {engine}")
+        self.engine = engine
+        self.exchange_kernels = {}
+        self._partition = None
+        self.profiler = None
+        self._step_profiler = None
+        self.agents_by_type = {}
+        self.agents_by_class = {}
+        self.agents_by_uid = {}
+        self.agents_by_id = {}
+        self._agents_by_role = {}
         #------------------------------
         #    INITIALIZE MODEL DATA
         #------------------------------
@@ -102,6 +184,8 @@ class AgentModel(Model, AttributeHolder):
         self.seed = md['seed']
         self.global_entropy = md['global_entropy']
         self.single_agent = md['single_agent']
+        self.cohorts = md.get('cohorts', False)
+        self.rng_streams = md.get('rng_streams', False)
         self.termination = md['termination']
         self.priorities = md['priorities']
         self.location = md.get('location')
@@ -111,23 +195,31 @@ class AgentModel(Model, AttributeHolder):
         self.data_collection = data_collection
         if initializer.init_type == 'from_new':
             self.random_state = np.random.RandomState(self.seed)
+            agent_streams = {}
             self.time = datetime.timedelta()
             self.starting_step_num = 0
-            self.storage_ratios = {}
+            self.storage_ratios = StorageRatios()
             self.step_records_buffer = []
             self.is_terminated = False
             self.termination_reason = None
         elif initializer.init_type == 'from_model':
             self.random_state = np.random.RandomState()
             self.random_state.set_state(md['random_state'])
+            agent_streams = md.get('agent_streams', {})
             self.time = datetime.timedelta(seconds=md['time'])
             self.starting_step_num = md['steps']
-            self.storage_ratios = md['storage_ratios']
+            self.storage_ratios = StorageRatios(md['storage_ratios'])
             self.step_records_buffer = md['step_records_buffer']
             self.is_terminated = md['is_terminated']
             self.termination_reason = md['termination_reason']
         else:
             raise AgentModelInitializationError(f"Unrecognized initializer type: {initializer.init_type}")
+        if self.rng_streams:
+            self.scheduler_rng = random_generator(
+                md.get('scheduler_rng', np.random.SeedSequence(self.seed, spawn_key=(0,))))
+            self.agent_streams = agent_streams
+        else:
+            self.scheduler_rng = self.random_state
         # Calculated / Temporary
         if self.priorities:
             self.scheduler = PrioritizedRandomActivation(self)
@@ -139,6 +231,7 @@ class AgentModel(Model, AttributeHolder):
         self.daytime = int(self.time.total_seconds() / 60) % self.day_length_minutes
         self.timedelta_per_step = datetime.timedelta(minutes=self.minutes_per_step)
         self.hours_per_step = timedelta_to_hours(self.timedelta_per_step)
+        self.ledger = StorageLedger()
 
         #------------------------------
         #     INITIALIZE AGENT DATA
@@ -158,16 +251,80 @@ class AgentModel(Model, AttributeHolder):
             params = dict(model=self, agent_type=agent_type, agent_desc=agent_desc,
                           connections=connections, **instance)
             if self.single_agent == 1:
-                agent = build_from_class(amount=amount, **params)
-                self.scheduler.add(agent)
+                agent = build_from_class(amount=amount, **params,
+                                         **self._spawn_random_states(agent_type, params))
+                self.add_agent(agent)
+            elif self.cohorts and build_from_class is not ConcreteAgent:
+                if build_from_class is PlantAgent:
+                    build_from_class = PlantCohortAgent
+                else:
+                    build_from_class = CohortAgent
+                agent = build_from_class(amount=amount, **params,
+                                         **self._spawn_random_states(agent_type, params))
+                self.add_agent(agent)
             else:
                 for i in range(amount):
-                    agent = build_from_class(amount=1, **params)
-                    self.scheduler.add(agent)
+                    agent = build_from_class(amount=1, **params,
+                                             **self._spawn_random_states(agent_type, params))
+                    self.add_agent(agent)
+        expected_steps = self._expected_steps()
+        self.data_resolution = parse_resolution(data_resolution,
+                                                self.day_length_hours / self.hours_per_step)
+        self.collection_plan = parse_plan(collection_plan)
         for agent in self.scheduler.agents:
             agent._init_currency_exchange()
             if self.data_collection:
-                agent.data_collector = AgentDataCollector.from_agent(agent)
+                fields = None
+                if self.collection_plan is not None:
+                    fields = self.collection_plan.get(
+                        agent.agent_type, self.collection_plan.get('default', []))
+                if fields == []:
+                    agent.data_collector = None  # Not in the collection plan
+                    continue
+                agent.data_collector = AgentDataCollector.from_agent(
+                    agent, expected_steps, self.data_resolution, fields)
+        self._agents_by_role = {}  # has_flows is set by _init_currency_exchange
+        if self.engine == 'vectorized':
+            self._compile_exchange_kernels()
+
+    def _expected_steps(self):
+        """Return the steps until time termination, or None if there isn't one"""
+        for cond in self.termination:
+            if cond['condition'] == 'time':
+                hours = dict(min=1/60, hour=1, day=self.day_length_hours,
+                             year=self.day_length_hours * 365).get(cond['unit'], self.day_length_hours)
+                steps = math.ceil(cond['value'] * hours / self.hours_per_step) + 1
+                return max(steps - self.starting_step_num, 1)
+        return None
+
+    def _spawn_random_states(self, agent_type, params):
+        """Return agent kwargs with new random streams, if rng_streams is set
+
+        Streams are children of the seed: (0,) for the scheduler, and
+        (1, <agent type hash>, i) for the ith agent of a type, so they don't
+        depend on other agents or on the order random numbers are drawn.
+        """
+        if not self.rng_streams or 'random_states' in params:
+            return {}
+        index = self.agent_streams.get(agent_type, 0)
+        self.agent_streams[agent_type] = index + 1
+        agent_seq = np.random.SeedSequence(
+            self.seed, spawn_key=(1, zlib.crc32(agent_type.encode()), index))
+        variation, events = agent_seq.spawn(2)
+        return dict(random_states=dict(variation=variation, events=events))
+
+    def _compile_exchange_kernels(self):
+        """Compile an ExchangeKernel for every agent class that supports it
+
+        Kernels are used by PrioritizedRandomActivation, so they have no
+        effect on models without priorities.
+        """
+        agents_by_class = {}
+        for agent in self.scheduler.agents:
+            agents_by_class.setdefault(agent.agent_class, []).append(agent)
+        for agent_class, agents in agents_by_class.items():
+            if ExchangeKernel.can_compile_class(agents):
+                self.exchange_kernels[agent_class] = ExchangeKernel(self, agents)
 
     # TODO: Fix logger
     # @property
@@ -264,11 +421,32 @@ class AgentModel(Model, AttributeHolder):
         return model
 
     def add_agent(self, agent):
-        """TODO"""
+        """Add an agent to the scheduler and the agent indices"""
         self.scheduler.add(agent)
+        self.agents_by_type.setdefault(agent.agent_type, []).append(agent)
+        self.agents_by_class.setdefault(agent.agent_class, []).append(agent)
+        self.agents_by_uid[agent.unique_id] = agent
+        self.agents_by_id.setdefault(getattr(agent, 'id', None), agent)
+        self._agents_by_role = {}
+        self._partition = None
 
     def step(self):
         """Execute a single step."""
+        profiler = self.profiler
+        if profiler is not None:
+            start = perf_counter()
+        if not self._start_step():
+            return
+        # Step agents
+        self.scheduler.step()
+        self._collect_step_data()
+        if profiler is not None:
+            profiler.steps += 1
+            profiler.time += perf_counter() - start
+        # app.logger.info("{0} step_num {1}".format(self, self.step_num))  # TODO: Fix logger
+
+    def _start_step(self):
+        """Advance time and check termination; return False if terminated"""
         self.time += self.timedelta_per_step
         self.daytime = int(self.time.total_seconds() / 60) % self.day_length_minutes
         # Check termination conditions; stop if true
@@ -290,13 +468,20 @@ class AgentModel(Model, AttributeHolder):
                 if model_time > value:
                     self.is_terminated = True
                     self.termination_reason = 'time'
-                    return
-        # Step agents
-        self.scheduler.step()
+                    return False
+        return True
+
+    def _collect_step_data(self):
         if self.data_collection:
+            profiler = self.profiler
             for agent in self.scheduler.agents:
+                if agent.data_collector is None:
+                    continue
+                if profiler is not None:
+                    start = perf_counter()
                 agent.data_collector.step()
-        # app.logger.info("{0} step_num {1}".format(self, self.step_num))  # TODO: Fix logger
+                if profiler is not None:
+                    profiler.add(agent.agent_type, 'data_collection', perf_counter() - start)
 
     def step_to(self, n_steps=None, termination=None, max_steps=365*24*2):
         """Execute a fixed number of steps, or until termination
@@ -316,12 +501,15 @@ class AgentModel(Model, AttributeHolder):
             else:
                 self.step()
 
-    def get_data(self, step_range=None, fields=None, debug=False, clear_cache=False):
+    def get_data(self, step_range=None, fields=None, debug=False, clear_cache=False,
+                 arrays=False):
         """Return data from model.
 
         Args:
             * ``debug``: bool. If True, return all available fields. Else, return only 'flows', 'storage' and 'growth.
             * ``clear_cache``: bool. Remove all staved data from data collector.
+            * ``arrays``: bool. Return numeric records as NumPy arrays rather
+              than lists. Arrays are views, which are overwritten after ``clear_cache``.
 
         Returns:
             * ``data``: :ref:`model-data`
@@ -332,18 +520,64 @@ class AgentModel(Model, AttributeHolder):
             return data
         else:
             for agent in self.scheduler.agents:
+                if agent.data_collector is None:
+                    continue
                 data[agent.agent_type] = agent.data_collector.get_data(
                     step_range=step_range, fields=fields, debug=debug,
-                    clear_cache=clear_cache)
+                    clear_cache=clear_cache, arrays=arrays)
             return data
 
+    def get_columns(self, step_range=None):
+        """Return collected data as columnar tables; see :ref:`columnar-data`
+
+        Args:
+            * ``step_range``: (start, end), as in ``get_data``
+        """
+        resolutions = {r for f, r in self.data_resolution.items() if f != 'events'}
+        if len(resolutions) > 1 or any(aggregate for _, aggregate in resolutions):
+            raise AgentModelError("Columnar data requires the same resolution for all "
+                                  "families, without aggregates")
+        data = self.get_data(step_range=step_range, debug=True, arrays=True)
+        tables = [t for a in self.scheduler.agents if a.data_collector is not None
+                  for t in a.data_collector.tables.values()] if self.data_collection else []
+        if not tables:
+            return to_columns(data)
+        every = resolutions.pop()[0]
+        size = tables[0].size
+        last = self.step_num - self.step_num % every
+        steps = np.arange(last - every * (size - 1), last + 1, every)
+        if step_range is not None:
+            steps = steps[step_range[0]:step_range[1]]
+        return to_columns(data, steps)
+
     def remove(self, agent):
-        """TODO"""
-        # self.scheduler.remove(agent)
+        """Remove an agent from the scheduler and the agent indices
+
+        Agents which die are not removed, but deactivated (see
+        ``GeneralAgent.destroy``), so that their data is still collected.
+        """
+        self.scheduler.remove(agent)
+        for index, key in [(self.agents_by_type, agent.agent_type),
+                           (self.agents_by_class, agent.agent_class)]:
+            index[key].remove(agent)
+            if not index[key]:
+                del index[key]
+        del self.agents_by_uid[agent.unique_id]
+        agent_id = getattr(agent, 'id', None)
+        if self.agents_by_id.get(agent_id) is agent:
+            del self.agents_by_id[agent_id]
+            for other in self.scheduler.agents:
+                if getattr(other, 'id', None) == agent_id:
+                    self.agents_by_id[agent_id] = other
+                    break
+        self._agents_by_role = {}
+        self._partition = None
 
     def get_agents_by_type(self, agent_type=None):
         """Returns a list of agents matching search term, or all agent
 
+        Lists are maintained by add_agent/remove and must not be modified.
+
         Args:
             * ``agent_type``: Agent name
 
@@ -353,46 +587,95 @@ class AgentModel(Model, AttributeHolder):
         if agent_type is None:
             return self.scheduler.agents
         else:
-            return [agent for agent in self.scheduler.agents if agent.agent_type == agent_type]
+            return self.agents_by_type.get(agent_type, [])
 
     def get_agents_by_class(self, agent_class=None):
-        """TODO
+        """Returns a list of agents of an agent class, or all agents
 
-        TODO
+        Lists are maintained by add_agent/remove and must not be modified.
 
         Args:
-            agent_class: TODO
+            agent_class: str, e.g. 'plants'
 
         Returns:
-          TODO
+          [Agent...]
         """
         if agent_class is None:
             return self.scheduler.agents
         else:
-            return [agent for agent in self.scheduler.agents
-                    if agent.agent_class == agent_class]
+            return self.agents_by_class.get(agent_class, [])
 
     def agent_by_id(self, id):
-        """TODO
+        """Returns the first agent with a storage id, or None
+
+        Args:
+            id: int, storage-specific id
+
+        Returns:
+          Agent or None
+        """
+        return self.agents_by_id.get(id)
+
+    def agent_by_uid(self, unique_id):
+        """Returns the agent with a unique_id, or None"""
+        return self.agents_by_uid.get(unique_id)
+
+    @property
+    def partition(self):
+        """The ModelPartition of the current agents, computed when first used"""
+        if self._partition is None:
+            self._partition = ModelPartition(self)
+        return self._partition
 
-        TODO
+    def get_partition(self):
+        """Return a report of the connected components of the model
+
+        See ``ModelPartition.get_report``.
+        """
+        return self.partition.get_report()
+
+    def enable_profiling(self, reset=True):
+        """Start timing the phases of each step; see :ref:`step-profiler`
 
         Args:
-            id: TODO
+            * ``reset``: bool, clear records of earlier profiling
+        """
+        if self._step_profiler is None or reset:
+            self._step_profiler = StepProfiler()
+        self.profiler = self._step_profiler
+
+    def disable_profiling(self):
+        """Stop timing steps; records are kept until profiling is enabled again"""
+        self.profiler = None
+
+    def get_profile(self, reset=False):
+        """Return the time spent in each phase of the steps profiled
+
+        Args:
+            * ``reset``: bool, clear the records after reporting them
 
         Returns:
-          TODO
+            * ``dict``: see ``StepProfiler.get_report``, or None if profiling
+              has never been enabled
         """
-        for agent in self.get_agents_by_type():
-            if agent.id == id:
-                return agent
-        return None
+        profiler = self._step_profiler
+        if profiler is None:
+            return None
+        report = profiler.get_report()
+        if reset:
+            profiler.reset()
+        return report
 
     def get_agents_by_role(self, role=None):
-        if role == 'storage':
-            return [agent for agent in self.scheduler.agents if agent.has_storage]
-        elif role == 'flows':
-            return [agent for agent in self.scheduler.agents if agent.has_flows]
+        if role not in ['storage', 'flows']:
+            return None
+        if role not in self._agents_by_role:
+            if role == 'storage':
+                agents = [agent for agent in self.scheduler.agents if agent.has_storage]
+            else:
+                agents = [agent for agent in self.scheduler.agents if agent.has_flows]
+            self._agents_by_role[role] = agents
+        return self._agents_by_role[role]
 
 
 class PrioritizedRandomActivation(RandomActivation):
@@ -416,16 +699,34 @@ class PrioritizedRandomActivation(RandomActivation):
     def step(self):
         if not self.initialized:
             self._load_agents_by_class()
+        profiler = self.model.profiler
         for agent_class in self.model.priorities:
             if agent_class in self.agents_by_class:
                 agents = self.agents_by_class[agent_class]
-                self.model.random_state.shuffle(agents)
+                self.model.scheduler_rng.shuffle(agents)
+                kernel = self.model.exchange_kernels.get(agent_class)
+                if kernel is not None:
+                    if profiler is not None:
+                        start = perf_counter()
+                    kernel.step(agents)
+                    if profiler is not None:
+                        profiler.add_kernel(agent_class, perf_counter() - start)
+                    continue
                 for agent in agents:
                     if agent.active:
+                        if profiler is not None:
+                            start = perf_counter()
                         agent.step()
+                        if profiler is not None:
+                            profiler.add(agent.agent_type, 'step', perf_counter() - start)
         self.steps += 1
         self.time += 1
 
+    def add(self, agent):
+        super().add(agent)
+        if self.initialized:
+            self.agents_by_class.setdefault(agent.agent_class, []).append(agent)
+
     def _load_agents_by_class(self):
         for agent in self.agents:
             agent_class = agent.agent_class
@@ -436,4 +737,5 @@ class PrioritizedRandomActivation(RandomActivation):
 
     def remove(self, agent):
         super().remove(agent)
-        self.agents_by_class[agent.agent_class].remove(agent)
+        if self.initialized:
+            self.agents_by_class[agent.agent_class].remove(agent)
@@ -1,2 +1,2 @@
 from agent_model.agents.core import BaseAgent, GeneralAgent, StorageAgent, \
-    PlantAgent, ConcreteAgent
+    PlantAgent, ConcreteAgent, CohortAgent, PlantCohortAgent
@@ -5,16 +5,26 @@ import math
 import random
 import operator
 from abc import ABCMeta
-from time import time
+from time import time, perf_counter
 
 import numpy as np
-import quantities as pq
 from mesa import Agent
 
 from agent_model.attribute_meta import AttributeHolder
 from agent_model.agents import growth_func, variation_func
 from agent_model.agents import custom_funcs
 from agent_model.exceptions import AgentInitializationError
+from agent_model.growth_cache import growth_cache
+from agent_model.util import resolve_unit, random_generator
+
+_PRELUDE_PHASES = {'threshold': 'thresholds', 'custom_function': 'custom_functions',
+                   'event': 'events'}
+
+def _lap(profiler, agent_type, phase, start):
+    """Add the time since start to a phase of the profiler; return the time"""
+    now = perf_counter()
+    profiler.add(agent_type, phase, now - start)
+    return now
 
 class BaseAgent(Agent, AttributeHolder, metaclass=ABCMeta):
     """Initializes and manages refs, metadata, currency_dict, and AttributeHolder"""
@@ -28,12 +38,21 @@ class BaseAgent(Agent, AttributeHolder, metaclass=ABCMeta):
           unique_id:            int
           agent_desc:           dict        from AgentModelInitializer
           active:               bool
+          random_states:        dict        ``{'variation': <rng>, 'events': <rng>}``,
+                                            np.random.Generators or their states;
+                                            if not given, use model.random_state
         """
         self.model = kwargs.pop("model", None)
         self.agent_type = kwargs.pop("agent_type", None)
         self.unique_id = kwargs.pop("unique_id", random.getrandbits(63))
         self.active = kwargs.pop("active", True)
         self.amount = kwargs.pop('amount', 1)
+        random_states = kwargs.pop('random_states', None)
+        if random_states is None:
+            self.random_state = self.event_random_state = self.model.random_state
+        else:
+            self.random_state = random_generator(random_states['variation'])
+            self.event_random_state = random_generator(random_states['events'])
 
         agent_desc = kwargs.pop("agent_desc", None)
         self.agent_class = agent_desc['agent_class']
@@ -72,7 +91,7 @@ class BaseAgent(Agent, AttributeHolder, metaclass=ABCMeta):
             if isinstance(upper, dict) or isinstance(lower, dict):
                 # When currency values are specified individually
                 self.initial_variable = variation_func.get_variable(
-                    self.model.random_state, ge, ge, distribution, stdev_range)
+                    self.random_state, ge, ge, distribution, stdev_range)
                 if self.initial_variable == 1:
                     return
                 elif self.initial_variable < 1:
@@ -91,7 +110,7 @@ class BaseAgent(Agent, AttributeHolder, metaclass=ABCMeta):
                 upper = upper * ge
                 lower = lower * ge
                 self.initial_variable = variation_func.get_variable(
-                    self.model.random_state, upper, lower, distribution, stdev_range)
+                    self.random_state, upper, lower, distribution, stdev_range)
                 for attr, attr_value in self.attrs.items():
                     prefix, field = attr.split('_', 1)
                     if prefix in ['in', 'out'] or field in characteristics:
@@ -104,7 +123,7 @@ class BaseAgent(Agent, AttributeHolder, metaclass=ABCMeta):
             self.step_variable = 1
 
     def generate_step_variable(self):
-        return variation_func.get_variable(self.model.random_state, **self.step_variation)
+        return variation_func.get_variable(self.random_state, **self.step_variation)
 
     def add_currency_to_dict(self, currency):
         """Adds a reference to the currency's database object.
@@ -131,7 +150,12 @@ class BaseAgent(Agent, AttributeHolder, metaclass=ABCMeta):
 
 
 class StorageAgent(BaseAgent):
-    """Initialize and manage storage capacity """
+    """Initialize and manage storage capacity
+
+    Balances are stored in the model's :ref:`storage-ledger`. Item and
+    attribute access to a stored currency (``agent['co2']``, ``agent.co2``)
+    read and write the ledger.
+    """
 
     def __init__(self, *args, **kwargs):
         """Set initial currency balances; create new attributes for class capacities
@@ -141,18 +165,23 @@ class StorageAgent(BaseAgent):
           ...[currency] int     starting balance, from config
           ...[attributes & attribute_details inherited from BaseAgent]
         """
+        self.ledger_index = {}
+        self.ledger_views = {}
+        self.ratios_dirty = True
         super().__init__(*args, **kwargs)
         self.id = kwargs.get("id", None)
         self.has_storage = False
         class_capacities = {}
         class_unit = {}
+        storage_units = []  # (base unit, factor) of each currency
         for attr, attr_value in self.attrs.items():
             if attr.startswith('char_capacity'):
                 if not self.has_storage:
                     self.has_storage = True
                 self._attr(attr, attr_value)
                 currency = attr.split('_', 2)[2]
-                self._attr(currency, kwargs.get(currency, 0))
+                self.ledger_index[currency] = self.model.ledger.register(kwargs.get(currency, 0))
+                storage_units.append(self._get_resolved_unit(attr))
                 # Add meta-attributes for currency classes, so that inputs/outputs
                 # can use the same mechanisms to reference them.
                 self.add_currency_to_dict(currency)
@@ -166,49 +195,130 @@ class StorageAgent(BaseAgent):
             if class_attr not in self:
                 self._attr(class_attr, capacity)
                 self.attr_details[class_attr] = dict(unit=class_unit[currency_class])
+                self._get_resolved_unit(class_attr)
+        # Balances of one agent are registered together, so they're contiguous
+        indices = list(self.ledger_index.values())
+        self.ledger_slice = slice(indices[0], indices[-1] + 1) if indices else slice(0, 0)
+        # Factors to convert each balance to the unit of the first, for ratios
+        self.ledger_factors = []
+        for (unit_base, unit_factor), currency in zip(storage_units, self.ledger_index):
+            if unit_base != storage_units[0][0]:
+                raise AgentInitializationError(
+                    f"Units for {self.agent_type} {currency} storage are not "
+                    f"compatible with other currencies in the same storage")
+            self.ledger_factors.append(unit_factor / storage_units[0][1])
+        for view in self.currency_dict:
+            self._get_ledger_view(view)
         self._calculate_storage_ratios()
 
+    def _get_resolved_unit(self, attr, prefix=''):
+        """Return the (base unit, factor) of an attribute, as resolved by parse_agent"""
+        ad = self.attr_details[attr]
+        if f'{prefix}unit_factor' not in ad:
+            # e.g. Agent descriptions saved before units were resolved at parse
+            unit_base, unit_factor = resolve_unit(ad[f'{prefix}unit'])
+            ad[f'{prefix}unit_base'] = unit_base
+            ad[f'{prefix}unit_factor'] = unit_factor
+        if ad[f'{prefix}unit_factor'] is None:
+            raise AgentInitializationError(
+                f"Unrecognized unit for {self.agent_type} {attr}: {ad[f'{prefix}unit']}")
+        return ad[f'{prefix}unit_base'], ad[f'{prefix}unit_factor']
+
+    def __getitem__(self, key):
+        index = self.ledger_index.get(key)
+        if index is None:
+            return self.__dict__[key]
+        return self.model.ledger.values.item(index)
+
+    def __setitem__(self, key, value):
+        index = self.ledger_index.get(key)
+        if index is None:
+            self.__dict__[key] = value
+        else:
+            self._mark_ratios_dirty()
+            self.model.ledger.values[index] = value
+
+    def __contains__(self, key):
+        return key in self.ledger_index or key in self.__dict__
+
+    def __getattr__(self, name):
+        ledger_index = self.__dict__.get('ledger_index')
+        if ledger_index is not None and name in ledger_index:
+            return self.model.ledger.values.item(ledger_index[name])
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+    def __setattr__(self, name, value):
+        ledger_index = self.__dict__.get('ledger_index')
+        if ledger_index is not None and name in ledger_index:
+            self._mark_ratios_dirty()
+            self.model.ledger.values[ledger_index[name]] = value
+        else:
+            super().__setattr__(name, value)
+
     def step(self):
-        """Calculate storage ratios"""
-        # TODO: This should be moved to self.increment() and streamlined
+        """Schedule storage ratios to be calculated, if balances have changed
+
+        Ratios are calculated when first read, or before the balances change
+        again, whichever is first; see :ref:`storage-ledger`.
+        """
         if self.has_storage:
+            storage_ratios = self.model.storage_ratios
+            if self.ratios_dirty or storage_ratios.writers.get(self.agent_type) is not self:
+                storage_ratios.pending[self.agent_type] = self
+            elif storage_ratios.pending.get(self.agent_type) is not None:
+                # Ratios of another instance of this type were scheduled
+                del storage_ratios.pending[self.agent_type]
+
+    def _mark_ratios_dirty(self):
+        """Calculate scheduled ratios before balances change; mark them outdated"""
+        storage_ratios = self.model.storage_ratios
+        if storage_ratios.pending.get(self.agent_type) is self:
+            del storage_ratios.pending[self.agent_type]
             self._calculate_storage_ratios()
+        self.ratios_dirty = True
 
     def _calculate_storage_ratios(self):
+        profiler = self.model.profiler
+        if profiler is not None:
+            start = perf_counter()
         storage_id = self.agent_type
-        if storage_id not in self.model.storage_ratios:
-            self.model.storage_ratios[storage_id] = {}
-        temp, total = {}, None
-        for attr in self.attrs:
-            if attr.startswith('char_capacity'):
-                currency = attr.split('_', 2)[2]
-                storage_unit = self.attr_details[attr]['unit']
-                storage_value = pq.Quantity(float(self[currency]), storage_unit)
-                if not total:
-                    total = storage_value
-                else:
-                    storage_value.units = total.units
-                    total += storage_value
-                temp[currency] = storage_value.magnitude.tolist()
-        for currency in temp:
-            if temp[currency] > 0:
-                self.model.storage_ratios[storage_id][currency + '_ratio'] = \
-                    temp[currency] / total.magnitude.tolist()
+        all_storage_ratios = self.model.storage_ratios
+        if storage_id not in all_storage_ratios:
+            dict.__setitem__(all_storage_ratios, storage_id, {})
+        storage_ratios = dict.__getitem__(all_storage_ratios, storage_id)
+        all_storage_ratios.writers[storage_id] = self
+        self.ratios_dirty = False
+        balances = self.model.ledger.values[self.ledger_slice].tolist()
+        values = [value * factor for value, factor in zip(balances, self.ledger_factors)]
+        total = 0
+        for value in values:
+            total += value
+        for currency, value in zip(self.ledger_index, values):
+            storage_ratios[currency + '_ratio'] = value / total if value > 0 else 0
+        if profiler is not None:
+            profiler.add(storage_id, 'storage_ratios', perf_counter() - start)
+
+    def _get_ledger_view(self, view):
+        """Return the currencies and ledger indices included in a view"""
+        if view not in self.ledger_views:
+            currency_data = self.currency_dict[view]
+            if currency_data['type'] == 'currency':
+                currencies = [view] if view in self.ledger_index else []
+            elif currency_data['type'] == 'currency_class':
+                currencies = [c for c in currency_data['currencies'] if c in self.ledger_index]
             else:
-                self.model.storage_ratios[storage_id][currency + '_ratio'] = 0
+                raise KeyError(f"Currency {currency_data['name']} type not recognized by view.")
+            indices = np.array([self.ledger_index[c] for c in currencies], dtype=int)
+            self.ledger_views[view] = (currencies, indices)
+        return self.ledger_views[view]
 
     def view(self, view=None):
         if view not in self.currency_dict:
             raise KeyError(f"{view} is not a recognized view.")
-        currency_data = self.currency_dict[view]
-        if currency_data['type'] == 'currency':
-            currency = view
-            return {currency: self[currency]}
-        elif currency_data['type'] == 'currency_class':
-            currencies = currency_data['currencies']
-            return {c: self[c] for c in currencies if c in self}
-        else:
-            raise KeyError(f"Currency {currency_data['name']} type not recognized by view.")
+        if self.currency_dict[view]['type'] == 'currency' and view not in self.ledger_index:
+            return {view: self[view]}
+        currencies, indices = self._get_ledger_view(view)
+        return dict(zip(currencies, self.model.ledger.values[indices].tolist()))
 
     def increment(self, view, increment_amount):
         """Increase or decrease storage balances
@@ -224,37 +334,38 @@ class StorageAgent(BaseAgent):
         incremented.
 
         """
+        values = self.model.ledger.values
         if increment_amount > 0:
             currency = view
             if self.currency_dict[currency]['type'] != 'currency':
                 raise ValueError(f"Positive increment can only be used with currencies.")
             capacity = self['char_capacity_' + currency] * self.amount
-            currency_amount = min(self[currency] + increment_amount, capacity)
-            currency_increment_actual = self[currency] - currency_amount
-            self[currency] = currency_amount
-            return {currency: currency_increment_actual}
+            index = self.ledger_index[currency]
+            current = values.item(index)
+            currency_amount = min(current + increment_amount, capacity)
+            self._mark_ratios_dirty()
+            values[index] = currency_amount
+            return {currency: current - currency_amount}
         elif increment_amount < 0:
-            currencies = self.view(view)
-            total_view_amount = sum(currencies.values())
+            if view not in self.currency_dict:
+                raise KeyError(f"{view} is not a recognized view.")
+            currencies, indices = self._get_ledger_view(view)
+            current = values[indices]
+            total_view_amount = sum(current.tolist())
             target_view_amount = min(total_view_amount + increment_amount, 0)
             # TODO: This is triggered sometimes by a rounding error. Need a better solution.
             # if target_view_amount < 0:
                 # raise ValueError(f"{self.agent_type} has insufficient {view} balance to increment by {increment_amount}")
             if total_view_amount <= 0:
                 return {c: 0 for c in currencies}
-            ratios = {c: self[c]/total_view_amount for c in currencies.keys()}
-            flow = {}
-            for currency in currencies:
-                currency_increment_target = increment_amount * ratios[currency]
-                currency_amount = max(self[currency] + currency_increment_target, 0)
-                currency_increment_actual = self[currency] - currency_amount
-                self[currency] = currency_amount
-                flow[currency] = currency_increment_actual
-            return flow
+            ratios = current / total_view_amount
+            currency_amounts = np.maximum(current + increment_amount * ratios, 0)
+            self._mark_ratios_dirty()
+            values[indices] = currency_amounts
+            return dict(zip(currencies, (current - currency_amounts).tolist()))
         else:
             return {}
 
-
 class GeneralAgent(StorageAgent):
     """The base class for a SIMOC agent.
 
@@ -283,6 +394,7 @@ class GeneralAgent(StorageAgent):
     ``step_values``        dict           Step values for each currency with lifetime/daily growth applied
     ``events``             dict           A list of event instances by type
     ``event_multipliers``  dict           A list of multipliers from events, applied to every currency exchange
+    ``step_plan``          dict           Thresholds, custom functions, events and flows resolved from attrs for step()
     ====================== ============== ===============
     """
 
@@ -361,11 +473,12 @@ class GeneralAgent(StorageAgent):
                     # all connections specifying the direction of the exchange,
                     # rather than just the two endpoints.
                     continue
-                storage_unit = storage_agent.attr_details['char_capacity_' + currency]['unit']
-                if storage_unit != attr_unit:
+                storage_unit = storage_agent._get_resolved_unit('char_capacity_' + currency)
+                if storage_unit != self._get_resolved_unit(attr, prefix='flow_'):
                     raise AgentInitializationError(
                         f"Units for {self.agent_type} {currency} ({attr_unit}) "
-                        f"do not match storage ({storage_unit})")
+                        f"do not match storage "
+                        f"({storage_agent.attr_details['char_capacity_' + currency]['unit']})")
                 self.selected_storage[prefix][currency].append(storage_agent)
 
             # Deprive
@@ -384,9 +497,91 @@ class GeneralAgent(StorageAgent):
             # Step Values
             if attr not in self.step_values:
                 self.step_values[attr] = self._calculate_step_values(attr)
+        self._compile_step_plan()
+
+    def _compile_step_plan(self):
+        """Resolve the attrs used by step() into a plan which is executed each step
+
+        The plan has two parts, both in the order that step() processed attrs:
+          prelude: list of (type, data) for thresholds (with resolved storage
+            ratio keys and comparators), custom functions and events
+          flows: list of dicts for each non-zero input and output, with the
+            details, connected storages, weights and criteria it needs
+        """
+        prelude = []
+        for attr, attr_value in self.attrs.items():
+            if attr.startswith('char_threshold_'):
+                (threshold_type, currency) = attr.split('_')[-2:]
+                opp = {'upper': operator.gt, 'lower': operator.lt}[threshold_type]
+                for prefix in ['in', 'out']:
+                    for storage_agent in self.selected_storage[prefix].get(currency, []):
+                        prelude.append(('threshold', (storage_agent.agent_type,
+                                                      currency + '_ratio', opp,
+                                                      attr_value, currency)))
+            if attr == 'char_custom_function':
+                custom_function = getattr(custom_funcs, attr_value)
+                if not custom_function:
+                    raise Exception(f'Unknown custom function: {custom_function}.')
+                prelude.append(('custom_function', custom_function))
+            if attr.startswith('event'):
+                prelude.append(('event', (attr, attr_value)))
+
+        flows = []
+        for prefix in ['in', 'out']:
+            for currency, selected_storages in self.selected_storage[prefix].items():
+                attr = f"{prefix}_{currency}"
+                if self.attrs[attr] == 0:
+                    # e.g. Atmosphere Equalizer: uses custom_func, has dummy flow to initialize connections
+                    continue
+                attr_details = self.attr_details[attr]
+                weights = []
+                for weight in attr_details.get('weighted') or []:
+                    if (weight in self.currency_dict and
+                        self.currency_dict[currency]['type'] == 'currency'):
+                        weights.append((weight, 'per_amount'))
+                    elif weight == 'growth_rate':
+                        weights.append((weight, 'growth_rate'))
+                    else:
+                        weights.append((weight, None))
+                criteria = None
+                if attr_details['criteria_name']:
+                    criteria = dict(
+                        name=attr_details['criteria_name'],
+                        opp={'>': operator.gt, '<': operator.lt,
+                             '=': operator.eq}[attr_details['criteria_limit']],
+                        value=attr_details['criteria_value'] or 0.0,
+                        buffer=attr_details['criteria_buffer'] or 0.0)
+                flows.append(dict(
+                    attr=attr,
+                    prefix=prefix,
+                    currency=currency,
+                    storages=selected_storages,
+                    requires=attr_details.get('requires') or [],
+                    weights=weights,
+                    criteria=criteria,
+                    is_required=attr_details.get('is_required'),
+                    deprive_value=attr_details.get('deprive_value') or 0,
+                    delta_per_step=attr_details.get('delta_per_step', 0)))
+        self.step_plan = dict(prelude=prelude, flows=flows,
+                              criteria={f['attr']: f['criteria'] for f in flows})
 
     def _calculate_step_values(self, attr):
-        """Calculate lifetime step values based on growth functions and add to self.step_values
+        """Return lifetime step values of attr, from the growth cache if possible
+
+        Curves without growth are cheap, and curves with noise or initial
+        variation are unique to the agent, so those aren't cached.
+        """
+        ad = self.attr_details[attr]
+        if (not (ad['lifetime_growth_type'] or ad['daily_growth_type']) or
+                ad['lifetime_growth_noise'] or ad['daily_growth_noise'] or
+                getattr(self, 'initial_variable', 1) != 1):
+            return self._build_step_values(attr)
+        key = growth_cache.make_key(self.attrs[attr], ad, getattr(self, 'lifetime', None),
+                                    self.model.hours_per_step, self.model.day_length_hours)
+        return growth_cache.get(key, lambda: self._build_step_values(attr))
+
+    def _build_step_values(self, attr):
+        """Calculate lifetime step values based on growth functions
 
         """
         step_values = []
@@ -468,41 +663,42 @@ class GeneralAgent(StorageAgent):
             min_threshold *= day_length_hours
             max_threshold = daily_growth_max_threshold or 0.0
             max_threshold *= day_length_hours
-            invert = bool(daily_growth_invert)
-            noise = bool(daily_growth_noise)
-            for i in range(0, n_steps, day_length):
-                day_values = step_values[i:i+day_length]
-                agent_value = np.mean(day_values)
-                daily_min = np.min(day_values)
-                daily_max = np.max(day_values)
+            kwargs = {'growth_type': daily_growth_type,
+                      'min_threshold': int(min_threshold),
+                      'max_threshold': int(max_threshold),
+                      'center': center,
+                      'noise': bool(daily_growth_noise),
+                      'invert': bool(daily_growth_invert)}
+            if daily_growth_scale:
+                kwargs['scale'] = daily_growth_scale
+            elif lifetime_growth_type:
+                kwargs['scale'] = 0.5
+            if daily_growth_steepness:
+                kwargs['steepness'] = daily_growth_steepness
+
+            def _overlay(days):
+                """Replace each row of days with a daily curve of the same mean"""
+                means = days.mean(axis=1)
                 if daily_growth_min_value:
-                    start_value = agent_value * daily_growth_min_value
-                elif daily_min < daily_max:
-                    start_value = daily_min or 0
-                else:
-                    start_value = 0
-                if (i + day_length) > n_steps:
-                    day_length = n_steps - i
-                kwargs = {'agent_value': agent_value,
-                          'num_values': day_length,
-                          'growth_type': daily_growth_type,
-                          'min_value': start_value,
-                          'min_threshold': int(min_threshold),
-                          'max_threshold': int(max_threshold),
-                          'center': center,
-                          'noise': noise,
-                          'invert': invert}
-                if daily_growth_scale:
-                    kwargs['scale'] = daily_growth_scale
-                elif lifetime_growth_type:
-                    kwargs['scale'] = 0.5
-                    kwargs['max_value'] = agent_value * 1.1
-                if daily_growth_steepness:
-                    kwargs['steepness'] = daily_growth_steepness
-                if start_value == agent_value:
-                    step_values[i:i+day_length] = np.ones(day_length) * agent_value
+                    starts = means * daily_growth_min_value
                 else:
-                    step_values[i:i+day_length] = growth_func.get_growth_values(**kwargs)
+                    daily_min, daily_max = days.min(axis=1), days.max(axis=1)
+                    starts = np.where((daily_min < daily_max) & (daily_min != 0), daily_min, 0.0)
+                growing = starts != means
+                days[~growing] = means[~growing, None]
+                if growing.any():
+                    day_kwargs = dict(kwargs, agent_value=means[growing],
+                                      num_values=days.shape[1], min_value=starts[growing])
+                    if lifetime_growth_type and not daily_growth_scale:
+                        day_kwargs['max_value'] = means[growing] * 1.1
+                    days[growing] = growth_func.get_growth_values(**day_kwargs)
+
+            # All complete days at once, one row per day, then a partial last day
+            n_days, remainder = divmod(n_steps, day_length)
+            if n_days:
+                _overlay(step_values[:n_days * day_length].reshape(n_days, day_length))
+            if remainder:
+                _overlay(step_values[n_days * day_length:].reshape(1, remainder))
         return step_values
 
     def _get_storage_ratio(self, cr_name):
@@ -525,41 +721,36 @@ class GeneralAgent(StorageAgent):
         return total
 
     def _get_step_value(self, attr, step_num):
-        """TODO
+        """Return the base value of an exchange for the current step
 
-        TODO
+        Criteria are checked first, and update the criteria buffer.
 
         Args:
-            attr: TODO
+            attr: str, e.g. 'in_o2'
+            step_num: int, index into step_values
 
         Returns:
-          TODO
+          float: step value, in the exchange's flow_unit
         """
-        prefix, currency = attr.split('_', 1)
-        agent_unit = self.attr_details[attr]['flow_unit']
-        cr_name = self.attr_details[attr]['criteria_name']
-        if cr_name:
-            cr_limit = self.attr_details[attr]['criteria_limit']
-            cr_value = self.attr_details[attr]['criteria_value'] or 0.0
-            cr_buffer = self.attr_details[attr]['criteria_buffer'] or 0.0
+        criteria = self.step_plan['criteria'].get(attr)
+        if criteria:
+            cr_name = criteria['name']
             if cr_name in self:
                 # e.g. 'growth_rate'
                 source = self[cr_name]
             else:
                 source = self._get_storage_ratio(cr_name)
-            opp = {'>': operator.gt, '<': operator.lt, '=': operator.eq}[cr_limit]
-            if opp(source, cr_value):
-                if cr_buffer > 0 and self.buffer.get(attr, 0) > 0:
+            if criteria['opp'](source, criteria['value']):
+                if criteria['buffer'] > 0 and self.buffer.get(attr, 0) > 0:
                     self.buffer[attr] -= 1
-                    return pq.Quantity(0.0, agent_unit)
+                    return 0.0
             else:
-                if cr_buffer > 0:
-                    self.buffer[attr] = cr_buffer
-                return pq.Quantity(0.0, agent_unit)
+                if criteria['buffer'] > 0:
+                    self.buffer[attr] = criteria['buffer']
+                return 0.0
         cached_steps = self.step_values[attr].shape[0]
         step_num = step_num % int(cached_steps)
-        agent_value = self.step_values[attr][step_num]
-        return pq.Quantity(agent_value, agent_unit)
+        return self.step_values[attr].item(step_num)
 
     def _process_event(self, attr, attr_value):
         event_type = attr.split('_', 1)[1]
@@ -579,7 +770,7 @@ class GeneralAgent(StorageAgent):
         max_new_instances = max_instances - len(instances)
         for i in range(max_new_instances):
             # Roll the dice
-            instance_variable = self.model.random_state.rand()
+            instance_variable = self.event_random_state.random()
             if instance_variable > attr_details['probability_per_step']:
                 continue
             # Add instance
@@ -590,7 +781,7 @@ class GeneralAgent(StorageAgent):
                 magnitude_variation_distribution = attr_details.get('magnitude_variation_distribution')
                 if magnitude_variation_distribution:
                     magnitude_variable = variation_func.get_variable(
-                        self.model.random_state,
+                        self.event_random_state,
                         attr_details['magnitude_variation_upper'],
                         attr_details['magnitude_variation_lower'],
                         magnitude_variation_distribution
@@ -602,7 +793,7 @@ class GeneralAgent(StorageAgent):
                     duration_variation_distribution = attr_details.get('duration_variation_distribution')
                     if duration_variation_distribution:
                         duration_variable = variation_func.get_variable(
-                            self.model.random_state,
+                            self.event_random_state,
                             attr_details['duration_variation_upper'],
                             attr_details['duration_variation_lower'],
                             duration_variation_distribution
@@ -625,6 +816,16 @@ class GeneralAgent(StorageAgent):
     def step(self, value_eps=1e-12, value_round=6):
         """The main step function for SIMOC agents. Calculate step values and process exchanges.
 
+        """
+        if not self._step_prelude():
+            return
+        self._step_exchanges(value_eps, value_round)
+
+    def _step_prelude(self):
+        """Update status fields and run thresholds, custom functions and events
+
+        Returns False if the agent was killed by a threshold, in which case no
+        exchanges should be processed this step.
         """
         super().step()
 
@@ -635,144 +836,170 @@ class GeneralAgent(StorageAgent):
         self.step_exchange_buffer = {'in': {}, 'out': {}}
 
         self.age += self.model.hours_per_step
-        for attr, attr_value in self.attrs.items():
+        profiler = self.model.profiler
+        for step_type, step_data in self.step_plan['prelude']:
+            if profiler is not None:
+                start = perf_counter()
             # 1. CHECK THRESHOLDS
-            if attr.startswith('char_threshold_'):
-                (threshold_type, currency) = attr.split('_')[-2:]
-                for prefix in ['in', 'out']:
-                    if currency in self.selected_storage[prefix]:
-                        for storage_agent in self.selected_storage[prefix][currency]:
-                            agent_id = storage_agent.agent_type
-                            storage_ratio = self.model.storage_ratios[agent_id][currency + '_ratio']
-                            opp = {'upper': operator.gt, 'lower': operator.lt}[threshold_type]
-                            if opp(storage_ratio, attr_value):
-                                self.kill(self.amount,
-                                          f'Threshold {currency} met for '
-                                          f'{self.agent_type}. Killing the agent')
-                                return
+            if step_type == 'threshold':
+                storage_id, ratio_name, opp, threshold, currency = step_data
+                storage_ratio = self.model.storage_ratios[storage_id][ratio_name]
+                if opp(storage_ratio, threshold):
+                    self.kill(self.amount,
+                              f'Threshold {currency} met for '
+                              f'{self.agent_type}. Killing the agent')
+                    if profiler is not None:
+                        profiler.add(self.agent_type, 'thresholds', perf_counter() - start)
+                    return False
             # 2. EXECUTE CUSTOM FUNCTIONS
-            if attr == 'char_custom_function':
-                custom_function = getattr(custom_funcs, attr_value)
-                if custom_function:
-                    custom_function(self)
-                else:
-                    raise Exception(f'Unknown custom function: {custom_function}.')
+            elif step_type == 'custom_function':
+                step_data(self)
             # 3. PROCESS EVENTS
-            if attr.startswith('event') and self.process_events:
-                self._process_event(attr, attr_value)
+            elif step_type == 'event' and self.process_events:
+                self._process_event(*step_data)
+            else:
+                continue
+            if profiler is not None:
+                profiler.add(self.agent_type, _PRELUDE_PHASES[step_type],
+                             perf_counter() - start)
 
         # 4. GENERATE RANDOM VARIATION
         if self.step_variation is not None:
+            if profiler is not None:
+                start = perf_counter()
             self.step_variable = self.generate_step_variable()
+            if profiler is not None:
+                profiler.add(self.agent_type, 'variation', perf_counter() - start)
+        return True
 
+    def _step_exchanges(self, value_eps=1e-12, value_round=6):
+        """Calculate step values and process all currency exchanges"""
         # ITERATE THROUGH EACH INPUT AND OUTPUT
         influx = {}     # For 'requires' field
         self.missing_desired = False  # Stalls growth if 'required = desired' field is missing
-        for prefix in ['in', 'out']:
-            for currency, selected_storages in self.selected_storage[prefix].items():
-                attr = f"{prefix}_{currency}"
-                attr_details = self.attr_details[attr]
+        step_num = int(self.age)
+        event_multiplier = np.prod(list(self.event_multipliers.values()))
+        profiler = self.model.profiler
+        for flow in self.step_plan['flows']:
+            # 5. CHECK ESCAPE PARAMETERS
+            attr, prefix, currency = flow['attr'], flow['prefix'], flow['currency']
+            requires = flow['requires']
+            if any(_currency not in influx for _currency in requires):
+                # e.g. Human: if not consume potable water, don't produce urine
+                continue
 
-                # 5. CHECK ESCAPE PARAMETERS
-                if self.attrs[attr] == 0:
-                    # e.g. Atmosphere Equalizer: uses custom_func, has dummy flow to initialize connections
-                    continue
-                requires = attr_details.get('requires') or []
-                if any(_currency not in influx for _currency in requires):
-                    # e.g. Human: if not consume potable water, don't produce urine
-                    continue
+            # 6. CALCULATE TARGET VALUE
+            if profiler is not None:
+                lap = perf_counter()
+            step_value = self._get_step_value(attr, step_num)     # type float, in flow_unit
+            for _currency in requires:
+                step_value *= influx.get(_currency)  # scale outputs to inputs
+            for weight, weight_type in flow['weights']:
+                weight_value = getattr(self, weight)
+                if weight_type == 'per_amount':
+                    # If weighted by some currency, must first divide by
+                    # amount, because it's multiplied by amount again later
+                    weight_value /= self.amount
+                elif weight_type == 'growth_rate':
+                    # If weighted by growth rate, multiply by 2 because for
+                    # an un-skewed sigmoid curve, max height is 2x mean
+                    weight_value *= 2
+                step_value *= weight_value
+
+            step_mag, target_value = self._get_flow_values(attr, step_value,
+                                                           event_multiplier)
+            actual_value = target_value                 # to be adjusted below
+            if profiler is not None:
+                lap = _lap(profiler, self.agent_type, 'target', lap)
+
+            # 7. CALCULATE AVAILABLE VALUE
+            available_value = 0   # Total available in connected storages
+            available_conns = []  # (storage, value) for each storage
+            for storage in flow['storages']:
+                storage_value = sum(storage.view(currency).values())
+                available_value += storage_value
+                available_conns.append((storage, storage_value))
+            if profiler is not None:
+                lap = _lap(profiler, self.agent_type, 'availability', lap)
+
+            # 8. UPDATE AGENT BASED ON DEFICIT/SUFFICIENCY
+            has_deficit = prefix == 'in' and available_value < target_value
+            # 8.1 REQUIRES
+            is_required = flow['is_required']
+            if has_deficit and is_required:
+                if is_required == 'mandatory':
+                    # e.g. Dehumidifier: If there's no atmosphere.h2o, don't do anything.
+                    return
+                elif is_required == 'desired':
+                    # e.g. Plants: If one or more desired inputs is missing, growth stalls.
+                    self.missing_desired = True
+            # 8.2 DEPRIVE
+            if flow['deprive_value'] > 0:
+                actual_value = self._update_deprive(flow, has_deficit, available_value,
+                                                    step_mag, actual_value)
+                if self.amount == 0:
+                    return
+            elif has_deficit:
+                actual_value = available_value
+            if profiler is not None:
+                lap = _lap(profiler, self.agent_type, 'deprive', lap)
 
-                # 6. CALCULATE TARGET VALUE
-                step_num = int(self.age)
-                step_value = self._get_step_value(attr, step_num)     # type pq.Quantity
-                for _currency in requires:
-                    step_value *= influx.get(_currency)  # scale outputs to inputs
-                weighted = attr_details.get('weighted') or []
-                for weight in weighted:
-                    weight_value = getattr(self, weight)
-                    if (weight in self.currency_dict and
-                        # If weighted by some currency, must first divide by
-                        # amount, because it's multiplied by amount again later
-                        self.currency_dict[currency]['type'] == 'currency'):
-                        weight_value /= self.amount
-                    elif weight == 'growth_rate':
-                        # If weighted by growth rate, multiply by 2 because for
-                        # an un-skewed sigmoid curve, max height is 2x mean
-                        weight_value *= 2
-                    step_value *= weight_value
-
-                step_value = step_value * self.step_variable
-                step_value = step_value * np.prod(list(self.event_multipliers.values()))
-                step_mag = step_value.magnitude.tolist()    # type float
-                target_value = step_mag * self.amount
-                actual_value = target_value                 # to be adjusted below
-
-                # 7. CALCULATE AVAILABLE VALUE
-                available_value = 0   # Total available in connected storages
-                available_conns = []  # Value/capacity for each storage
-                for storage in selected_storages:
-                    storage_value = sum(storage.view(currency).values())
-                    storage_cap = storage['char_capacity_' + currency]
-                    storage_amount = storage.__dict__.get('amount', 1)
-                    available_value += storage_value
-                    available_conns.append(dict(
-                        agent=storage,
-                        value=storage_value,
-                        capacity=storage_cap * storage_amount
-                    ))
-
-                # 8. UPDATE AGENT BASED ON DEFICIT/SUFFICIENCY
-                has_deficit = prefix == 'in' and available_value < target_value
-                # 8.1 REQUIRES
-                is_required = attr_details.get('is_required')
-                if has_deficit and is_required:
-                    if is_required == 'mandatory':
-                        # e.g. Dehumidifier: If there's no atmosphere.h2o, don't do anything.
-                        return
-                    elif is_required == 'desired':
-                        # e.g. Plants: If one or more desired inputs is missing, growth stalls.
-                        self.missing_desired = True
-                # 8.2 DEPRIVE
-                deprive_value = attr_details.get('deprive_value') or 0
-                if has_deficit and deprive_value > 0:
-                    n_satisfied = math.floor(available_value / step_mag)
-                    actual_value = n_satisfied * step_mag
-                    delta_per_step = attr_details.get('delta_per_step', 0)
-                    max_survive = math.floor(max(self.deprive[attr], 0) / delta_per_step)
-                    n_deprived = self.amount - n_satisfied
-                    n_survive = min(n_deprived, max_survive)
-                    self.deprive[attr] -= delta_per_step * n_survive
-                    n_die = n_deprived - n_survive
-                    self.kill(n_die, f'All {self.agent_type} died from lack of'
-                              f' {currency}. Killing the agent')
-                    if self.amount == 0:
-                        return
-                elif deprive_value > 0:
-                    self.deprive[attr] = min(deprive_value * self.amount,
-                                             self.deprive[attr] + deprive_value)
-                elif has_deficit:
-                    actual_value = available_value
-
-                # 9. PROCESS EXCHANGE
-                if actual_value < value_eps:  # ignore values less than 1e-12
-                    continue
-                if prefix == 'in':  # log input ratios to scale outputs
-                    influx[currency] = actual_value / target_value
-                remaining_value = actual_value
-                for conn in available_conns:
-                    storage = conn['agent']
-                    if prefix == 'in':
-                        conn_delta = min(remaining_value, conn['value'])
-                        flow = storage.increment(currency, -conn_delta)
-                    elif prefix == 'out':
-                        conn_delta = remaining_value / len(available_conns)
-                        flow = storage.increment(currency, conn_delta)
-                    remaining_value -= conn_delta
-                    buf = self.step_exchange_buffer[prefix]
-                    for _currency, _amount in flow.items():
-                        if _currency not in buf:
-                            buf[_currency] = {}
-                        buf[_currency][storage.agent_type] = abs(_amount)
+            # 9. PROCESS EXCHANGE
+            if actual_value < value_eps:  # ignore values less than 1e-12
+                continue
+            if prefix == 'in':  # log input ratios to scale outputs
+                influx[currency] = actual_value / target_value
+            remaining_value = actual_value
+            buf = self.step_exchange_buffer[prefix]
+            for storage, storage_value in available_conns:
+                if prefix == 'in':
+                    conn_delta = min(remaining_value, storage_value)
+                    exchange = storage.increment(currency, -conn_delta)
+                elif prefix == 'out':
+                    conn_delta = remaining_value / len(available_conns)
+                    exchange = storage.increment(currency, conn_delta)
+                remaining_value -= conn_delta
+                for _currency, _amount in exchange.items():
+                    if _currency not in buf:
+                        buf[_currency] = {}
+                    buf[_currency][storage.agent_type] = abs(_amount)
+            if profiler is not None:
+                _lap(profiler, self.agent_type, 'exchange', lap)
+
+    def _get_flow_values(self, attr, step_value, event_multiplier):
+        """Apply step variation and events to a step value
+
+        Returns:
+          (float, float): value per unit of amount, and total target value
+        """
+        step_value = step_value * self.step_variable
+        step_value = step_value * event_multiplier
+        step_mag = float(step_value)
+        return step_mag, step_mag * self.amount
+
+    def _update_deprive(self, flow, has_deficit, available_value, step_mag, actual_value):
+        """Update deprive of an input, kill units which can't survive a deficit
+
+        Returns:
+          float: the value which can be exchanged
+        """
+        attr = flow['attr']
+        deprive_value = flow['deprive_value']
+        if not has_deficit:
+            self.deprive[attr] = min(deprive_value * self.amount,
+                                     self.deprive[attr] + deprive_value)
+            return actual_value
+        n_satisfied = math.floor(available_value / step_mag)
+        actual_value = n_satisfied * step_mag
+        delta_per_step = flow['delta_per_step']
+        max_survive = math.floor(max(self.deprive[attr], 0) / delta_per_step)
+        n_deprived = self.amount - n_satisfied
+        n_survive = min(n_deprived, max_survive)
+        self.deprive[attr] -= delta_per_step * n_survive
+        n_die = n_deprived - n_survive
+        self.kill(n_die, f'All {self.agent_type} died from lack of'
+                  f' {flow["currency"]}. Killing the agent')
+        return actual_value
 
     def kill(self, number, reason):
         """Destroy the agent and remove it from the model
@@ -840,6 +1067,8 @@ class PlantAgent(GeneralAgent):
 
     def _init_currency_exchange(self):
         super()._init_currency_exchange()
+        light_type = self.connections['in']['par'][0]
+        self.light_agent = self.model.get_agents_by_type(light_type)[0]
         self.co2_scale = {}
         for attr in self.attrs:
             prefix, _ = attr.split('_', 1)
@@ -852,8 +1081,7 @@ class PlantAgent(GeneralAgent):
         # food output, and ignore any criteria.
         cr_name = self.attr_details[attr]['criteria_name']
         if self.grown and cr_name != 'grown':
-            agent_unit = self.attr_details[attr]['flow_unit']
-            return pq.Quantity(0.0, agent_unit)
+            return 0.0
 
         # Step values for plants are based on `agent_step_num`` instead of `age`
         # to account for stalled growth from deprive. TODO: As noted above,
@@ -934,15 +1162,19 @@ class PlantAgent(GeneralAgent):
         self.growth_rate = (self['biomass'] / self.amount) / self.attrs['char_capacity_biomass']
         hour_of_day = self.model.step_num % int(self.model.day_length_hours)
         self.daily_growth_factor = self.daily_growth[hour_of_day]
+        profiler = self.model.profiler
+        if profiler is not None:
+            start = perf_counter()
         self.cu_factor, self.te_factor = self._calculate_co2_response()
+        if profiler is not None:
+            profiler.add(self.agent_type, 'co2_response', perf_counter() - start)
         # Light response
         # 12/22/22: Electric lamps and sunlight work differently.
         # - Lamp.par is multiplied by the lamp amount (to scale kwh consumption)
         # - Sun.par is not, because there's nothing to scale and plants can't
         #   compete over it. Sunlight also can't be incremented.
-        light_type = self.connections['in']['par'][0]
-        light_agent = self.model.get_agents_by_type(light_type)[0]
-        is_electric = ('lamp' in light_type)
+        light_agent = self.light_agent
+        is_electric = ('lamp' in light_agent.agent_type)
         par_ideal = self.attrs['char_par_baseline'] * self.daily_growth_factor
         if is_electric:
             par_ideal *= self.amount
@@ -1013,3 +1245,314 @@ class ConcreteAgent(GeneralAgent):
         self.carbonation_rate = gradient * self.diffusion_rate
         self.carbonation += self.carbonation_rate
         super().step()
+
+
+class CohortAgent(GeneralAgent):
+    """A population of individuals of one agent type, stepped together
+
+    Used instead of separate instances when a model is initialized with
+    ``single_agent=0`` and ``cohorts=True``. Storage and shared fields are
+    the same as a GeneralAgent with ``amount`` equal to the number of
+    individuals alive; individual state is kept in arrays with one entry per
+    individual, alive or dead. Aggregate fields (``amount``,
+    ``initial_variable``, ``step_variable``, ``deprive``, ``events`` and
+    ``event_multipliers``) are kept in sync, so data collection is the same
+    as for a single agent.
+
+    ====================== ============== ===============
+          Attribute        Type               Description
+    ====================== ============== ===============
+    ``cohort_size``        int            Number of individuals, alive or dead
+    ``alive``              np.ndarray     bool, whether each individual is alive
+    ``initial_variables``  np.ndarray     Initial variable of each individual
+    ``flow_variables``     dict           ``{<attr>: np.ndarray}`` flow multiplier of each individual, from initial variation
+    ``step_variables``     np.ndarray     Step variable of each individual
+    ``individual_deprive`` dict           ``{<attr>: np.ndarray}`` deprive available to each individual
+    ``event_active``       dict           ``{<event_type>: np.ndarray}`` bool, whether each individual has an instance
+    ``event_magnitudes``   dict           ``{<event_type>: np.ndarray}`` magnitude of each individual's instance
+    ``event_durations``    dict           ``{<event_type>: np.ndarray}`` remaining duration of each individual's instance
+    ``event_factors``      np.ndarray     Product of event magnitudes of each individual
+    ====================== ============== ===============
+    """
+
+    def __init__(self, *args, cohort=None, **kwargs):
+        """Initialize individual state, or load it from a saved ``cohort`` dict"""
+        super().__init__(*args, **kwargs)
+        cohort = cohort or {}
+        if 'alive' in cohort:
+            self.alive = np.array(cohort['alive'], dtype=bool)
+        else:
+            self.alive = np.ones(self.amount, dtype=bool)
+        self.cohort_size = len(self.alive)
+        if 'initial_variables' in cohort:
+            self.initial_variables = np.array(cohort['initial_variables'], dtype=float)
+            self.flow_variables = {attr: np.array(values, dtype=float)
+                                   for attr, values in cohort['flow_variables'].items()}
+            self.step_variables = np.array(cohort['step_variables'], dtype=float)
+        elif 'initial_variables' not in self.__dict__:
+            # No variation
+            self.initial_variables = np.ones(self.cohort_size)
+            self.flow_variables = {}
+            self.step_variables = np.ones(self.cohort_size)
+        self.individual_deprive = {attr: np.array(values, dtype=float) for attr, values
+                                   in cohort.get('individual_deprive', {}).items()}
+        self.event_active = {}
+        self.event_magnitudes = {}
+        self.event_durations = {}
+        for attr in self.attrs:
+            if not attr.startswith('event'):
+                continue
+            event_type = attr.split('_', 1)[1]
+            if event_type in cohort.get('event_active', {}):
+                self.event_active[event_type] = np.array(
+                    cohort['event_active'][event_type], dtype=bool)
+                self.event_magnitudes[event_type] = np.array(
+                    cohort['event_magnitudes'][event_type], dtype=float)
+                self.event_durations[event_type] = np.array(
+                    cohort['event_durations'][event_type], dtype=float)
+            else:
+                self.event_active[event_type] = np.zeros(self.cohort_size, dtype=bool)
+                self.event_magnitudes[event_type] = np.ones(self.cohort_size)
+                self.event_durations[event_type] = np.zeros(self.cohort_size)
+        self._update_event_factors()
+        self._update_alive()
+
+    @property
+    def amount(self):
+        return self._amount
+
+    @amount.setter
+    def amount(self, amount):
+        """Kill or revive individuals to match the amount alive"""
+        alive = self.__dict__.get('alive')
+        self._amount = amount
+        if alive is None:
+            return
+        alive_index = np.flatnonzero(alive)
+        n_alive = len(alive_index)
+        if amount < n_alive:
+            alive[alive_index[amount:]] = False
+        elif amount > n_alive:
+            revived = np.flatnonzero(~alive)[:amount - n_alive]
+            alive[revived] = True
+            for attr, deprive in self.individual_deprive.items():
+                deprive[revived] = self.attr_details[attr]['deprive_value']
+            self.step_variables[revived] = 1
+        self._update_alive()
+
+    def _update_alive(self):
+        """Update the index of living individuals and the aggregate deprive"""
+        self._alive_index = np.flatnonzero(self.alive)
+        for attr, deprive in self.individual_deprive.items():
+            self.deprive[attr] = sum(deprive[self._alive_index].tolist())
+
+    def _update_event_factors(self):
+        self.event_factors = np.ones(self.cohort_size)
+        for event_type, active in self.event_active.items():
+            self.event_factors *= np.where(active, self.event_magnitudes[event_type], 1)
+
+    def _init_variation(self, variation):
+        """Draw initial and step variables for each individual"""
+        ge = self.model.global_entropy
+        n = self.amount
+        iv = variation.get('initial')
+        sv = variation.get('step')
+        self.initial_variables = np.ones(n)
+        self.flow_variables = {}
+        self.step_variables = np.ones(n)
+        if iv:
+            upper = iv.get('upper', 0)
+            lower = iv.get('lower', 0)
+            distribution = iv.get('distribution')
+            stdev_range = iv.get('stdev_range', None)
+            characteristics = iv.get('characteristics', [])
+            if isinstance(upper, dict) or isinstance(lower, dict):
+                # When currency values are specified individually
+                variables = variation_func.get_variable(
+                    self.random_state, ge, ge, distribution, stdev_range, size=n)
+                x_norm = np.abs(variables - 1)
+                for attr, attr_value in self.attrs.items():
+                    prefix, field = attr.split('_', 1)
+                    if prefix in {'in', 'out'} or field in characteristics:
+                        values = np.full(n, float(attr_value))
+                        for y_ref, mask in [(lower, variables < 1), (upper, variables > 1)]:
+                            if not mask.any():
+                                continue
+                            if field not in y_ref:
+                                raise ValueError(f"Missing variation value for {self.agent_type} {field}.")
+                            values[mask] = np.interp(x_norm[mask], [0, 1], [attr_value, y_ref[field]])
+                        self._vary_attr(attr, values)
+            else:
+                # When a scalar is used
+                variables = variation_func.get_variable(
+                    self.random_state, upper * ge, lower * ge, distribution,
+                    stdev_range, size=n)
+                for attr, attr_value in self.attrs.items():
+                    prefix, field = attr.split('_', 1)
+                    if prefix in ['in', 'out'] or field in characteristics:
+                        self._vary_attr(attr, attr_value * variables)
+            self.initial_variables = variables
+        self.initial_variable = float(np.mean(self.initial_variables))
+        if sv:
+            upper = ge * sv.get('upper', 0)
+            lower = ge * sv.get('lower', 0)
+            distribution = sv.get('distribution')
+            self.step_variation = dict(upper=upper, lower=lower, distribution=distribution)
+        else:
+            self.step_variation = None
+        self.step_variable = 1
+
+    def _vary_attr(self, attr, values):
+        """Vary flows for each individual; characteristics by their mean"""
+        attr_value = self.attrs[attr]
+        if attr.startswith(('in_', 'out_')):
+            if attr_value != 0:
+                self.flow_variables[attr] = values / attr_value
+        else:
+            self.attrs[attr] = float(np.mean(values))
+
+    def generate_step_variable(self):
+        alive = self._alive_index
+        if len(alive) == 0:
+            return 1
+        self.step_variables[alive] = variation_func.get_variable(
+            self.random_state, size=len(alive), **self.step_variation)
+        return float(np.mean(self.step_variables[alive]))
+
+    def _init_currency_exchange(self):
+        super()._init_currency_exchange()
+        for attr in self.deprive:
+            if attr not in self.individual_deprive:
+                deprive_value = self.attr_details[attr]['deprive_value']
+                self.individual_deprive[attr] = np.full(self.cohort_size, float(deprive_value))
+        self._update_alive()
+
+    def _process_event(self, attr, attr_value):
+        event_type = attr.split('_', 1)[1]
+        attr_details = self.attr_details[attr]
+        active = self.event_active[event_type]
+        magnitudes = self.event_magnitudes[event_type]
+        durations = self.event_durations[event_type]
+        has_duration = bool(attr_details.get('duration_value'))
+        random_state = self.event_random_state
+        # UPDATE INSTANCES FOR DURATION & AMOUNT
+        if has_duration:
+            durations[active] -= attr_details['duration_delta_per_step']
+            active &= durations > 0
+        active &= self.alive
+        # RANDOMLY GENERATE NEW INSTANCES
+        is_group = attr_details['scope'] == 'group'
+        if is_group:
+            new = self._alive_index
+            if active.any() or len(new) == 0 or \
+               random_state.random() > attr_details['probability_per_step']:
+                new = new[:0]
+        else:
+            candidates = np.flatnonzero(self.alive & ~active)
+            rolls = random_state.random(len(candidates))
+            new = candidates[rolls <= attr_details['probability_per_step']]
+        if len(new) > 0:
+            n_instances = 1 if is_group else len(new)
+            if attr_value == 'termination':
+                self.alive[new] = False
+                self.kill(len(new), f"Agent died due to {event_type}")
+            elif attr_value == 'multiplier':
+                magnitude = attr_details['magnitude_value']
+                magnitude_variation_distribution = attr_details.get('magnitude_variation_distribution')
+                if magnitude_variation_distribution:
+                    magnitude = magnitude * variation_func.get_variable(
+                        random_state,
+                        attr_details['magnitude_variation_upper'],
+                        attr_details['magnitude_variation_lower'],
+                        magnitude_variation_distribution,
+                        size=n_instances
+                    )
+                magnitudes[new] = magnitude
+                if has_duration:
+                    duration = attr_details['duration_value']
+                    duration_variation_distribution = attr_details.get('duration_variation_distribution')
+                    if duration_variation_distribution:
+                        duration = duration * variation_func.get_variable(
+                            random_state,
+                            attr_details['duration_variation_upper'],
+                            attr_details['duration_variation_lower'],
+                            duration_variation_distribution,
+                            size=n_instances
+                        )
+                    durations[new] = duration
+                active[new] = True
+        # UPDATE EVENT RECORDS
+        self._update_event_factors()
+        if not active.any():
+            self.events.pop(event_type, None)
+            self.event_multipliers.pop(event_type, None)
+        else:
+            instances = self._alive_index[:1] if is_group else np.flatnonzero(active)
+            if has_duration:
+                self.events[event_type] = [dict(magnitude=m, duration=d) for m, d in zip(
+                    magnitudes[instances].tolist(), durations[instances].tolist())]
+            else:
+                self.events[event_type] = [dict(magnitude=m)
+                                           for m in magnitudes[instances].tolist()]
+            event_factors = np.where(active, magnitudes, 1)[self._alive_index]
+            self.event_multipliers[event_type] = float(np.mean(event_factors))
+
+    def _get_flow_values(self, attr, step_value, event_multiplier):
+        """Apply each individual's variation and events to a step value
+
+        Returns:
+          (np.ndarray, float): value for each living individual, and their sum
+        """
+        alive = self._alive_index
+        step_mags = step_value * self.step_variables[alive]
+        step_mags *= self.event_factors[alive]
+        flow_variables = self.flow_variables.get(attr)
+        if flow_variables is not None:
+            step_mags *= flow_variables[alive]
+        return step_mags, sum(step_mags.tolist())
+
+    def _update_deprive(self, flow, has_deficit, available_value, step_mags, actual_value):
+        """Update deprive of each individual, kill those which can't survive
+
+        In a deficit, individuals are satisfied in random order until the
+        available value is exhausted.
+        """
+        attr = flow['attr']
+        deprive = self.individual_deprive[attr]
+        alive = self._alive_index
+        if not has_deficit:
+            deprive[alive] = flow['deprive_value']
+            self._update_alive()
+            return actual_value
+        order = self.random_state.permutation(len(alive))
+        n_satisfied = int(np.searchsorted(np.cumsum(step_mags[order]), available_value,
+                                          side='right'))
+        actual_value = sum(step_mags[order[:n_satisfied]].tolist())
+        deprive[alive[order[:n_satisfied]]] = flow['deprive_value']
+        deprived = alive[order[n_satisfied:]]
+        survive = deprive[deprived] >= flow['delta_per_step']
+        deprive[deprived[survive]] -= flow['delta_per_step']
+        dying = deprived[~survive]
+        if len(dying) > 0:
+            self.alive[dying] = False
+            self.kill(len(dying), f'All {self.agent_type} died from lack of'
+                      f' {flow["currency"]}. Killing the agent')
+        self._update_alive()
+        return actual_value
+
+    def _get_cohort_state(self):
+        """Return individual state as a json-serializable dict"""
+        return dict(
+            alive=self.alive.tolist(),
+            initial_variables=self.initial_variables.tolist(),
+            flow_variables={k: v.tolist() for k, v in self.flow_variables.items()},
+            step_variables=self.step_variables.tolist(),
+            individual_deprive={k: v.tolist() for k, v in self.individual_deprive.items()},
+            event_active={k: v.tolist() for k, v in self.event_active.items()},
+            event_magnitudes={k: v.tolist() for k, v in self.event_magnitudes.items()},
+            event_durations={k: v.tolist() for k, v in self.event_durations.items()},
+        )
+
+
+class PlantCohortAgent(PlantAgent, CohortAgent):
+    """A cohort of plants; growth and biomass are shared by the cohort"""
@@ -1,15 +1,296 @@
+import copy
+import math
+
+import numpy as np
+
+from agent_model.exceptions import AgentModelInitializationError
+
+DEFAULT_CAPACITY = 1024  # Initial rows of a table, if the run length isn't known
+
+# Numeric fields, in the order they're written to tables
+RECORD_FIELDS = ['age', 'amount', 'storage', 'storage_ratios', 'growth', 'flows',
+                 'buffer', 'deprive', 'step_variable']
+STATS = ['min', 'mean', 'max', 'sum']
+# Fields which can be requested in a collection plan; 'events' includes
+# 'event_multipliers', and 'name' is always collected.
+PLAN_FIELDS = ['age', 'amount', 'lifetime', 'full_amount', 'reproduce', 'growth',
+               'storage', 'storage_ratios', 'capacity', 'flows', 'buffer', 'deprive',
+               'events', 'initial_variable', 'step_variable']
+
+def _copy_records(value):
+    """Copy nested dicts of record lists, which contain immutable values"""
+    if isinstance(value, dict):
+        return {k: _copy_records(v) for k, v in value.items()}
+    elif isinstance(value, list):
+        return list(value)
+    return value
+
+def _assign_columns(template, columns):
+    """Replace the None leaves of a record template with column numbers"""
+    if isinstance(template, dict):
+        return {k: _assign_columns(v, columns) for k, v in template.items()}
+    columns.append(len(columns))
+    return columns[-1]
+
+def ends_period(step_num, every):
+    """Whether step_num is the last step of a period of ``every`` steps
+
+    Periods are numbered by ``floor(step_num / every)``, so that days of a
+    fractional number of steps (e.g. sols of 24.65 one-hour steps) start
+    and end at day boundaries. Rounding keeps whole quotients exact.
+    """
+    return (math.floor(round(step_num / every, 9)) >
+            math.floor(round((step_num - 1) / every, 9)))
+
+def parse_resolution(resolution, steps_per_day):
+    """Return ``{<family>: (<every>, <daily>)}`` for a data resolution
+
+    Args:
+      resolution: None or 1 to record every step; int N to record every Nth
+        step; 'daily' for min/mean/max/sum aggregates of each day; or a dict
+        of these by family (``RECORD_FIELDS`` and 'events'), with 'default'
+        for the families not listed
+      steps_per_day: float, ``day_length_hours / hours_per_step``
+
+    Raises:
+      AgentModelInitializationError: if resolution is invalid
+    """
+    families = RECORD_FIELDS + ['events']
+    if not isinstance(resolution, dict):
+        resolution = {'default': resolution}
+    unknown = [f for f in resolution if f != 'default' and f not in families]
+    if unknown:
+        raise AgentModelInitializationError(
+            f"Unrecognized data resolution families: {', '.join(unknown)}")
+    parsed = {}
+    for family in families:
+        value = resolution.get(family, resolution.get('default'))
+        if value is None:
+            value = 1
+        if value == 'daily':
+            parsed[family] = (steps_per_day, family != 'events')
+        elif isinstance(value, int) and not isinstance(value, bool) and value > 0:
+            parsed[family] = (value, False)
+        else:
+            raise AgentModelInitializationError(
+                f"Data resolution of {family} must be a positive int or 'daily': {value!r}")
+    return parsed
+
+def parse_plan(plan, fields=PLAN_FIELDS):
+    """Return ``{<agent_type>: [<field>]}`` for a collection plan, or None
+
+    Args:
+      plan: None to collect every field of every agent; a list of fields
+        to collect for every agent; or a dict of lists by agent type, with
+        'default' for the agent types not listed. A list of None collects
+        every field; agent types without a list, or with an empty one,
+        aren't collected.
+      fields: list, the fields which can be requested
+
+    Raises:
+      AgentModelInitializationError: if plan is invalid
+    """
+    if plan is None:
+        return None
+    if not isinstance(plan, dict):
+        plan = {'default': plan}
+    parsed = {}
+    for agent_type, agent_fields in plan.items():
+        if agent_fields is None:
+            parsed[agent_type] = None
+            continue
+        if isinstance(agent_fields, str) or not all(isinstance(f, str) for f in agent_fields):
+            raise AgentModelInitializationError(
+                f"Collection plan of {agent_type} must be a list of fields: {agent_fields!r}")
+        unknown = [f for f in agent_fields if f not in fields]
+        if unknown:
+            raise AgentModelInitializationError(
+                f"Unrecognized collection plan fields of {agent_type}: {', '.join(unknown)}")
+        parsed[agent_type] = list(agent_fields)
+    return parsed
+
+KINDS = [bool, int, float]  # Kinds of record values, from narrowest to widest
+
+def _kind(value):
+    if value is None:
+        return None
+    if isinstance(value, (bool, np.bool_)):
+        return bool
+    return int if isinstance(value, (int, np.integer)) else float
+
+class RecordTable():
+    """Preallocated rows of numeric records at one resolution
+
+    Rows are recorded at the last step of each period of ``every`` steps
+    (see ``ends_period``). Aggregate rows hold the min, mean, max and sum of
+    each column over the steps since the previous row, in blocks of ``n_columns``. The table starts
+    with room for the expected rows of the run, up to ``DEFAULT_CAPACITY``,
+    and doubles when full.
+
+    Values are stored as float64, with NaN for None, and returned as the
+    widest kind recorded in their column, so a series of ints which later
+    holds floats is returned as floats. None values are returned as None,
+    and are left out of aggregates.
+
+    ====================== ============== ===============
+          Attribute        Type               Description
+    ====================== ============== ===============
+    ``every``              int or float   Steps per row; steps per day for daily rows
+    ``aggregate``          bool           Whether rows are aggregates
+    ``table``              np.ndarray     ``(capacity, n_columns)``, or ``(capacity, 4 * n_columns)``
+    ``size``               int            Rows recorded
+    ``kinds``              list           Kind of each column's values (see ``KINDS``), or None if all are None
+    ====================== ============== ===============
+    """
+
+    def __init__(self, n_columns, every=1, aggregate=False, expected_steps=None):
+        self.n_columns = n_columns
+        self.every = every
+        self.aggregate = aggregate
+        self.expected_rows = max(int(expected_steps // every), 1) if expected_steps else None
+        capacity = DEFAULT_CAPACITY
+        if self.expected_rows:
+            capacity = min(capacity, self.expected_rows)
+        width = len(STATS) * n_columns if aggregate else n_columns
+        self.table = np.empty((max(capacity, 1), width))
+        self.size = 0
+        self.kinds = None
+        self._narrow = None  # Columns which may still widen to another kind
+        self._period = None  # [min, max, sum, count] since the last row
+
+    def __deepcopy__(self, memo):
+        copied = self.__class__.__new__(self.__class__)
+        copied.__dict__.update(self.__dict__)
+        copied.table = self.table.copy()
+        if self.kinds is not None:
+            copied.kinds = list(self.kinds)
+            copied._narrow = list(self._narrow)
+        if self._period is not None:
+            copied._period = [v.copy() for v in self._period]
+        return copied
+
+    def records(self, step_num):
+        """Whether values are added at step_num"""
+        return self.aggregate or ends_period(step_num, self.every)
+
+    def _update_kinds(self, row):
+        """Widen the kinds of columns to those of the values in row"""
+        if self.kinds is None:
+            self.kinds = [_kind(v) for v in row]
+            self._narrow = [i for i, kind in enumerate(self.kinds) if kind is not float]
+            return
+        widened = False
+        for i in self._narrow:
+            kind = _kind(row[i])
+            if kind is None or kind is self.kinds[i]:
+                continue
+            if self.kinds[i] is None or KINDS.index(kind) > KINDS.index(self.kinds[i]):
+                self.kinds[i] = kind
+                widened = widened or kind is float
+        if widened:
+            self._narrow = [i for i in self._narrow if self.kinds[i] is not float]
+
+    def add(self, row, step_num):
+        """Add the values of one step, which are recorded if it ends a row"""
+        if self.kinds is None or self._narrow:
+            self._update_kinds(row)
+        values = np.array(row, dtype=float)  # None is NaN
+        if self.aggregate:
+            present = ~np.isnan(values)
+            period = self._period
+            if period is None:
+                period = self._period = [values, values.copy(),
+                                         np.where(present, values, 0), present.astype(int)]
+            else:
+                np.fmin(period[0], values, out=period[0])
+                np.fmax(period[1], values, out=period[1])
+                period[2] += np.where(present, values, 0)
+                period[3] += present
+            if not ends_period(step_num, self.every):
+                return
+            counts = period[3]
+            total = np.where(counts > 0, period[2], np.nan)
+            mean = np.divide(total, counts, out=np.full(len(total), np.nan), where=counts > 0)
+            values = np.concatenate([period[0], mean, period[1], total])
+            self._period = None
+        if self.size == len(self.table):
+            self._grow()
+        self.table[self.size] = values
+        self.size += 1
+
+    def _grow(self):
+        """Double the rows of the table, or grow it to the expected rows"""
+        capacity = 2 * len(self.table)
+        if self.expected_rows and len(self.table) < self.expected_rows:
+            capacity = min(capacity, self.expected_rows)
+        table = np.empty((capacity, self.table.shape[1]))
+        table[:self.size] = self.table[:self.size]
+        self.table = table
+
+    def _get_values(self, column, kind, start, end, arrays):
+        values = self.table[:self.size, column][start:end]
+        if arrays:
+            return values
+        missing = np.isnan(values)
+        if kind is bool or kind is int:
+            values = np.where(missing, 0, values).astype(kind if kind is bool else np.int64)
+        output = values.tolist()
+        if missing.any():
+            output = [None if m else v for v, m in zip(output, missing.tolist())]
+        return output
+
+    def get_column(self, column, start=None, end=None, arrays=False):
+        """Return rows of a column, as an array or a list of its kind
+
+        Aggregate columns are returned as ``{'min': [], 'mean': [], 'max':
+        [], 'sum': []}``.
+        """
+        kind = self.kinds[column] if self.kinds else float
+        if not self.aggregate:
+            return self._get_values(column, kind, start, end, arrays)
+        kinds = dict(min=kind, mean=float, max=kind, sum=int if kind is bool else kind)
+        return {stat: self._get_values(i * self.n_columns + column, kinds[stat],
+                                       start, end, arrays)
+                for i, stat in enumerate(STATS)}
+
+    def clear(self):
+        """Remove all rows; values added since the last row are kept"""
+        self.size = 0
+
 class AgentDataCollector():
+    """Records the state of an agent at every step
+
+    Numeric records (see ``RECORD_FIELDS``) are written to a RecordTable,
+    with a row per step and a column per record, rather than appended to
+    lists. With a data resolution (see ``parse_resolution``), each family
+    is recorded every Nth step or as daily aggregates, with a table for
+    each resolution. Event records contain objects, so they're kept in
+    lists. With ``fields`` from a collection plan (see ``parse_plan``),
+    only those fields are recorded and returned.
+
+    ====================== ============== ===============
+          Attribute        Type               Description
+    ====================== ============== ===============
+    ``snapshot_attrs``     list           Fields recorded and returned by get_data
+    ``resolution``         dict           ``{<family>: (<every>, <aggregate>)}`` from parse_resolution
+    ``tables``             dict           ``{(<every>, <aggregate>): RecordTable}``
+    ``table_fields``       dict           ``{(<every>, <aggregate>): [<field>]}``, in column order
+    ====================== ============== ===============
+
+    Numeric fields are attributes with the same nested structure as their
+    data, e.g. ``storage``: ``{<currency>: <column>}``.
+    """
 
     @classmethod
-    def from_agent(cls, agent):
-        return cls(agent)
+    def from_agent(cls, agent, expected_steps=None, resolution=None, fields=None):
+        return cls(agent, expected_steps, resolution, fields)
 
-    def __init__(self, agent):
+    def __init__(self, agent, expected_steps=None, resolution=None, fields=None):
         # Static Fields
         self.agent = agent
         self.name = agent.agent_type
-        self.age = []
-        self.amount = []
+        self.age = None
+        self.amount = None
         self.snapshot_attrs = ['name', 'age', 'amount']
         # Plant-Specific Fields
         for attr in ['lifetime', 'full_amount', 'reproduce']:
@@ -19,13 +300,13 @@ class AgentDataCollector():
         # Plants
         if agent.agent_class == 'plants':
             self.snapshot_attrs.append('growth')
-            self.growth = dict(par_factor=[], cu_factor=[], te_factor=[],
-                density_factor=[], crop_management_factor=[], growth_rate=[],
-                grown=[], agent_step_num=[])
+            self.growth = dict.fromkeys(['par_factor', 'cu_factor', 'te_factor',
+                'density_factor', 'crop_management_factor', 'growth_rate',
+                'grown', 'agent_step_num'])
         # Concrete
         if agent.agent_type == 'concrete':
             self.snapshot_attrs.append('growth')
-            self.growth = dict(carbonation_rate=[], carbonation=[])
+            self.growth = dict(carbonation_rate=None, carbonation=None)
         # Dynamic Fields
         for attr, attr_value in self.agent.attrs.items():
             if attr_value == 0:
@@ -36,11 +317,11 @@ class AgentDataCollector():
                     self.snapshot_attrs.append('storage')
                     self.storage = {}
                 currency = attr.split('_', 2)[2]
-                self.storage[currency] = []
+                self.storage[currency] = None
                 if 'storage_ratios' not in self.snapshot_attrs:
                     self.snapshot_attrs.append('storage_ratios')
                     self.storage_ratios = {}
-                self.storage_ratios[currency] = []
+                self.storage_ratios[currency] = None
                 if 'capacity' not in self.snapshot_attrs:
                     self.snapshot_attrs.append('capacity')
                     self.capacity = {}
@@ -62,28 +343,28 @@ class AgentDataCollector():
                 if currency_desc['type'] == 'currency':
                     self.flows[prefix][currency] = {}
                     for storage in self.agent.selected_storage[prefix][currency]:
-                        self.flows[prefix][currency][storage.agent_type] = []
+                        self.flows[prefix][currency][storage.agent_type] = None
                 # Currency classes
                 elif currency_desc['type'] == 'currency_class':
                     for class_currency in currency_desc['currencies']:
                         self.flows[prefix][class_currency] = {}
                     for storage in self.agent.selected_storage[prefix][currency]:
                         for class_currency in currency_desc['currencies']:
-                            self.flows[prefix][class_currency][storage.agent_type] = []
+                            self.flows[prefix][class_currency][storage.agent_type] = None
                 # Buffer
                 cr_buffer = self.agent.attr_details[attr]['criteria_buffer']
                 if cr_buffer:
                     if 'buffer' not in self.snapshot_attrs:
                         self.snapshot_attrs.append('buffer')
                         self.buffer = {}
-                    self.buffer[attr] = []
+                    self.buffer[attr] = None
                 # Deprive
                 deprive_value = self.agent.attr_details[attr]['deprive_value']
                 if deprive_value:
                     if 'deprive' not in self.snapshot_attrs:
                         self.snapshot_attrs.append('deprive')
                         self.deprive = {}
-                    self.deprive[attr] = []
+                    self.deprive[attr] = None
             # Events
             if attr.startswith('event'):
                 if 'events' not in self.snapshot_attrs:
@@ -99,53 +380,111 @@ class AgentDataCollector():
             self.initial_variable = self.agent.initial_variable
         if 'step_variable' in self.agent:
             self.snapshot_attrs.append('step_variable')
-            self.step_variable = []
+            self.step_variable = None
+        # Collection plan
+        if fields is not None:
+            fields = set(fields)
+            if 'events' in fields:
+                fields.add('event_multipliers')
+            self.snapshot_attrs = [f for f in self.snapshot_attrs
+                                   if f == 'name' or f in fields]
 
-    def step(self):
-        self.age.append(self.agent.age)
-        self.amount.append(self.agent.amount)
-        if 'storage' in self.snapshot_attrs:
-            for currency, record in self.storage.items():
-                record.append(self.agent[currency])
-            for currency, record in self.storage_ratios.items():
-                record.append(self.agent.model.storage_ratios[self.name][currency + '_ratio'])
-        if 'growth' in self.snapshot_attrs:
-            for field, record in self.growth.items():
-                record.append(getattr(self.agent, field))
-        if 'co2_scale' in self.snapshot_attrs:
-            for field, record in self.co2_scale.items():
-                record.append(self.agent.co2_scale[field])
-        if 'flows' in self.snapshot_attrs:
+        # Numeric records are stored in a table for each resolution
+        if resolution is None:
+            resolution = parse_resolution(
+                None, agent.model.day_length_hours / agent.model.hours_per_step)
+        self.resolution = resolution
+        self.expected_steps = expected_steps
+        self.record_fields = [f for f in RECORD_FIELDS if f in self.snapshot_attrs]
+        self.tables = {}        # {(<every>, <aggregate>): RecordTable}
+        self.table_fields = {}  # {(<every>, <aggregate>): [<field>]}
+        for field in self.record_fields:
+            self.table_fields.setdefault(resolution[field], []).append(field)
+        for key, fields in self.table_fields.items():
+            columns = []
+            for field in fields:
+                setattr(self, field, _assign_columns(getattr(self, field), columns))
+            self.tables[key] = RecordTable(len(columns), *key, expected_steps)
+        self.events_every = resolution['events'][0]
+
+    def __deepcopy__(self, memo):
+        """Copy records shallowly, which is much faster than deepcopy
+
+        Event records hold references to the agent's event objects, so
+        they're copied deeply.
+        """
+        copied = self.__class__.__new__(self.__class__)
+        memo[id(self)] = copied
+        for key, value in self.__dict__.items():
+            if key in ['agent', 'events', 'event_multipliers', 'tables']:
+                value = copy.deepcopy(value, memo)
+            else:
+                value = _copy_records(value)
+            copied.__dict__[key] = value
+        return copied
+
+    def _add_values(self, field, agent, row):
+        """Append the current values of a field to row, in column order"""
+        if field == 'age':
+            row.append(agent.age)
+        elif field == 'amount':
+            row.append(agent.amount)
+        elif field == 'storage':
+            for currency in self.storage:
+                row.append(agent[currency])
+        elif field == 'storage_ratios':
+            ratios = agent.model.storage_ratios[self.name]
+            for currency in self.storage_ratios:
+                row.append(ratios[currency + '_ratio'])
+        elif field == 'growth':
+            for attr in self.growth:
+                row.append(getattr(agent, attr))
+        elif field == 'flows':
             for prefix, currencies in self.flows.items():
                 for currency, storages in currencies.items():
-                    step_data = self.agent.step_exchange_buffer[prefix].get(currency)
-                    for agent, record in storages.items():
-                        value = 0 if not step_data else step_data.get(agent, 0)
-                        record.append(value)
-        if 'buffer' in self.snapshot_attrs:
-            for cr_id, record in self.buffer.items():
-                record.append(self.agent.buffer.get(cr_id, 0))
-        if 'deprive' in self.snapshot_attrs:
-            for currency, record in self.deprive.items():
-                record.append(self.agent.deprive.get(currency, 0))
-        if 'step_variable' in self.snapshot_attrs:
-            self.step_variable.append(self.agent.step_variable)
-        if 'events' in self.snapshot_attrs:
+                    step_data = agent.step_exchange_buffer[prefix].get(currency)
+                    for storage in storages:
+                        row.append(0 if not step_data else step_data.get(storage, 0))
+        elif field == 'buffer':
+            for cr_id in self.buffer:
+                row.append(agent.buffer.get(cr_id, 0))
+        elif field == 'deprive':
+            for currency in self.deprive:
+                row.append(agent.deprive.get(currency, 0))
+        elif field == 'step_variable':
+            row.append(agent.step_variable)
+
+    def step(self):
+        agent = self.agent
+        step_num = agent.model.step_num
+        for key, table in self.tables.items():
+            if not table.records(step_num):
+                continue
+            row = []
+            for field in self.table_fields[key]:
+                self._add_values(field, agent, row)
+            table.add(row, step_num)
+        if 'events' in self.snapshot_attrs and ends_period(step_num, self.events_every):
             for event, record in self.events.items():
-                if event in self.agent.events:
-                    record.append(self.agent.events[event])
-                    self.event_multipliers[event].append(self.agent.event_multipliers[event])
+                if event in agent.events:
+                    record.append(agent.events[event])
+                    self.event_multipliers[event].append(agent.event_multipliers[event])
                 else:
                     record.append([])
                     self.event_multipliers[event].append('-')
 
+    def get_data(self, step_range=None, fields=None, debug=False, clear_cache=False,
+                 arrays=False):
+        """Return all data (default) or specified range/fields.
 
-    def get_data(self, step_range=None, fields=None, debug=False, clear_cache=False):
-        """Return all data (default) or specified range/fields."""
+        Numeric records are lists, or with ``arrays``, slices of the tables,
+        which are overwritten after ``clear_cache``. With a data resolution,
+        ``step_range`` selects recorded rows rather than steps.
+        """
         if debug or fields == None:
             fields = self.snapshot_attrs
         else:
-            fields = [f for f in fields if self.snapshot_attrs.includes(f)]
+            fields = [f for f in fields if f in self.snapshot_attrs]
 
         def _copy_range(value, start, end):
             """Recursively segment lists"""
@@ -155,21 +494,25 @@ class AgentDataCollector():
                 return value[start:end]
             elif isinstance(value, dict):
                 return {k: _copy_range(v, start, end) for k, v in value.items()}
-        if step_range is None:
-            start, end = 0, len(self.age)
-        else:
-            start, end = step_range
-        data = {f: _copy_range(getattr(self, f), start, end) for f in fields}
+        def _copy_columns(table, value, start, end):
+            """Recursively replace column numbers with their records"""
+            if isinstance(value, dict):
+                return {k: _copy_columns(table, v, start, end) for k, v in value.items()}
+            return table.get_column(value, start, end, arrays)
+        start, end = (None, None) if step_range is None else step_range
+        data = {}
+        for f in fields:
+            if f in self.record_fields:
+                table = self.tables[self.resolution[f]]
+                data[f] = _copy_columns(table, getattr(self, f), start, end)
+            else:
+                data[f] = _copy_range(getattr(self, f), start, end)
 
         if clear_cache:
-            def _clear(section):
-                """Recursively clear lists while retaining and dict structures and strs"""
-                if isinstance(section, list):
-                    return []
-                elif isinstance(section, dict):
-                    return {k: _clear(v) for k, v in section.items()}
-                else:
-                    return section
-            for field in self.snapshot_attrs:
-                setattr(self, field, _clear(getattr(self, field)))
+            for table in self.tables.values():
+                table.clear()
+            for field in ['events', 'event_multipliers']:
+                if field in self.snapshot_attrs:
+                    for record in getattr(self, field).values():
+                        record.clear()
         return data
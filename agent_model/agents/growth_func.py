@@ -1,35 +1,87 @@
 r"""Describes Core Agent Types.
 """
 import numpy as np
-from scipy.stats import norm
-from sklearn.preprocessing import MinMaxScaler
-import functools
-from scipy.optimize import minimize
-from scipy.optimize import Bounds
+
+from agent_model.util import LRUCache
 
 np.seterr(over='ignore')
 
+_NORM_PDF_C = np.sqrt(2 * np.pi)
+_EPS = np.finfo(float).eps
+_INV_PHI = (np.sqrt(5) - 1) / 2
+
+unit_curves = LRUCache(maxsize=512)   # {(<curve>, *<params>): <read-only array>}
+max_values = LRUCache(maxsize=1024)   # {(<curve>, *<params>): <max_value>}
+
+
+# Curves are built in two parts: a unit curve, which only depends on the
+# shape parameters, and a rescaling to [min_value, max_value]. Unit curves
+# are cached by their parameters in unit_curves, and are read-only. Rescaling writes into
+# one new buffer, with one row per value if min_value or max_value are
+# arrays, so many curves (e.g. one per day) can be built at once.
+#
+# The arithmetic is the same as scipy.stats.norm.pdf and sklearn's
+# MinMaxScaler, which were used before, so curves are identical.
+def norm_pdf(num_values, scale, center):
+    """Return the (read-only) normal pdf of num_values points in 0-1, centered on index center"""
+    center = center or num_values // 2
+    def _norm_pdf():
+        x0 = np.linspace(0, 1, num_values)
+        z = (x0 - x0[center]) / scale
+        return np.exp(-z**2 / 2.0) / _NORM_PDF_C / scale
+    return unit_curves.get(('norm', num_values, scale, center), _norm_pdf)
+
+
+def scale_curve(unit_curve, min_value, max_value):
+    """Return unit_curve rescaled from its min and max to min_value and max_value
 
-# Caching norm.pdf() directly is not possible since
-# x0 is a non-hashable numpy.ndarray.  x0 depends
-# on num_values, so we can create this helper function
-# and cache num_values, scale, and center instead.
-# This makes DB initializazion much faster, since
-# of the 15k calls done, all except 12 can be cached.
-# We also can't use lru_cache() directly because the
-# return value is a mutable ndarray, and we need to
-# explicitly create and return a copy.
-def norm_pdf(num_values, scale, center, *, _cache={}):
-    if (num_values, scale, center) in _cache:
-        y = _cache[(num_values, scale, center)].copy()
+    Args:
+      unit_curve: 1-D array
+      min_value, max_value: float, or 1-D arrays for one curve per value
+
+    Returns:
+      new array, 1-D, or 2-D with a row per value
+    """
+    lower, upper = np.asarray(min_value, dtype=float), np.asarray(max_value, dtype=float)
+    if np.any(lower >= upper):
+        raise ValueError("Minimum of desired feature range must be smaller than maximum. "
+                         f"Got {(min_value, max_value)}.")
+    data_min = unit_curve.min()
+    data_range = unit_curve.max() - data_min
+    if data_range < 10 * _EPS:
+        data_range = 1.0  # Near constant curve
+    scale = (upper - lower) / data_range
+    offset = lower - data_min * scale
+    if scale.ndim == 0:
+        y = unit_curve * scale
+        y += offset
     else:
-        center = center or num_values // 2
-        x0 = np.linspace(0, 1, num_values)
-        y = norm.pdf(x0, x0[center], scale)
-        _cache[(num_values, scale, center)] = y
+        scale, offset = np.broadcast_arrays(scale, offset)
+        y = np.empty((scale.shape[0], unit_curve.shape[0]))
+        np.multiply(unit_curve, scale[:, None], out=y)
+        y += offset[:, None]
     return y
 
 
+def _row_bounds(y, value):
+    """Return value, broadcast against the rows of y"""
+    value = np.asarray(value, dtype=float)
+    return value[:, None] if y.ndim == 2 and value.ndim == 1 else value
+
+
+def _add_noise(y, noise_factor, start=0, stop=None):
+    """Add normal noise to y[..., start:stop] in place, one draw per row"""
+    for row in (y if y.ndim == 2 else [y]):
+        part = row[start:stop]
+        part += np.random.normal(0, row.std() / noise_factor, part.shape[0])
+
+
+def _invert(y, min_value, max_value):
+    np.negative(y, out=y)
+    y += _row_bounds(y, max_value)
+    y += _row_bounds(y, min_value)
+
+
 def get_bell_curve(num_values, min_value, max_value, scale=0.1, center=None, invert=False,
                    noise=False, noise_factor=10.0, clip=False, **kwargs):
     """TODO
@@ -56,16 +108,13 @@ def get_bell_curve(num_values, min_value, max_value, scale=0.1, center=None, inv
     assert min_value is not None
     assert max_value is not None
     assert scale is not None
-    y = norm_pdf(num_values, scale, center)
-    y = MinMaxScaler((min_value, max_value)).fit_transform(y.reshape(-1, 1)).reshape(num_values)
+    y = scale_curve(norm_pdf(num_values, scale, center), min_value, max_value)
     if invert:
-        y = -1 * y
-        y = y + max_value + min_value
+        _invert(y, min_value, max_value)
     if noise:
-        noise = np.random.normal(0, y.std() / noise_factor, num_values)
-        y += noise
+        _add_noise(y, noise_factor)
     if clip:
-        y = np.clip(y, min_value, max_value)
+        np.clip(y, _row_bounds(y, min_value), _row_bounds(y, max_value), out=y)
     return y
 
 
@@ -95,48 +144,68 @@ def get_clipped_bell_curve(num_values, min_value, max_value, scale=0.1, factor=2
     assert min_value is not None
     assert max_value is not None
     assert scale is not None
-    y = norm_pdf(num_values, scale, center)
-    y = MinMaxScaler((min_value, max_value * factor)).fit_transform(y.reshape(-1, 1)).reshape(num_values)
-    y = np.clip(y, min_value, max_value)
+    y = scale_curve(norm_pdf(num_values, scale, center), min_value,
+                    np.asarray(max_value, dtype=float) * factor)
+    np.clip(y, _row_bounds(y, min_value), _row_bounds(y, max_value), out=y)
     if invert:
-        y = -1 * y
-        y = y + max_value + min_value
+        _invert(y, min_value, max_value)
     if noise:
-        noise = np.random.normal(0, y.std() / noise_factor, num_values)
-        y += noise
+        _add_noise(y, noise_factor)
     return y
 
 
-def optimize_bell_curve_mean(mean_value, num_values, center, min_value, invert,
-                             noise, noise_factor=10, **kwargs):
-    del kwargs
-    _get_bell_curve = functools.partial(get_bell_curve, num_values=num_values, center=center,
-                                        min_value=min_value, invert=invert, noise=noise,
-                                        noise_factor=noise_factor)
+def _solve_max_value(mean_value, min_value, unit_curve, invert, lower, upper):
+    """Return the max_value which minimizes the loss of optimize_bell_curve_mean
 
+    Curves are ``min_value + d * u``, where u is unit_curve scaled to 0-1
+    (or ``1 - u`` if inverted) and ``d = max_value - min_value``, so the
+    loss ``|mean_value - mean(y)| + |y[0] - min_value| + |y[-1] - min_value|``
+    is ``|mean_value - min_value - a * d| + b * |d|``. It's convex in d, so
+    its minimum within the bounds is at one of its kinks or bounds.
+    """
+    span = unit_curve.max() - unit_curve.min()
+    u = (unit_curve - unit_curve.min()) / span if span > 0 else np.zeros_like(unit_curve)
+    if invert:
+        u = 1 - u
+    a, b = u.mean(), u[0] + u[-1]
     def _loss(max_value):
-        y = _get_bell_curve(max_value=max_value)
-        rmse = np.sqrt(
-            (np.abs(mean_value - np.mean(y)) +
-             np.abs(y[0] - min_value)
-             + np.abs(y[-1] - min_value)) ** 2)
-        return rmse
-
-    res = minimize(_loss, mean_value, bounds=[[max(1e-8, mean_value), 1e8]], options={'disp': False})
-    return {'max_value': res.x[0]}
-
-
-# this function manually caches some calculations,
-# similarly to the norm_pdf function above
-def calc_y(num_values, width, center, steepness, *, _cache={}):
-    if (num_values, width, center, steepness) in _cache:
-        y = _cache[(num_values, width, center, steepness)].copy()
-    else:
-        center = center or num_values // 2
-        x0 = np.linspace(-width, width, num_values)
-        y = 1 / (1. + np.exp(-steepness * (x0 - x0[center])))
-        _cache[(num_values, width, center, steepness)] = y
-    return y
+        d = max_value - min_value
+        return abs(mean_value - min_value - a * d) + b * abs(d)
+    candidates = [min_value, lower, upper]
+    if a > 0:
+        candidates.append(min_value + (mean_value - min_value) / a)
+    candidates = [min(max(c, lower), upper) for c in candidates]
+    return min(candidates, key=_loss)
+
+
+def _bell_curve_max_value(mean_value, num_values, center, min_value, invert, scale):
+    y = norm_pdf(num_values, scale, center)
+    return _solve_max_value(mean_value, min_value, y, invert, max(1e-8, mean_value), 1e8)
+
+
+def optimize_bell_curve_mean(mean_value, num_values, center, min_value, invert,
+                             noise, noise_factor=10, scale=0.1, **kwargs):
+    """Return the max_value of a bell curve with a mean of mean_value
+
+    Solved in closed form (see ``_solve_max_value``) rather than by a
+    general optimizer, and memoized by parameters. Noise has a mean of
+    zero, so it's ignored.
+    """
+    del kwargs, noise, noise_factor
+    center = None if center is None else int(center)
+    args = (mean_value, num_values, center, min_value, bool(invert), scale)
+    return {'max_value': max_values.get(('norm', *args), lambda: _bell_curve_max_value(*args))}
+
+
+def _unit_sigmoid(num_values, width, center, steepness):
+    center = center or num_values // 2
+    x0 = np.linspace(-width, width, num_values)
+    return 1 / (1. + np.exp(-steepness * (x0 - x0[center])))
+
+def calc_y(num_values, width, center, steepness):
+    """Return the (read-only) unit sigmoid of num_values points in -width-width"""
+    return unit_curves.get(('sigmoid', num_values, width, center or num_values // 2, steepness),
+                           lambda: _unit_sigmoid(num_values, width, center, steepness))
 
 def get_sigmoid_curve(num_values, min_value, max_value, steepness=1.0, center=None, noise=False,
                       noise_factor=10.0, width=10, clip=False, **kwargs):
@@ -164,32 +233,77 @@ def get_sigmoid_curve(num_values, min_value, max_value, steepness=1.0, center=No
     assert min_value is not None
     assert max_value is not None
     assert steepness is not None
-    y = calc_y(num_values, width, center, steepness)
-    y = MinMaxScaler((min_value, max_value)).fit_transform(y.reshape(-1, 1)).reshape(num_values)
+    y = scale_curve(calc_y(num_values, width, center, steepness), min_value, max_value)
     if noise:
-        noise = np.random.normal(0, y.std() / noise_factor, num_values)
-        y += noise
+        _add_noise(y, noise_factor)
     if clip:
-        y = np.clip(y, min_value, max_value)
+        np.clip(y, _row_bounds(y, min_value), _row_bounds(y, max_value), out=y)
     return y
 
 
-def optimize_sigmoid_curve_mean(mean_value, num_values, center, min_value,
-                                noise, noise_factor=10.0, **kwargs):
-    del kwargs
-    _get_sigmoid_curve = functools.partial(get_sigmoid_curve, num_values=num_values, center=center,
-                                           min_value=min_value, noise=noise,
-                                           noise_factor=noise_factor)
+def _sigmoid_fit(mean_value, num_values, center, min_value, steepness, width):
+    """Return the loss of optimize_sigmoid_curve_mean at steepness, and its max_value
+
+    The loss is ``|mean_value - mean(y)| / mean_value + steepness / num_values``.
+    Curves are ``min_value + d * u``, where u is the unit sigmoid scaled to
+    0-1, so the mean is matched by ``d = (mean_value - min_value) / mean(u)``,
+    within the bounds of max_value.
+    """
+    y = _unit_sigmoid(num_values, width, center, steepness)
+    span = y.max() - y.min()
+    mean_unit = (y.mean() - y.min()) / span if span > 0 else 0
+    if mean_unit <= 0:
+        max_value = max(mean_value, 1e-10)
+    else:
+        max_value = min(max(min_value + (mean_value - min_value) / mean_unit, 1e-10), 1e10)
+    mean = min_value + (max_value - min_value) * mean_unit
+    return abs(mean_value - mean) / mean_value + steepness / num_values, max_value
+
+
+def _sigmoid_curve_params(mean_value, num_values, center, min_value, width, tol=1e-10):
+    """Return the (steepness, max_value) which minimize the loss of _sigmoid_fit
+
+    A golden-section search over steepness in [1e-2, num_values / 2], with
+    the best max_value at each steepness. The bounds are also tried, since
+    the loss is usually lowest at the lower one.
+    """
+    def _loss(steepness):
+        return _sigmoid_fit(mean_value, num_values, center, min_value, steepness, width)[0]
+    lower, upper = 1e-2, num_values / 2
+    a, b = lower, upper
+    c, d = b - _INV_PHI * (b - a), a + _INV_PHI * (b - a)
+    loss_c, loss_d = _loss(c), _loss(d)
+    while b - a > tol * max(1, abs(a)):
+        if loss_c <= loss_d:
+            b, d, loss_d = d, c, loss_c
+            c = b - _INV_PHI * (b - a)
+            loss_c = _loss(c)
+        else:
+            a, c, loss_c = c, d, loss_d
+            d = a + _INV_PHI * (b - a)
+            loss_d = _loss(d)
+    fits = [(steepness, *_sigmoid_fit(mean_value, num_values, center, min_value,
+                                      steepness, width))
+            for steepness in [lower, (a + b) / 2, upper]]
+    steepness, _, max_value = min(fits, key=lambda fit: fit[1])
+    return steepness, max_value
 
-    def _loss(args):
-        steepness, max_value = args
-        y = _get_sigmoid_curve(steepness=steepness, max_value=max_value)
-        rmse = np.sqrt(np.abs(mean_value - np.mean(y)) ** 2)
-        return (rmse / mean_value) + (steepness / num_values)
 
-    x0 = np.array([num_values / 2, mean_value])
-    res = minimize(_loss, x0, bounds=Bounds([1e-2, 1e-10], [num_values / 2, 1e10]), options={'disp': False})
-    return {'steepness': res.x[0], 'max_value': res.x[1]}
+def optimize_sigmoid_curve_mean(mean_value, num_values, center, min_value,
+                                noise, noise_factor=10.0, width=10, **kwargs):
+    """Return the steepness and max_value of a sigmoid curve with a mean of mean_value
+
+    Minimizes the loss of the scipy optimizer used before (see
+    ``_sigmoid_fit``) with a search over steepness alone, since the best
+    max_value at each steepness is known in closed form. Memoized by
+    parameters. Noise has a mean of zero, so it's ignored.
+    """
+    del kwargs, noise, noise_factor
+    center = None if center is None else int(center)
+    args = (mean_value, num_values, center, min_value, width)
+    steepness, max_value = max_values.get(('sigmoid', *args),
+                                          lambda: _sigmoid_curve_params(*args))
+    return {'steepness': steepness, 'max_value': max_value}
 
 
 def get_log_curve(num_values, max_value, min_value, zero_value=1e-2, noise=False,
@@ -215,13 +329,14 @@ def get_log_curve(num_values, max_value, min_value, zero_value=1e-2, noise=False
     assert num_values
     assert min_value is not None
     assert max_value is not None
-    zero_value = zero_value if zero_value < max_value else max_value * zero_value
-    y = np.geomspace(zero_value, max_value - min_value, num_values) + min_value
+    zero_value = np.where(zero_value < max_value, zero_value,
+                          np.multiply(max_value, zero_value))
+    y = np.geomspace(zero_value, np.subtract(max_value, min_value), num_values, axis=-1)
+    y += _row_bounds(y, min_value)
     if noise:
-        noise = np.random.normal(0, y.std() / noise_factor, num_values)
-        y += noise
+        _add_noise(y, noise_factor)
     if clip:
-        y = np.clip(y, min_value, max_value)
+        np.clip(y, _row_bounds(y, min_value), _row_bounds(y, max_value), out=y)
     return y
 
 
@@ -247,12 +362,11 @@ def get_linear_curve(num_values, max_value, min_value, noise=False, noise_factor
     assert num_values
     assert min_value is not None
     assert max_value is not None
-    y = np.linspace(min_value, max_value, num_values)
+    y = np.linspace(min_value, max_value, num_values, axis=-1)
     if noise:
-        noise = np.random.normal(0, y.std() / noise_factor, num_values)
-        y += noise
+        _add_noise(y, noise_factor)
     if clip:
-        y = np.clip(y, min_value, max_value)
+        np.clip(y, _row_bounds(y, min_value), _row_bounds(y, max_value), out=y)
     return y
 
 
@@ -282,33 +396,37 @@ def get_switch_curve(num_values, min_value, max_value, min_threshold, max_thresh
     assert max_value is not None
     assert min_threshold is not None
     assert max_threshold is not None
-    y = np.zeros(num_values) + min_value
-    y[min_threshold:max_threshold] = max_value
+    shape = np.broadcast(np.asarray(min_value), np.asarray(max_value)).shape
+    y = np.zeros(shape + (num_values,))
+    y += _row_bounds(y, min_value)
+    y[..., min_threshold:max_threshold] = _row_bounds(y, max_value)
     if noise:
-        noise = np.random.normal(0, y.std() / noise_factor,
-                                 min(max_threshold, y.shape[0]) - min_threshold)
-        y[min_threshold:max_threshold] += noise
+        _add_noise(y, noise_factor, min_threshold, max_threshold)
     if clip:
-        y = np.clip(y, min_value, max_value)
+        np.clip(y, _row_bounds(y, min_value), _row_bounds(y, max_value), out=y)
     return y
 
 
 def get_growth_values(agent_value, growth_type, **kwargs):
-    """TODO
+    """Return a growth curve of growth_type
 
-    TODO
+    Curves are built at once for arrays of agent_value, min_value or
+    max_value, with one row per value.
 
     Args:
-      agent_value: float, TODO
-      growth_type: str, TODO
-      kwargs: Dict, TODO
+      agent_value: float or 1-D array, the max_value if it isn't positive
+      growth_type: str, e.g. 'norm', 'sigmoid', 'clipped', 'switch'
+      kwargs: Dict, arguments of the curve function
 
     Returns:
-      TODO
+      1-D array of num_values, or 2-D array with one row per value
     """
     assert growth_type
     assert agent_value is not None
-    if kwargs.get('max_value', 0.0) <= 0:
+    max_value = kwargs.get('max_value', 0.0)
+    if np.ndim(max_value) or np.ndim(agent_value):
+        kwargs['max_value'] = np.where(np.less_equal(max_value, 0), agent_value, max_value)
+    elif max_value <= 0:
         kwargs['max_value'] = agent_value
     if growth_type in ['linear', 'lin']:
         return get_linear_curve(**kwargs)
@@ -0,0 +1,535 @@
+r"""Describes lockstep simulation of a batch of model variants.
+
+A ``BatchedAgentModel`` holds K :ref:`agent-model` variants built from
+configs with the same agent topology (the same agent types and storages, in
+the same order), which may differ in amounts and parameters. The storage
+balances of all variants are the rows of one (K, n) array, so their ledgers
+are frozen: storages can't be added to a variant once it's batched. Each
+step:
+
+  1. Advances time and checks termination for each variant. Terminated
+     variants are masked out of the rest of the step.
+  2. Shuffles each priority class with the random state of each variant, as
+     the scalar scheduler does. When the activation orders agree (always,
+     unless the random streams of the variants diverge), agents are stepped
+     position by position across variants; otherwise each variant is
+     stepped in its own order.
+  3. Steps agent types which can be batched for all variants at once with a
+     ``BatchKernel``; other agents are stepped by each variant.
+
+A type can be batched if it's a plain GeneralAgent without custom
+functions, events, step variation or weighted flows, which doesn't store
+its own exchanges. Results are identical to stepping each variant on its
+own.
+"""
+
+import copy
+
+import numpy as np
+
+from agent_model.agent_model import AgentModel
+from agent_model.agents.core import GeneralAgent, StorageAgent
+from agent_model.initializer import AgentModelInitializer
+from agent_model.exceptions import AgentModelConfigError, AgentModelInitializationError
+
+
+def _signature(agent):
+    """Return the parts of an agent's step plan which batched agents must share"""
+    prelude = []
+    for step_type, step_data in agent.step_plan['prelude']:
+        if step_type == 'threshold':
+            storage_id, ratio_name, opp, _, currency = step_data
+            prelude.append((step_type, storage_id, ratio_name, opp, currency))
+        else:
+            prelude.append((step_type,))
+    flows = []
+    for flow in agent.step_plan['flows']:
+        criteria = flow['criteria']
+        flows.append((flow['attr'], flow['prefix'], flow['currency'],
+                      tuple(s.agent_type for s in flow['storages']),
+                      tuple(flow['requires']), flow['is_required'],
+                      criteria and (criteria['name'], criteria['opp']),
+                      len(agent.step_values[flow['attr']])))
+    return agent.has_storage, tuple(prelude), tuple(flows)
+
+
+class BatchKernel():
+    """Steps the agent of one type in every variant with NumPy operations
+
+    Age, deprive and criteria buffers are stored in the kernel, and written
+    back to the agents by ``sync`` at the end of every step. Amounts are
+    changed through the agents' ``kill`` method and mirrored in ``amount``.
+
+    ====================== ============== ===============
+          Attribute        Type               Description
+    ====================== ============== ===============
+    ``agents``             list           The agent of each variant
+    ``ledger``             np.ndarray     (K, n) storage balances of all variants
+    ``age``                np.ndarray     (K,) age of each agent
+    ``amount``             np.ndarray     (K,) amount of each agent
+    ``active``             np.ndarray     (K,) bool, whether each agent is active
+    ``deprive``            dict           ``{<attr>: (K,) np.ndarray}``
+    ``buffer``             dict           ``{<attr>: (K,) np.ndarray}``
+    ``records``            dict           ``{(<prefix>, <currency>, <storage type>): (K,) np.ndarray}``
+                                          exchanges of the current step
+    ====================== ============== ===============
+    """
+
+    @staticmethod
+    def can_batch(agents):
+        """Return True if the agents of all variants can be stepped together"""
+        signature = None
+        for agent in agents:
+            if type(agent) is not GeneralAgent or agent.step_variation is not None:
+                return False
+            for step_type, _ in agent.step_plan['prelude']:
+                if step_type == 'custom_function':
+                    return False
+                if step_type == 'event' and agent.process_events:
+                    return False
+            for flow in agent.step_plan['flows']:
+                if flow['weights']:
+                    return False
+                criteria = flow['criteria']
+                if criteria and (criteria['name'] in agent or
+                                 criteria['name'].split('_')[-1] not in ['in', 'out']):
+                    return False
+                if agent in flow['storages']:
+                    return False
+                if (flow['prefix'] == 'out' and
+                    agent.currency_dict[flow['currency']]['type'] != 'currency'):
+                    return False
+            if signature is None:
+                signature = _signature(agent)
+            elif _signature(agent) != signature:
+                return False
+        return True
+
+    def __init__(self, agents, ledger):
+        self.agents = agents
+        self.models = [agent.model for agent in agents]
+        self.ledger = ledger
+        first = agents[0]
+        n_variants = len(agents)
+        self.agent_type = first.agent_type
+        self.has_storage = first.has_storage
+        self.hours_per_step = np.array([m.hours_per_step for m in self.models], dtype=float)
+        self.age = np.array([a.age for a in agents], dtype=float)
+        self.amount = np.array([a.amount for a in agents], dtype=float)
+        self.active = np.array([a.active for a in agents], dtype=bool)
+        self.thresholds = []
+        for i, (step_type, step_data) in enumerate(first.step_plan['prelude']):
+            if step_type != 'threshold':
+                continue
+            storage_id, ratio_name, opp, _, currency = step_data
+            values = np.array([a.step_plan['prelude'][i][1][3] for a in agents], dtype=float)
+            self.thresholds.append((storage_id, ratio_name, opp, values, currency))
+        self.flows = []
+        self.deprive = {}
+        self.buffer = {}
+        self.buffer_attrs = []
+        for i, flow in enumerate(first.step_plan['flows']):
+            attr = flow['attr']
+            plans = [a.step_plan['flows'][i] for a in agents]
+            compiled = dict(
+                attr=attr,
+                prefix=flow['prefix'],
+                currency=flow['currency'],
+                requires=flow['requires'],
+                is_required=flow['is_required'],
+                step_values=np.array([a.step_values[attr] for a in agents], dtype=float),
+                deprive_value=np.array([p['deprive_value'] for p in plans], dtype=float),
+                delta_per_step=np.array([p['delta_per_step'] for p in plans], dtype=float),
+                criteria=None,
+                conns=[])
+            if flow['criteria']:
+                criteria = flow['criteria']
+                direction = criteria['name'].split('_')[-1]
+                elements = criteria['name'].split('_')
+                compiled['criteria'] = dict(
+                    storage_id=first.selected_storage[direction][elements[0]][0].agent_type,
+                    ratio_name='_'.join(elements[:2]),
+                    opp=criteria['opp'],
+                    value=np.array([p['criteria']['value'] for p in plans], dtype=float),
+                    buffer=np.array([p['criteria']['buffer'] for p in plans], dtype=float))
+                self.buffer[attr] = np.array([a.buffer.get(attr, 0) for a in agents],
+                                             dtype=float)
+                if attr in first.buffer:
+                    self.buffer_attrs.append(attr)
+            if compiled['deprive_value'].any():
+                self.deprive[attr] = np.array([a.deprive.get(attr, 0) for a in agents],
+                                              dtype=float)
+            for j, storage in enumerate(flow['storages']):
+                currencies, indices = storage._get_ledger_view(flow['currency'])
+                storages = [a.step_plan['flows'][i]['storages'][j] for a in agents]
+                conn = dict(agent_type=storage.agent_type, storages=storages,
+                            currencies=currencies, cols=indices)
+                if flow['prefix'] == 'out':
+                    conn['capacity'] = np.array(
+                        [s['char_capacity_' + flow['currency']] for s in storages], dtype=float)
+                compiled['conns'].append(conn)
+            self.flows.append(compiled)
+        self.records = {}
+        self.n_variants = n_variants
+
+    def _record(self, key, variants, values):
+        record = self.records.get(key)
+        if record is None:
+            record = self.records[key] = np.zeros(self.n_variants)
+        record[variants] = values
+
+    def _kill(self, k, number, reason):
+        agent = self.agents[k]
+        agent.kill(number, reason)
+        self.amount[k] = agent.amount
+        if agent.amount == 0:
+            # destroy() clears the exchanges of this step
+            self.active[k] = False
+            for record in self.records.values():
+                record[k] = 0
+
+    def _get_step_values(self, flow, variants):
+        """Return the base value of an exchange for each variant, as _get_step_value"""
+        step_values = flow['step_values']
+        n_steps = step_values.shape[1]
+        values = step_values[variants, self.age[variants].astype(int) % n_steps]
+        criteria = flow['criteria']
+        if criteria:
+            source = np.array([self.models[k].storage_ratios[criteria['storage_id']]
+                               [criteria['ratio_name']] for k in variants])
+            passed = criteria['opp'](source, criteria['value'][variants])
+            cr_buffer = criteria['buffer'][variants]
+            buffer = self.buffer[flow['attr']]
+            buffered = passed & (cr_buffer > 0) & (buffer[variants] > 0)
+            buffer[variants[buffered]] -= 1
+            reset = ~passed & (cr_buffer > 0)
+            buffer[variants[reset]] = cr_buffer[reset]
+            values = np.where(buffered | ~passed, 0.0, values)
+        return values
+
+    def _withdraw(self, flow, conn, variants, amounts):
+        """Decrease storage balances, as StorageAgent.increment with a negative amount"""
+        variants, amounts = variants[amounts > 0], amounts[amounts > 0]
+        if len(variants) == 0:
+            return
+        cols = conn['cols']
+        current = self.ledger[variants[:, None], cols]
+        total = 0
+        for j in range(len(cols)):
+            total = total + current[:, j]
+        empty = total <= 0
+        for currency in conn['currencies']:
+            self._record((flow['prefix'], currency, conn['agent_type']), variants[empty], 0)
+        has_balance = ~empty
+        variants, amounts = variants[has_balance], amounts[has_balance]
+        current, total = current[has_balance], total[has_balance]
+        if len(variants) == 0:
+            return
+        ratios = current / total[:, None]
+        new = np.maximum(current - amounts[:, None] * ratios, 0)
+        for k in variants:
+            conn['storages'][k]._mark_ratios_dirty()
+        self.ledger[variants[:, None], cols] = new
+        exchanged = np.abs(current - new)
+        for j, currency in enumerate(conn['currencies']):
+            self._record((flow['prefix'], currency, conn['agent_type']), variants,
+                         exchanged[:, j])
+
+    def _deposit(self, flow, conn, variants, amounts):
+        """Increase storage balances, as StorageAgent.increment with a positive amount"""
+        variants, amounts = variants[amounts > 0], amounts[amounts > 0]
+        if len(variants) == 0:
+            return
+        col = conn['cols'][0]
+        current = self.ledger[variants, col]
+        storages = conn['storages']
+        # Storages may be killed, so their amounts are read each step
+        capacity = conn['capacity'][variants] * np.array([storages[k].amount for k in variants])
+        new = np.minimum(current + amounts, capacity)
+        for k in variants:
+            conn['storages'][k]._mark_ratios_dirty()
+        self.ledger[variants, col] = new
+        self._record((flow['prefix'], flow['currency'], conn['agent_type']), variants,
+                     np.abs(current - new))
+
+    def step(self, live, value_eps=1e-12):
+        """Step the agents of the variants in ``live``, as GeneralAgent.step
+
+        Args:
+          live: np.ndarray, indices of variants whose agent is active
+        """
+        agents = self.agents
+        for record in self.records.values():
+            record[live] = 0
+        # 1. PRELUDE
+        if self.has_storage:
+            for k in live:
+                StorageAgent.step(agents[k])
+        self.age[live] += self.hours_per_step[live]
+        for storage_id, ratio_name, opp, threshold, currency in self.thresholds:
+            ratios = np.array([self.models[k].storage_ratios[storage_id][ratio_name]
+                               for k in live])
+            met = opp(ratios, threshold[live])
+            for k in live[met]:
+                self._kill(k, agents[k].amount, f'Threshold {currency} met for '
+                           f'{self.agent_type}. Killing the agent')
+            live = live[~met]
+
+        # 2. EXCHANGES
+        influx = {}
+        for flow in self.flows:
+            if len(live) == 0:
+                return
+            prefix, currency = flow['prefix'], flow['currency']
+            variants = live
+            for _currency in flow['requires']:
+                if _currency not in influx:
+                    variants = variants[:0]
+                else:
+                    variants = variants[~np.isnan(influx[_currency][variants])]
+            if len(variants) == 0:
+                continue
+            step_mag = self._get_step_values(flow, variants)
+            for _currency in flow['requires']:
+                step_mag = step_mag * influx[_currency][variants]
+            target_value = step_mag * self.amount[variants]
+            actual_value = target_value.copy()
+
+            available_value = 0
+            storage_values = []
+            for conn in flow['conns']:
+                current = self.ledger[variants[:, None], conn['cols']]
+                storage_value = 0
+                for j in range(current.shape[1]):
+                    storage_value = storage_value + current[:, j]
+                available_value = available_value + storage_value
+                storage_values.append(storage_value)
+            if prefix == 'in':
+                has_deficit = available_value < target_value
+            else:
+                has_deficit = np.zeros(len(variants), dtype=bool)
+
+            if flow['is_required'] == 'mandatory' and has_deficit.any():
+                live = live[~np.isin(live, variants[has_deficit])]
+                keep = ~has_deficit
+                variants, step_mag, has_deficit = variants[keep], step_mag[keep], has_deficit[keep]
+                target_value, actual_value = target_value[keep], actual_value[keep]
+                available_value = available_value[keep]
+                storage_values = [v[keep] for v in storage_values]
+
+            deprive_value = flow['deprive_value'][variants]
+            has_deprive = deprive_value > 0
+            actual_value = np.where(has_deficit & ~has_deprive, available_value, actual_value)
+            if has_deprive.any():
+                deprive = self.deprive[flow['attr']]
+                full = has_deprive & ~has_deficit
+                if full.any():
+                    ks = variants[full]
+                    deprive[ks] = np.minimum(deprive_value[full] * self.amount[ks],
+                                             deprive[ks] + deprive_value[full])
+                short = has_deprive & has_deficit
+                if short.any():
+                    ks = variants[short]
+                    n_satisfied = np.floor(available_value[short] / step_mag[short])
+                    actual_value[short] = n_satisfied * step_mag[short]
+                    delta_per_step = flow['delta_per_step'][ks]
+                    max_survive = np.floor(np.maximum(deprive[ks], 0) / delta_per_step)
+                    n_deprived = self.amount[ks] - n_satisfied
+                    n_survive = np.minimum(n_deprived, max_survive)
+                    deprive[ks] -= delta_per_step * n_survive
+                    n_die = n_deprived - n_survive
+                    for k, number in zip(ks[n_die > 0], n_die[n_die > 0]):
+                        self._kill(k, int(number), f'All {self.agent_type} died from '
+                                   f'lack of {currency}. Killing the agent')
+                    alive = self.amount[variants] > 0
+                    if not alive.all():
+                        live = live[self.amount[live] > 0]
+                        variants, actual_value = variants[alive], actual_value[alive]
+                        target_value = target_value[alive]
+                        storage_values = [v[alive] for v in storage_values]
+
+            exchanged = actual_value >= value_eps
+            variants, actual_value = variants[exchanged], actual_value[exchanged]
+            storage_values = [v[exchanged] for v in storage_values]
+            if prefix == 'in':
+                if currency not in influx:
+                    influx[currency] = np.full(self.n_variants, np.nan)
+                influx[currency][variants] = actual_value / target_value[exchanged]
+            remaining_value = actual_value
+            n_conns = len(flow['conns'])
+            for conn, storage_value in zip(flow['conns'], storage_values):
+                if prefix == 'in':
+                    conn_delta = np.minimum(remaining_value, storage_value)
+                    self._withdraw(flow, conn, variants, conn_delta)
+                else:
+                    conn_delta = remaining_value / n_conns
+                    self._deposit(flow, conn, variants, conn_delta)
+                remaining_value = remaining_value - conn_delta
+
+    def sync(self, k):
+        """Write the state of variant ``k`` back to its agent"""
+        agent = self.agents[k]
+        agent.age = self.age.item(k)
+        for attr, deprive in self.deprive.items():
+            agent.deprive[attr] = deprive.item(k)
+        for attr in self.buffer_attrs:
+            agent.buffer[attr] = self.buffer[attr].item(k)
+        buffer = {'in': {}, 'out': {}}
+        if agent.active:
+            for (prefix, currency, storage_type), record in self.records.items():
+                buffer[prefix].setdefault(currency, {})[storage_type] = record.item(k)
+        agent.step_exchange_buffer = buffer
+
+
+class BatchedAgentModel():
+    """K variants of an AgentModel, stepped in lockstep
+
+    ====================== ============== ===============
+          Attribute        Type               Description
+    ====================== ============== ===============
+    ``models``             list           ``[AgentModel]`` one model per variant
+    ``ledger``             np.ndarray     (K, n) storage balances; row k is ``models[k].ledger.values``
+    ``kernels``            dict           ``{<agent_type>: BatchKernel}`` for types which can be batched
+    ====================== ============== ===============
+    """
+
+    @classmethod
+    def from_configs(cls, configs, data_collection=False, currency_desc=None,
+                     agent_desc=None, agent_conn=None, agent_variation=None,
+                     agent_events=None):
+        """Takes a list of configurations, returns an initialized batch
+
+        Args:
+           * ``configs``: list of :ref:`simoc-config`
+
+        Kwargs:
+            * ``data_collection``: bool
+            * ``currency_desc``, ``agent_desc``, ``agent_conn``,
+              ``agent_variation``, ``agent_events``: as in ``AgentModel.from_config``
+        """
+        initializers = []
+        for config in configs:
+            initializer, errors = AgentModelInitializer.from_new(
+                copy.deepcopy(config), currency_desc, agent_desc, agent_conn,
+                agent_variation, agent_events)
+            if any(len(errors[c]) > 0 for c in ['model', 'agents', 'currencies']):
+                raise AgentModelConfigError(errors)
+            initializers.append(initializer)
+        return cls(initializers, data_collection)
+
+    def __init__(self, initializers, data_collection=False):
+        self.models = [AgentModel(initializer, data_collection) for initializer in initializers]
+        if len(self.models) == 0:
+            raise AgentModelInitializationError("A batch needs at least one variant")
+        first = self.models[0]
+        topology = [(a.agent_type, a.ledger_index) for a in first.scheduler.agents]
+        for model in self.models[1:]:
+            if ([(a.agent_type, a.ledger_index) for a in model.scheduler.agents] != topology
+                    or model.priorities != first.priorities):
+                raise AgentModelInitializationError(
+                    "All variants in a batch must have the same agent topology")
+        self.ledger = np.stack([m.ledger.values[:m.ledger.size] for m in self.models])
+        for k, model in enumerate(self.models):
+            model.ledger.values = self.ledger[k]
+            model.ledger.frozen = True
+        self.kernels = {}
+        # Without priorities, every variant steps its own agents
+        for agent_type, agents in (first.agents_by_type.items() if first.priorities else ()):
+            if len(agents) != 1:
+                continue
+            variant_agents = [m.agents_by_type[agent_type][0] for m in self.models]
+            if BatchKernel.can_batch(variant_agents):
+                self.kernels[agent_type] = BatchKernel(variant_agents, self.ledger)
+
+    @property
+    def is_terminated(self):
+        """Return a (K,) bool array of which variants are terminated"""
+        return np.array([m.is_terminated for m in self.models], dtype=bool)
+
+    def step(self):
+        """Execute a single step of every variant which isn't terminated"""
+        models = self.models
+        running = np.array([k for k, m in enumerate(models)
+                            if not m.is_terminated and m._start_step()], dtype=int)
+        if len(running) == 0:
+            return
+        if not models[0].priorities:
+            # Without priorities, agents are activated in one random order
+            for k in running:
+                models[k].scheduler.step()
+                self._end_step(k)
+            return
+        for k in running:
+            scheduler = models[k].scheduler
+            if not scheduler.initialized:
+                scheduler._load_agents_by_class()
+        for agent_class in models[0].priorities:
+            lists = {}
+            for k in running:
+                agents = models[k].scheduler.agents_by_class.get(agent_class)
+                if agents is not None:
+                    models[k].scheduler_rng.shuffle(agents)
+                    lists[k] = agents
+            if not lists:
+                continue
+            orders = [tuple(a.agent_type for a in agents) for agents in lists.values()]
+            if all(order == orders[0] for order in orders):
+                for position, agent_type in enumerate(orders[0]):
+                    kernel = self.kernels.get(agent_type)
+                    if kernel is not None:
+                        kernel.step(running[kernel.active[running]])
+                        continue
+                    for agents in lists.values():
+                        agent = agents[position]
+                        if agent.active:
+                            agent.step()
+            else:
+                for k, agents in lists.items():
+                    for agent in agents:
+                        kernel = self.kernels.get(agent.agent_type)
+                        if kernel is not None:
+                            if kernel.active[k]:
+                                kernel.step(np.array([k]))
+                        elif agent.active:
+                            agent.step()
+        for k in running:
+            scheduler = models[k].scheduler
+            scheduler.steps += 1
+            scheduler.time += 1
+            self._end_step(k)
+
+    def _end_step(self, k):
+        # Keep the agents of every variant current, so that its model can be
+        # saved, checkpointed or forked between steps
+        for kernel in self.kernels.values():
+            kernel.sync(k)
+        if self.models[k].data_collection:
+            self.models[k]._collect_step_data()
+
+    def step_to(self, n_steps=None, termination=None, max_steps=365*24*2):
+        """Execute a fixed number of steps, or until all variants terminate
+
+        Args:
+            * ``n_steps``: int
+            * ``termination``: bool
+            * ``max_steps``: int
+        """
+        if not n_steps and not termination:
+            return
+        for i in range(max_steps):
+            if i == n_steps or self.is_terminated.all():
+                return
+            self.step()
+
+    def sync(self):
+        """Write the state of batched agents back to the agents of every variant"""
+        for kernel in self.kernels.values():
+            for k in range(len(self.models)):
+                kernel.sync(k)
+
+    def get_data(self, step_range=None, fields=None, debug=False, clear_cache=False,
+                 arrays=False):
+        """Return a list with the data of each variant; see AgentModel.get_data"""
+        self.sync()
+        return [m.get_data(step_range=step_range, fields=fields, debug=debug,
+                           clear_cache=clear_cache, arrays=arrays) for m in self.models]
@@ -0,0 +1,237 @@
+r"""Benchmarks the Agent Model on the preset configurations.
+
+Runs ``AgentModel.from_config`` and ``step_to`` on every
+``data_files/config_*.json`` preset, without the server, database or
+workers, and reports for each:
+
+  ======================= ===============
+          Field            Description
+  ======================= ===============
+  ``steps``               Steps run; presets may terminate earlier than ``n_steps``
+  ``init_time``           Seconds in ``AgentModel.from_config``, best of ``repeat``
+  ``step_time``           Seconds in ``step_to``, best of ``repeat``
+  ``steps_per_sec``       ``steps / step_time``
+  ``peak_memory``         Peak bytes allocated by Python during init and steps,
+                          measured in a separate run with tracemalloc
+  ``data_size``           Bytes of ``get_data(debug=True)``, serialized as JSON
+  ======================= ===============
+
+Presets without a seed are run with seed 0, so every run does the same work.
+Presets which fail to initialize or step are reported with an ``error``.
+Results can be compared with a baseline written by an earlier run::
+
+    python -m agent_model.benchmark --output baseline.json
+    python -m agent_model.benchmark --baseline baseline.json
+
+The exit status is 1 if any preset regressed by more than ``--tolerance``.
+"""
+
+import argparse
+import copy
+import gc
+import glob
+import json
+import os
+import platform
+import sys
+import tracemalloc
+from time import perf_counter
+
+import numpy as np
+
+from agent_model.agent_model import AgentModel
+
+DATA_FILES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                          'data_files')
+
+# Field: 1 if higher is better, -1 if lower is better
+_COMPARED_FIELDS = {'init_time': -1, 'steps_per_sec': 1, 'peak_memory': -1, 'data_size': -1}
+
+def find_presets(data_files=DATA_FILES):
+    """Return ``{<preset name>: <path>}`` of the preset configurations"""
+    paths = sorted(glob.glob(os.path.join(data_files, 'config_*.json')))
+    return {os.path.basename(p)[len('config_'):-len('.json')]: p for p in paths}
+
+def _run(config, n_steps, data_collection):
+    start = perf_counter()
+    model = AgentModel.from_config(copy.deepcopy(config), data_collection=data_collection)
+    init_time = perf_counter() - start
+    start = perf_counter()
+    model.step_to(n_steps=n_steps, termination=True)
+    return model, init_time, perf_counter() - start
+
+def benchmark_config(config, n_steps=500, repeat=3, data_collection=True, profile=False):
+    """Benchmark one configuration and return its results
+
+    Args:
+       * ``config``: :ref:`simoc-config`
+
+    Kwargs:
+        * ``n_steps``: int, steps per run; runs also stop at termination
+        * ``repeat``: int, timed runs, of which the fastest is reported
+        * ``data_collection``: bool, passed to ``AgentModel.from_config``
+        * ``profile``: bool, add the ``get_profile()`` of an extra run
+
+    Returns:
+        * ``dict``: the fields described above
+    """
+    config = copy.deepcopy(config)
+    config.setdefault('seed', 0)
+    init_times, step_times = [], []
+    for _ in range(repeat):
+        gc.collect()
+        model, init_time, step_time = _run(config, n_steps, data_collection)
+        init_times.append(init_time)
+        step_times.append(step_time)
+    steps = model.step_num
+    data_size = len(json.dumps(model.get_data(debug=True))) if data_collection else 0
+    del model
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        model, _, _ = _run(config, n_steps, data_collection)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del model
+
+    step_time = min(step_times)
+    result = dict(steps=steps, init_time=min(init_times), step_time=step_time,
+                  steps_per_sec=steps / step_time if step_time > 0 else None,
+                  peak_memory=peak_memory, data_size=data_size)
+    if profile:
+        model = AgentModel.from_config(copy.deepcopy(config), data_collection=data_collection)
+        model.enable_profiling()
+        model.step_to(n_steps=n_steps, termination=True)
+        result['profile'] = model.get_profile()
+    return result
+
+def run_benchmarks(presets=None, n_steps=500, repeat=3, data_collection=True,
+                   profile=False, data_files=DATA_FILES, log=None):
+    """Benchmark preset configurations and return the results
+
+    Kwargs:
+        * ``presets``: list of preset names, e.g. ``['1h', 'b2_mission1a']``;
+          all presets if not given
+        * ``n_steps``, ``repeat``, ``data_collection``, ``profile``: as in
+          ``benchmark_config``
+        * ``data_files``: str, directory of the presets
+        * ``log``: file-like object to print progress to
+
+    Returns:
+        * ``dict``: ``environment`` (python, numpy and platform versions),
+          ``settings`` and ``results``: ``{<preset name>: <result>}``, or
+          ``{<preset name>: {'error': str}}`` if it failed
+    """
+    available = find_presets(data_files)
+    if presets is None:
+        presets = list(available)
+    unknown = [p for p in presets if p not in available]
+    if unknown:
+        raise ValueError(f"Unknown presets: {', '.join(unknown)}")
+    results = {}
+    for name in presets:
+        with open(available[name]) as f:
+            config = json.load(f)
+        try:
+            results[name] = benchmark_config(config, n_steps, repeat, data_collection, profile)
+        except Exception as e:
+            results[name] = dict(error=f'{type(e).__name__}: {e}')
+        if log is not None:
+            r = results[name]
+            if 'error' in r:
+                print(f"{name:<16} {r['error']}", file=log)
+                continue
+            print(f"{name:<16} {r['steps']:>6} steps  init {r['init_time']:.3f}s  "
+                  f"{r['steps_per_sec']:>8.1f} steps/s  peak {r['peak_memory'] / 2**20:.1f} MiB  "
+                  f"data {r['data_size'] / 2**20:.1f} MiB", file=log)
+    environment = dict(python=platform.python_version(), numpy=np.__version__,
+                       platform=platform.platform(), processor=platform.processor())
+    settings = dict(n_steps=n_steps, repeat=repeat, data_collection=data_collection)
+    return dict(environment=environment, settings=settings, results=results)
+
+def compare_results(results, baseline, tolerance=0.1):
+    """Return regressions of results relative to a baseline
+
+    Only presets and fields present in both are compared. Presets which
+    fail only in results are reported as a regression of ``error``, and
+    runs with different step counts as a regression of ``steps``.
+
+    Args:
+       * ``results``, ``baseline``: dicts from ``run_benchmarks``
+       * ``tolerance``: float, relative change which is not a regression
+
+    Returns:
+        * ``list``: ``[{'preset': str, 'field': str, 'baseline': float,
+          'value': float, 'change': float}]``, where change is relative to
+          the baseline, positive if worse
+    """
+    regressions = []
+    for name, result in results['results'].items():
+        base = baseline['results'].get(name)
+        if base is None or 'error' in base:
+            continue
+        if 'error' in result:
+            regressions.append(dict(preset=name, field='error', baseline=None,
+                                    value=result['error'], change=None))
+            continue
+        if result['steps'] != base['steps']:
+            regressions.append(dict(preset=name, field='steps', baseline=base['steps'],
+                                    value=result['steps'], change=None))
+            continue
+        for field, direction in _COMPARED_FIELDS.items():
+            value, base_value = result.get(field), base.get(field)
+            if not value or not base_value:
+                continue
+            change = direction * (base_value - value) / base_value
+            if change > tolerance:
+                regressions.append(dict(preset=name, field=field, baseline=base_value,
+                                        value=value, change=change))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m agent_model.benchmark',
+        description='Benchmark the Agent Model on the preset configurations')
+    parser.add_argument('presets', nargs='*',
+                        help='preset names, e.g. 1h b2_mission1a (default: all)')
+    parser.add_argument('--n-steps', type=int, default=500,
+                        help='steps per run; presets also stop at termination (default: 500)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='timed runs per preset, of which the fastest is used (default: 3)')
+    parser.add_argument('--no-data-collection', action='store_true',
+                        help='run without data collection')
+    parser.add_argument('--profile', action='store_true',
+                        help='add a per-phase profile of each preset to the results')
+    parser.add_argument('--output', help='write results to this json file')
+    parser.add_argument('--baseline', help='compare results with this json file')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative change flagged as a regression (default: 0.1)')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.presets or None, args.n_steps, args.repeat,
+                             not args.no_data_collection, args.profile, log=sys.stdout)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if not args.baseline:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('settings') != results['settings']:
+        print(f"Warning: baseline settings {baseline.get('settings')} differ from "
+              f"{results['settings']}")
+    regressions = compare_results(results, baseline, args.tolerance)
+    for r in regressions:
+        if r['change'] is None:
+            print(f"REGRESSION {r['preset']}: {r['field']} {r['baseline']} -> {r['value']}")
+        else:
+            print(f"REGRESSION {r['preset']}: {r['field']} {r['baseline']:.4g} -> "
+                  f"{r['value']:.4g} ({r['change']:+.0%})")
+    if not regressions:
+        print(f"No regressions against {args.baseline}")
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,160 @@
+r"""Converts model data to flat tables, and saves and loads them.
+
+:ref:`model-data` is nested by agent type, field and currency. Columnar data
+has one table per field family, in which every series is a row of a 2-D
+``values`` array, ``(n_series, n_steps)``, labelled by one array per
+dimension:
+
+  ======================= =========================================== ===============
+          Family           Dimensions                                  Series
+  ======================= =========================================== ===============
+  ``agents``              agent_type, field                           age, amount, step_variable
+  ``storage``             agent_type, currency                        Balances
+  ``storage_ratios``      agent_type, currency                        Ratios
+  ``flows``               agent_type, direction, currency, connection Actual exchanges
+  ``growth``              agent_type, field                           Growth fields of plants and concrete
+  ``buffer``              agent_type, attr                            Criteria buffers
+  ``deprive``             agent_type, attr                            Deprive
+  ======================= =========================================== ===============
+
+``step`` holds the step number of each column. Agents added during a run
+have shorter series, which are right-aligned and padded with NaN. Events
+are not included.
+
+Columns are saved either to a compressed ``.npz`` file, or to a directory
+with one ``.npy`` file per array, which can be memory-mapped when loaded::
+
+    columns = model.get_columns()
+    save_columns('run.npz', columns)
+    save_columns('run', columns)
+    columns = load_columns('run', mmap_mode='r')
+    o2, _ = select(columns['flows'], agent_type='human_agent', currency='o2')
+"""
+
+import os
+
+import numpy as np
+
+FAMILIES = {
+    'agents': ['agent_type', 'field'],
+    'storage': ['agent_type', 'currency'],
+    'storage_ratios': ['agent_type', 'currency'],
+    'flows': ['agent_type', 'direction', 'currency', 'connection'],
+    'growth': ['agent_type', 'field'],
+    'buffer': ['agent_type', 'attr'],
+    'deprive': ['agent_type', 'attr'],
+}
+_AGENT_FIELDS = ['age', 'amount', 'step_variable']
+
+def _flatten(value, depth, labels, series):
+    """Add ``(labels, series)`` for the leaves of a nested dict of series"""
+    if depth == 0:
+        series.append((labels, value))
+        return
+    for key, child in value.items():
+        _flatten(child, depth - 1, labels + [key], series)
+
+def to_columns(data, steps=None):
+    """Return columnar tables of model data
+
+    Args:
+       * ``data``: :ref:`model-data`, with lists or arrays
+
+    Kwargs:
+        * ``steps``: array of the step numbers of the data; by default, the
+          last ``n_steps`` up to ``data['step_num']``
+
+    Returns:
+        * ``dict``: ``step``: (n_steps,) int array; ``<family>``:
+          ``{'values': (n_series, n_steps) float array, <dimension>: (n_series,)
+          str array}`` for each family in ``FAMILIES``
+    """
+    series = {family: [] for family in FAMILIES}
+    for agent_type, agent_data in data.items():
+        if not isinstance(agent_data, dict):
+            continue  # game_id, step_num
+        for field in _AGENT_FIELDS:
+            if field in agent_data:
+                series['agents'].append(([agent_type, field], agent_data[field]))
+        for family, dims in FAMILIES.items():
+            if family != 'agents' and family in agent_data:
+                _flatten(agent_data[family], len(dims) - 1, [agent_type], series[family])
+
+    n_steps = max((len(s) for rows in series.values() for _, s in rows), default=0)
+    if steps is None:
+        last = data.get('step_num') or n_steps
+        steps = np.arange(last - n_steps + 1, last + 1)
+    columns = dict(step=np.asarray(steps, dtype=np.int64))
+    for family, dims in FAMILIES.items():
+        rows = series[family]
+        values = np.full((len(rows), n_steps), np.nan)
+        for i, (_, s) in enumerate(rows):
+            if len(s) > 0:
+                values[i, n_steps - len(s):] = s
+        table = dict(values=values)
+        for d, dim in enumerate(dims):
+            table[dim] = np.array([labels[d] for labels, _ in rows], dtype=str)
+        columns[family] = table
+    return columns
+
+def save_columns(path, columns):
+    """Save columnar tables to a compressed .npz file or a directory of .npy files
+
+    Args:
+       * ``path``: str, ending in '.npz' for a compressed file; otherwise a
+         directory, which is created if needed
+       * ``columns``: dict from ``to_columns``
+    """
+    arrays = {'step': columns['step']}
+    for family in FAMILIES:
+        for name, array in columns[family].items():
+            arrays[f'{family}.{name}'] = array
+    if str(path).endswith('.npz'):
+        np.savez_compressed(path, **arrays)
+        return
+    os.makedirs(path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f'{name}.npy'), array, allow_pickle=False)
+
+def load_columns(path, mmap_mode=None):
+    """Load columnar tables saved by save_columns
+
+    Args:
+       * ``path``: str, .npz file or directory
+       * ``mmap_mode``: passed to ``np.load`` for the arrays of a directory,
+         e.g. 'r' to read them from disk as they're used. Arrays of .npz
+         files are decompressed into memory.
+
+    Returns:
+        * ``dict``: as returned by ``to_columns``
+    """
+    if str(path).endswith('.npz'):
+        with np.load(path, allow_pickle=False) as npz:
+            arrays = {name: npz[name] for name in npz.files}
+    else:
+        arrays = {}
+        for filename in os.listdir(path):
+            if filename.endswith('.npy'):
+                arrays[filename[:-len('.npy')]] = np.load(
+                    os.path.join(path, filename), mmap_mode=mmap_mode, allow_pickle=False)
+    columns = dict(step=arrays.pop('step'))
+    for name, array in arrays.items():
+        family, key = name.split('.', 1)
+        columns.setdefault(family, {})[key] = array
+    return columns
+
+def select(table, **labels):
+    """Return the rows of a table's values which match all labels
+
+    Args:
+       * ``table``: one family of ``to_columns``, e.g. ``columns['flows']``
+       * ``labels``: ``<dimension>=<label>``, e.g. ``currency='o2'``
+
+    Returns:
+        * ``(values, mask)``: ``(n_matches, n_steps)`` array, and the
+          boolean mask of the matching rows
+    """
+    mask = np.ones(len(table['values']), dtype=bool)
+    for dim, label in labels.items():
+        mask &= table[dim] == label
+    return table['values'][mask], mask
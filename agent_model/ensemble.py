@@ -0,0 +1,139 @@
+r"""Runs ensembles of an Agent Model with different seeds.
+
+With ``global_entropy > 0``, results depend on the seed. An ensemble parses
+the config and data files once, runs one model per seed in a process pool,
+and returns the data of each run along with statistics across runs.
+"""
+
+import copy
+import random
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from agent_model.agent_model import AgentModel
+from agent_model.initializer import AgentModelInitializer
+from agent_model.exceptions import AgentModelConfigError
+
+_worker_initializer = None
+
+def _init_worker(initializer):
+    """Store the parsed initializer once per worker process"""
+    global _worker_initializer
+    _worker_initializer = initializer
+
+def _run_member(seed, n_steps, engine, debug, initializer=None):
+    """Run one model of the ensemble and return its data and survival time"""
+    initializer = copy.deepcopy(initializer or _worker_initializer)
+    initializer.model_data['seed'] = seed
+    model = AgentModel(initializer, data_collection=True, engine=engine)
+    model.step_to(n_steps=n_steps, termination=True)
+    data = model.get_data(debug=debug)
+    # Survival: first step with no living inhabitants, or None if they survived
+    survival = None
+    inhabitants = model.get_agents_by_class('inhabitants')
+    if inhabitants:
+        amounts = np.sum([agent.data_collector.get_data(arrays=True)['amount']
+                          for agent in inhabitants], axis=0)
+        dead = np.flatnonzero(amounts == 0)
+        if len(dead) > 0:
+            survival = int(dead[0]) + 1
+    return data, survival
+
+def _is_series(value):
+    return (isinstance(value, list) and len(value) > 0 and
+            all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in value))
+
+def _series_stats(values, percentiles):
+    """Return mean and percentile bands of equal- or unequal-length series"""
+    n_steps = max(len(v) for v in values)
+    stacked = np.full((len(values), n_steps), np.nan)
+    for i, v in enumerate(values):
+        stacked[i, :len(v)] = v
+    if all(len(v) == n_steps for v in values):
+        # nanpercentile is much slower, so only use it for runs which ended early
+        mean = stacked.mean(axis=0)
+        bands = np.percentile(stacked, percentiles, axis=0)
+    else:
+        mean = np.nanmean(stacked, axis=0)
+        bands = np.nanpercentile(stacked, percentiles, axis=0)
+    stats = dict(mean=mean.tolist())
+    for p, band in zip(percentiles, bands):
+        stats[f'p{p}'] = band.tolist()
+    return stats
+
+def _aggregate(runs, percentiles):
+    """Recursively compute statistics for every numeric series in runs"""
+    first = runs[0]
+    if isinstance(first, dict):
+        stats = {}
+        for key, value in first.items():
+            if all(isinstance(run, dict) and key in run for run in runs):
+                child = _aggregate([run[key] for run in runs], percentiles)
+                if child:
+                    stats[key] = child
+        return stats
+    if all(_is_series(run) for run in runs):
+        return _series_stats(runs, percentiles)
+    return None
+
+def run_ensemble(config, seeds=None, n_runs=None, n_steps=None, max_workers=None,
+                 percentiles=(5, 50, 95), debug=False, engine='scalar',
+                 currency_desc=None, agent_desc=None, agent_conn=None,
+                 agent_variation=None, agent_events=None):
+    """Run a model once for each seed and return data and statistics
+
+    Args:
+       * ``config``: :ref:`simoc-config`
+
+    Kwargs:
+        * ``seeds``: list of int, one run per seed
+        * ``n_runs``: int, if seeds are not given; seeds count up from the
+          config seed, or are random if there isn't one
+        * ``n_steps``: int, steps per run; runs also stop at termination
+        * ``max_workers``: int, passed to ProcessPoolExecutor; with 1, runs
+          are executed in this process
+        * ``percentiles``: list of percentile bands to calculate
+        * ``debug``: bool, passed to ``AgentModel.get_data``
+        * ``engine``: str, 'scalar' or 'vectorized'
+        * ``currency_desc``, ``agent_desc``, ``agent_conn``,
+          ``agent_variation``, ``agent_events``: as in ``AgentModel.from_config``
+
+    Returns:
+        * ``dict``: ``seeds``: list of seeds; ``data``: ``{<seed>: model data}``;
+          ``stats``: model data structure with ``{'mean': [], 'p<n>': []}``
+          for every numeric series; ``survival``: ``steps`` (``{<seed>:
+          first step with no living inhabitants, or None}``), ``survived``
+          (fraction of runs) and ``mean`` (mean steps of runs which didn't
+          survive, or None)
+    """
+    if seeds is None:
+        if n_runs is None:
+            raise ValueError("Either seeds or n_runs must be specified.")
+        if 'seed' in config:
+            seeds = [(config['seed'] + i) % 2**32 for i in range(n_runs)]
+        else:
+            seeds = [random.getrandbits(32) for _ in range(n_runs)]
+    seeds = list(seeds)
+    initializer, errors = AgentModelInitializer.from_new(
+        copy.deepcopy(config), currency_desc, agent_desc, agent_conn,
+        agent_variation, agent_events)
+    if any(len(errors[c]) > 0 for c in ['model', 'agents', 'currencies']):
+        raise AgentModelConfigError(errors)
+
+    args = [seeds, [n_steps] * len(seeds), [engine] * len(seeds), [debug] * len(seeds)]
+    if max_workers == 1:
+        results = list(map(_run_member, *args, [initializer] * len(seeds)))
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                 initargs=(initializer,)) as executor:
+            results = list(executor.map(_run_member, *args))
+
+    data = {seed: run_data for seed, (run_data, _) in zip(seeds, results)}
+    steps = {seed: survival for seed, (_, survival) in zip(seeds, results)}
+    died = [s for s in steps.values() if s is not None]
+    survival = dict(steps=steps,
+                    survived=1 - len(died) / len(seeds),
+                    mean=float(np.mean(died)) if died else None)
+    stats = _aggregate([data[seed] for seed in seeds], percentiles)
+    return dict(seeds=seeds, data=data, stats=stats, survival=survival)
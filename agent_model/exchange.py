@@ -0,0 +1,440 @@
+r"""Describes the vectorized currency exchange engine.
+
+When an :ref:`agent-model` is created with ``engine='vectorized'``, every
+priority class whose agents can all be compiled is stepped by an
+``ExchangeKernel`` instead of calling ``GeneralAgent.step`` on each agent.
+
+The kernel compiles the flows of a class into arrays once, after
+``_init_currency_exchange``. Each step it:
+
+  1. Runs the per-agent prelude (storage ratios, thresholds, events, step
+     variation) in activation order, so the random stream is consumed in
+     the same order as the scalar engine.
+  2. Computes the demand of every flow of every agent, assuming that no
+     input is short and no storage is full.
+  3. Verifies that assumption with a cumulative sum of all exchanges on
+     each storage, in activation order. Storages reached by several views or
+     connections are verified by replaying their exchanges in order.
+  4. Commits all exchanges of the agents which come before the first
+     violation (all agents, in the common case) to the storages at once.
+  5. Steps the agent at the first violation with the scalar engine, and
+     repeats from step 3 for the agents after it.
+
+Tolerance: because step 5 uses the scalar code and steps 2-4 only commit
+exchanges which are known to be unaffected by ordering, results match the
+scalar engine to floating-point rounding: balances and flows agree to a
+relative tolerance of 1e-9.
+"""
+
+import operator
+
+import numpy as np
+
+from agent_model.agents.core import GeneralAgent
+
+_COMPARATORS = {'>': operator.gt, '<': operator.lt, '=': operator.eq}
+
+
+class _Flow():
+    """Static description of a single currency exchange of an agent"""
+
+    __slots__ = ('agent', 'agent_index', 'prefix', 'currency', 'attr', 'slot',
+                 'storages', 'conn_cells', 'cr_name', 'cr_opp', 'cr_value',
+                 'cr_buffer', 'requires', 'deprive_value', 'is_currency')
+
+    def __init__(self, agent, agent_index, prefix, currency, slot):
+        attr = f'{prefix}_{currency}'
+        ad = agent.attr_details[attr]
+        self.agent = agent
+        self.agent_index = agent_index
+        self.prefix = prefix
+        self.currency = currency
+        self.attr = attr
+        self.slot = slot
+        self.storages = agent.selected_storage[prefix][currency]
+        self.conn_cells = []
+        self.cr_name = ad['criteria_name']
+        self.cr_opp = _COMPARATORS[ad['criteria_limit']] if self.cr_name else None
+        self.cr_value = ad['criteria_value'] or 0.0
+        self.cr_buffer = ad['criteria_buffer'] or 0.0
+        self.requires = ad.get('requires') or []
+        self.deprive_value = ad.get('deprive_value') or 0
+        self.is_currency = agent.currency_dict[currency]['type'] == 'currency'
+
+
+class ExchangeKernel():
+    """Batched currency exchanges for all agents of one priority class
+
+    Attributes:
+      model: AgentModel
+      agents: list, compiled agents in a stable order
+      cells: list, (storage agent, currency) pairs connected to any flow
+      flows: list, compiled exchanges of all agents
+    """
+
+    @staticmethod
+    def can_compile(agent):
+        """Return True if the agent's step can be executed by the kernel
+
+        Subclasses of GeneralAgent override step() and may weight their
+        exchanges by values which change during the step, and custom
+        functions may modify storages at any point, so those agents are
+        stepped by the scalar engine.
+        """
+        return (type(agent) is GeneralAgent
+                and 'char_custom_function' not in agent.attrs
+                and not any(ad.get('weighted') for ad in agent.attr_details.values()))
+
+    @classmethod
+    def can_compile_class(cls, agents):
+        """Return True if all agents of a class can be executed by the kernel
+
+        The kernel runs the prelude of all agents before any exchange, so
+        agents can't exchange with the storage of another agent of the class,
+        whose storage ratios would be calculated before the exchange rather
+        than after it.
+        """
+        if not all(cls.can_compile(agent) for agent in agents):
+            return False
+        class_storages = {id(agent) for agent in agents if agent.has_storage}
+        return not any(id(storage) in class_storages and storage is not agent
+                       for agent in agents
+                       for prefix in ['in', 'out']
+                       for storages in agent.selected_storage[prefix].values()
+                       for storage in storages)
+
+    def __init__(self, model, agents):
+        self.model = model
+        self.agents = list(agents)
+        self._agent_index = {id(agent): i for i, agent in enumerate(self.agents)}
+        self.cells = []
+        self._cell_index = {}
+        self.flows = []
+        for agent_index, agent in enumerate(self.agents):
+            slot = 0
+            for prefix in ['in', 'out']:
+                for currency in agent.selected_storage[prefix]:
+                    if agent.attrs[f'{prefix}_{currency}'] == 0:
+                        continue
+                    flow = _Flow(agent, agent_index, prefix, currency, slot)
+                    for storage in flow.storages:
+                        flow.conn_cells.append(self._view_cells(storage, currency))
+                    self.flows.append(flow)
+                    slot += 1
+        n_flows = len(self.flows)
+        self._cell_ledger = np.array(
+            [storage.ledger_index[currency] for storage, currency in self.cells], dtype=int)
+        self._cell_capacity = np.array(
+            [storage.__dict__.get(f'char_capacity_{currency}', np.inf)
+             for storage, currency in self.cells], dtype=float)
+        self._flow_agent = np.array([f.agent_index for f in self.flows], dtype=int)
+        self._flow_slot = np.array([f.slot for f in self.flows], dtype=int)
+        self._flow_in = np.array([f.prefix == 'in' for f in self.flows], dtype=bool)
+        self._n_slots = int(self._flow_slot.max()) + 1 if n_flows else 0
+        self._slot_flows = [np.nonzero(self._flow_slot == s)[0] for s in range(self._n_slots)]
+        self._criteria_agents = sorted({f.agent_index for f in self.flows if f.cr_name})
+
+        # Step values of all flows, concatenated
+        lengths = [f.agent.step_values[f.attr].shape[0] for f in self.flows]
+        self._offsets = np.cumsum([0] + lengths[:-1]).astype(int)
+        self._lengths = np.array(lengths, dtype=int)
+        self._values = (np.concatenate([f.agent.step_values[f.attr] for f in self.flows])
+                        if n_flows else np.zeros(0))
+
+        self._compile_components()
+
+    def _cell(self, storage, currency):
+        key = (id(storage), currency)
+        if key not in self._cell_index:
+            self._cell_index[key] = len(self.cells)
+            self.cells.append((storage, currency))
+        return self._cell_index[key]
+
+    def _view_cells(self, storage, view):
+        """Return indices of the cells included in a storage view"""
+        if view not in storage.currency_dict:
+            raise KeyError(f"{view} is not a recognized view.")
+        currency_data = storage.currency_dict[view]
+        if currency_data['type'] == 'currency':
+            currencies = [view]
+        else:
+            currencies = [c for c in currency_data['currencies'] if c in storage.ledger_index]
+        return np.array([self._cell(storage, c) for c in currencies], dtype=int)
+
+    def _compile_components(self):
+        """Group flows which share storage cells into components
+
+        A component is 'simple' if all its flows use one connection and the
+        same view, so that its balance can be verified with a cumulative sum.
+        Other components are verified by replaying their exchanges in order.
+        """
+        parent = list(range(len(self.cells)))
+        def _find(c):
+            while parent[c] != c:
+                parent[c] = parent[parent[c]]
+                c = parent[c]
+            return c
+        for flow in self.flows:
+            cells = [c for cells in flow.conn_cells for c in cells]
+            for c in cells[1:]:
+                parent[_find(c)] = _find(cells[0])
+        roots = {}
+        flow_component = []
+        for flow in self.flows:
+            cells = [c for cells in flow.conn_cells for c in cells]
+            root = _find(cells[0]) if cells else -1
+            flow_component.append(roots.setdefault(root, len(roots)))
+        self._flow_component = np.array(flow_component, dtype=int)
+        n_components = len(roots)
+        members = [[] for _ in range(n_components)]
+        for i, component in enumerate(flow_component):
+            members[component].append(i)
+        self._component_cells = []
+        self._component_simple = np.zeros(n_components, dtype=bool)
+        for component, ids in enumerate(members):
+            views = {tuple(c for cells in self.flows[i].conn_cells for c in cells) for i in ids}
+            single_conn = all(len(self.flows[i].conn_cells) == 1 for i in ids)
+            view = next(iter(views))
+            self._component_simple[component] = (
+                single_conn and len(views) == 1 and len(view) > 0
+                and (len(view) == 1 or all(self._flow_in[i] for i in ids)))
+            self._component_cells.append(np.array(view, dtype=int))
+        self._flow_simple = self._component_simple[self._flow_component] if self.flows \
+            else np.zeros(0, dtype=bool)
+        single = [len(cells) == 1 for cells in self._component_cells]
+        self._component_cell = np.array(
+            [cells[0] if s else 0 for cells, s in zip(self._component_cells, single)], dtype=int)
+        self._component_single = np.array(single, dtype=bool)
+
+    def step(self, agents, value_eps=1e-12):
+        """Step all agents of the class, given in activation order"""
+        if any(id(agent) not in self._agent_index for agent in agents):
+            # Agents added after compilation are stepped by the scalar engine
+            for agent in agents:
+                agent.step(value_eps)
+            return
+
+        # 1. PRELUDE
+        live = []
+        for agent in agents:
+            if agent.active and agent._step_prelude():
+                live.append(agent)
+        if not self.flows or not live:
+            return
+        rank = np.full(len(self.agents), len(self.agents), dtype=int)
+        for r, agent in enumerate(live):
+            rank[self._agent_index[id(agent)]] = r
+            agent.missing_desired = False
+        buffers = {i: dict(self.agents[i].buffer) for i in self._criteria_agents}
+
+        # 2. DEMAND
+        reached, target = self._demand(rank < len(self.agents), value_eps)
+
+        # 3. VERIFY, 4. COMMIT, 5. SCALAR FALLBACK
+        cap = self._cell_capacity * np.array(
+            [getattr(s, 'amount', 1) for s, _ in self.cells], dtype=float)
+        flow_rank = rank[self._flow_agent]
+        start = 0
+        while start < len(live):
+            bal = self.model.ledger.values[self._cell_ledger]
+            pending = reached & (flow_rank >= start)
+            first_conflict = min(
+                self._verify_simple(pending, target, flow_rank, bal, cap),
+                self._verify_complex(pending, target, flow_rank, bal.copy(), cap,
+                                     value_eps, [])[0])
+            self._commit(pending & (flow_rank < first_conflict), target, flow_rank, bal, cap,
+                         value_eps)
+            if first_conflict >= len(live):
+                break
+            agent = live[first_conflict]
+            i = self._agent_index[id(agent)]
+            if i in buffers:
+                agent.buffer.clear()
+                agent.buffer.update(buffers[i])
+            agent._step_exchanges(value_eps)
+            start = first_conflict + 1
+
+    def _commit(self, committed, target, flow_rank, bal, cap, value_eps):
+        """Apply verified exchanges to the storages and agent records"""
+        records = self._commit_simple(committed, target, bal, value_eps)
+        self._verify_complex(committed, target, flow_rank, bal, cap, value_eps, records)
+        for i in np.nonzero(committed)[0].tolist():
+            flow = self.flows[i]
+            if flow.deprive_value > 0:
+                agent = flow.agent
+                agent.deprive[flow.attr] = min(flow.deprive_value * agent.amount,
+                                               agent.deprive[flow.attr] + flow.deprive_value)
+        for i, storage_type, c, value in records:
+            buf = self.flows[i].agent.step_exchange_buffer[self.flows[i].prefix]
+            currency = self.cells[c][1]
+            if currency not in buf:
+                buf[currency] = {}
+            buf[currency][storage_type] = abs(value)
+        for c in {c for _, _, c, _ in records}:
+            self.cells[c][0]._mark_ratios_dirty()
+        self.model.ledger.values[self._cell_ledger] = bal
+
+    def _demand(self, live, value_eps):
+        """Return (reached, target) for all flows
+
+        Flows are not reached if the agent is not live or a required input
+        was not received. Criteria are evaluated (and buffers updated) only
+        for reached flows, in the same order as the scalar engine.
+        """
+        n_flows = len(self.flows)
+        reached = np.zeros(n_flows, dtype=bool)
+        step_mag = np.zeros(n_flows)
+        age = np.array([int(a.age) for a in self.agents], dtype=int)
+        step_variable = np.array([a.step_variable for a in self.agents], dtype=float)
+        event_multiplier = np.array(
+            [np.prod(list(a.event_multipliers.values())) for a in self.agents], dtype=float)
+        amount = np.array([a.amount for a in self.agents], dtype=float)
+        received = [set() for _ in self.agents]
+        for ids in self._slot_flows:
+            agent_ids = self._flow_agent[ids]
+            slot_reached = live[agent_ids]
+            base = self._values[self._offsets[ids] + age[agent_ids] % self._lengths[ids]]
+            for n, i in enumerate(ids):
+                if not slot_reached[n]:
+                    continue
+                flow = self.flows[i]
+                if flow.requires and any(c not in received[flow.agent_index]
+                                         for c in flow.requires):
+                    slot_reached[n] = False
+                    continue
+                if flow.cr_name:
+                    agent = flow.agent
+                    if flow.cr_name in agent:
+                        source = agent[flow.cr_name]
+                    else:
+                        source = agent._get_storage_ratio(flow.cr_name)
+                    if flow.cr_opp(source, flow.cr_value):
+                        if flow.cr_buffer > 0 and agent.buffer.get(flow.attr, 0) > 0:
+                            agent.buffer[flow.attr] -= 1
+                            base[n] = 0.0
+                    else:
+                        if flow.cr_buffer > 0:
+                            agent.buffer[flow.attr] = flow.cr_buffer
+                        base[n] = 0.0
+            reached[ids] = slot_reached
+            # Inputs are assumed to be fully satisfied, so `requires` scales by 1
+            step_mag[ids] = base * step_variable[agent_ids] * event_multiplier[agent_ids]
+            for n, i in enumerate(ids):
+                if slot_reached[n] and self._flow_in[i] and \
+                        step_mag[i] * amount[agent_ids[n]] >= value_eps:
+                    received[agent_ids[n]].add(self.flows[i].currency)
+        target = step_mag * amount[self._flow_agent]
+        return reached, target
+
+    def _simple_events(self, mask, flow_rank):
+        """Return flow ids of simple components sorted by component, rank and slot"""
+        ids = np.nonzero(mask & self._flow_simple)[0]
+        order = np.lexsort((self._flow_slot[ids], flow_rank[ids], self._flow_component[ids]))
+        return ids[order]
+
+    def _verify_simple(self, reached, target, flow_rank, bal, cap):
+        """Return the rank of the first agent whose exchange would be short or clipped"""
+        ids = self._simple_events(reached & (target > 0), flow_rank)
+        if len(ids) == 0:
+            return len(self.agents)
+        is_in = self._flow_in[ids]
+        delta = np.where(is_in, -target[ids], target[ids])
+        components = self._flow_component[ids]
+        # Balance of each component before each exchange
+        before = np.cumsum(delta) - delta
+        starts = np.flatnonzero(np.concatenate(([True], components[1:] != components[:-1])))
+        lengths = np.diff(np.append(starts, len(ids)))
+        before -= np.repeat(before[starts], lengths)
+        initial = np.array([sum(bal[cells].tolist()) for cells in self._component_cells])
+        before += initial[components]
+        capacity = cap[self._component_cell[components]]
+        conflict = np.where(is_in, before < target[ids], before + target[ids] > capacity)
+        conflict &= is_in | self._component_single[components]
+        if not conflict.any():
+            return len(self.agents)
+        return int(flow_rank[ids][conflict].min())
+
+    def _commit_simple(self, committed, target, bal, value_eps):
+        """Apply exchanges of simple components and return their records"""
+        records = []
+        ids = np.nonzero(committed & self._flow_simple & (target >= value_eps))[0]
+        if len(ids) == 0:
+            return records
+        delta = np.where(self._flow_in[ids], -target[ids], target[ids])
+        totals = np.bincount(self._flow_component[ids], weights=delta,
+                             minlength=len(self._component_cells))
+        shares = {}
+        for component in np.unique(self._flow_component[ids]):
+            cells = self._component_cells[component]
+            if len(cells) == 1:
+                shares[component] = [1.0]
+                bal[cells[0]] += totals[component]
+            else:
+                share = bal[cells] / sum(bal[cells].tolist())
+                shares[component] = share.tolist()
+                bal[cells] = np.maximum(bal[cells] + totals[component] * share, 0)
+        for i, value in zip(ids.tolist(), target[ids].tolist()):
+            component = self._flow_component[i]
+            storage_type = self.flows[i].storages[0].agent_type
+            for c, share in zip(self._component_cells[component], shares[component]):
+                records.append((i, storage_type, c, value * share))
+        return records
+
+    def _verify_complex(self, mask, target, flow_rank, bal, cap, value_eps, records):
+        """Replay exchanges of complex components in activation order
+
+        Returns (first_conflict, records). `bal` and `records` are updated
+        in place.
+        """
+        ids = np.nonzero(mask & (target > 0) & ~self._flow_simple)[0]
+        order = np.lexsort((self._flow_slot[ids], flow_rank[ids]))
+        for i in ids[order].tolist():
+            flow = self.flows[i]
+            value = target[i]
+            conns = [(storage, cells, sum(bal[cells].tolist()))
+                     for storage, cells in zip(flow.storages, flow.conn_cells)]
+            if flow.prefix == 'in' and sum(c[2] for c in conns) < value:
+                return int(flow_rank[i]), records
+            if value < value_eps:
+                continue
+            remaining = value
+            for storage, cells, storage_value in conns:
+                if flow.prefix == 'in':
+                    conn_delta = min(remaining, storage_value)
+                    flows = self._decrement(bal, cells, conn_delta)
+                else:
+                    conn_delta = remaining / len(conns)
+                    if not flow.is_currency:
+                        raise ValueError(f"Positive increment can only be used with currencies.")
+                    if conn_delta > 0 and bal[cells[0]] + conn_delta > cap[cells[0]]:
+                        return int(flow_rank[i]), records
+                    flows = self._increment(bal, cells, conn_delta)
+                remaining -= conn_delta
+                records.extend((i, storage.agent_type, c, v) for c, v in flows)
+        return len(self.agents), records
+
+    @staticmethod
+    def _decrement(bal, cells, amount):
+        """Equivalent to StorageAgent.increment with a negative amount"""
+        if amount <= 0:
+            return []
+        total = sum(bal[cells].tolist())
+        if total <= 0:
+            return [(c, 0) for c in cells]
+        flows = []
+        for c in cells:
+            current = float(bal[c])
+            target = max(current - amount * (current / total), 0)
+            bal[c] = target
+            flows.append((c, current - target))
+        return flows
+
+    @staticmethod
+    def _increment(bal, cells, amount):
+        """Equivalent to StorageAgent.increment with a positive amount"""
+        if amount <= 0:
+            return []
+        c = cells[0]
+        current = float(bal[c])
+        bal[c] = current + amount
+        return [(c, -amount)]
@@ -0,0 +1,124 @@
+r"""Caches the lifetime step values of growing flows across models.
+
+``GeneralAgent._calculate_step_values`` builds an array of up to
+lifetime x 24 values for every flow with lifetime or daily growth. The same
+species, parameters and time step recur across games, so the arrays are
+cached under a hash of everything they depend on:
+
+  * The flow's value and ``attr_details``
+  * The agent's lifetime
+  * The model's ``hours_per_step`` and ``day_length_hours``
+
+There are two tiers. The first is an LRU of arrays in the process. The
+second, if a directory is set, is one ``<key>.npy`` file per curve, which is
+memory-mapped when loaded, so all processes on a host (e.g. Celery workers)
+share one copy in the page cache. The directory is read from the
+``SIMOC_GROWTH_CACHE_DIR`` environment variable, or set with ``configure``.
+
+Curves with growth noise or initial variation are different for every
+agent, and are never cached. Cached arrays are read-only, and shared by
+every agent which uses them.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from agent_model.util import LRUCache
+
+# Bump when the growth functions change, to invalidate curves on disk
+_CACHE_VERSION = 1
+
+class GrowthCurveCache(LRUCache):
+    """An in-process LRU of step value arrays, backed by a directory of .npy files
+
+    Attributes:
+      maxsize: int, arrays kept in the process
+      directory: str, directory of .npy files, or None for no disk tier
+      hits: int, arrays returned from the process
+      disk_hits: int, arrays loaded from the directory
+      misses: int, arrays computed
+    """
+
+    def __init__(self, maxsize=1024, directory=None):
+        super().__init__(maxsize)
+        self.directory = directory
+        self.disk_hits = 0
+
+    @staticmethod
+    def make_key(agent_value, attr_details, lifetime, hours_per_step, day_length_hours):
+        """Return the hex digest of the inputs of a flow's step values"""
+        content = json.dumps([_CACHE_VERSION, agent_value, attr_details, lifetime,
+                              hours_per_step, day_length_hours],
+                             sort_keys=True, default=str)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def get(self, key, func):
+        """Return the cached array of key, or compute it with func() and cache it"""
+        array = self.lookup(key)
+        if array is not None:
+            return array
+        array = self._load(key)
+        if array is not None:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            array = np.asarray(func(), dtype=float)
+            self._save(key, array)
+        return self.add(key, array)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.npy')
+
+    def _load(self, key):
+        if self.directory is None:
+            return None
+        try:
+            # asarray returns a plain ndarray view of the memmap, which
+            # pickles like any other array
+            return np.asarray(np.load(self._path(key), mmap_mode='r', allow_pickle=False))
+        except (OSError, ValueError):
+            return None  # Missing, or partially written by an older version
+
+    def _save(self, key, array):
+        if self.directory is None:
+            return
+        tmp_path = None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Write to a temporary file and rename it, so other processes
+            # never load a partial file
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, array, allow_pickle=False)
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            # The disk tier is best-effort; the array is still cached in the process
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def clear(self):
+        """Clear the arrays in the process and the counters; files are kept"""
+        super().clear()
+        self.disk_hits = 0
+
+    def get_stats(self):
+        """Return the counters and size as a dict"""
+        return dict(super().get_stats(), disk_hits=self.disk_hits, directory=self.directory)
+
+growth_cache = GrowthCurveCache(directory=os.environ.get('SIMOC_GROWTH_CACHE_DIR'))
+
+def configure(directory=None, maxsize=None):
+    """Set the directory and size of the shared cache, and clear it
+
+    Args:
+      directory: str, directory of .npy files, or None to disable the disk tier
+      maxsize: int, arrays kept in the process; unchanged if None
+    """
+    growth_cache.directory = directory
+    if maxsize is not None:
+        growth_cache.maxsize = maxsize
+    growth_cache.clear()
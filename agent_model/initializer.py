@@ -1,9 +1,12 @@
+import copy
+import hashlib
 import numpy as np
 import json
 import random
 import pathlib
 from datetime import datetime
 
+from agent_model.agents.core import CohortAgent
 from agent_model.exceptions import AgentModelInitializationError
 from agent_model.parse_data_files import parse_currency_desc, parse_agent_desc, \
                                          parse_agent_events, parse_agent_conn, merge_json
@@ -11,6 +14,7 @@ from agent_model.parse_data_files import parse_currency_desc, parse_agent_desc,
 _DEFAULT_LOCATION = 'mars'
 _DEFAULT_START_TIME = '1991-01-01 00:00:00'
 _DATA_FILES_DIR = pathlib.Path(__file__).parent.parent / 'data_files'
+_CHECKPOINT_VERSION = 1
 def load_data_file(fname):
     try:
         with open(_DATA_FILES_DIR / fname) as f:
@@ -19,6 +23,39 @@ def load_data_file(fname):
     except FileNotFoundError:
         raise AgentModelInitializationError(f"File `{fname}` not found in {_DATA_FILES_DIR}.")
 
+class InitializerCache():
+    """Parsed data files, reused by calls to AgentModelInitializer.from_new
+
+    Parsing agent_desc (which optimizes the growth curves of plants) takes
+    most of the time to initialize a model. A cache stores the output of each
+    stage under a key of the inputs it depends on, so configs which only
+    differ in e.g. amounts don't parse anything again. Cached values are
+    copied before they're returned, and must not be modified.
+
+    A cache must only be used with one set of user data files (currency_desc,
+    agent_desc, etc.), which aren't part of the keys.
+
+    Attributes:
+      stages: dict, {<stage>: {<key>: <value>}}
+      hits: dict, {<stage>: int}
+      misses: dict, {<stage>: int}
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.hits = {}
+        self.misses = {}
+
+    def get(self, stage, key, func):
+        """Return the cached value of key, or compute it with func()"""
+        values = self.stages.setdefault(stage, {})
+        if key in values:
+            self.hits[stage] = self.hits.get(stage, 0) + 1
+        else:
+            self.misses[stage] = self.misses.get(stage, 0) + 1
+            values[key] = func()
+        return values[key]
+
 class AgentModelInitializer():
     """Contains all data required to initialize an AgentModel
 
@@ -35,6 +72,8 @@ class AgentModelInitializer():
                   AgentModelInitialzier
       serialize: Converts this to a json-serializable dict
       deserialize: Converts from dict back into AgentModelInitializer
+      to_checkpoint: Writes this to a binary checkpoint file
+      from_checkpoint: Reads an AgentModelInitializer from a checkpoint file
 
     Raises:
       AgentModelInitializationError
@@ -51,6 +90,8 @@ class AgentModelInitializer():
             seed=random.getrandbits(32),
             global_entropy=0,
             single_agent=1,
+            cohorts=False,
+            rng_streams=False,
             termination=[],
             priorities=[],
             location=_DEFAULT_LOCATION,
@@ -60,7 +101,10 @@ class AgentModelInitializer():
 
     @classmethod
     def from_new(cls, config, user_currency_desc=None, user_agent_desc=None,
-                 user_agent_conn=None, user_agent_variation=None, user_agent_events=None):
+                 user_agent_conn=None, user_agent_variation=None, user_agent_events=None,
+                 cache=None):
+        if cache is None:
+            cache = InitializerCache()
 
         # 1. INITIALIZE ERROR DICT
         # Errors from all subsequent steps are compiled into a dict and returned to
@@ -100,27 +144,44 @@ class AgentModelInitializer():
         # will replace or be added to default values.
 
         # 3. CURRENCY DESC
-        currency_desc = load_data_file('currency_desc.json')
-        if user_currency_desc:
-            currency_desc = merge_json(currency_desc, user_currency_desc)
-        currency_desc, currency_errors = parse_currency_desc(currency_desc)
+        def _load_currency_desc():
+            currency_desc = load_data_file('currency_desc.json')
+            if user_currency_desc:
+                currency_desc = merge_json(currency_desc, user_currency_desc)
+            return parse_currency_desc(currency_desc)
+        currency_desc, currency_errors = cache.get('currency_desc', None, _load_currency_desc)
         model_data['currency_dict'] = currency_desc
-        errors['currencies'] = currency_errors
+        errors['currencies'] = copy.deepcopy(currency_errors)
 
         # 4. AGENT DESC
-        agent_desc = load_data_file('agent_desc.json')
-        if user_agent_desc:
-            agent_desc = merge_json(agent_desc, user_agent_desc)
-        # Only return agent_desc data for agents included in the config file
-        agent_desc, agents_errors = parse_agent_desc(config, model_data['currency_dict'],
-                                                     agent_desc, _DEFAULT_LOCATION)
+        def _load_agent_desc():
+            agent_desc = load_data_file('agent_desc.json')
+            if user_agent_desc:
+                agent_desc = merge_json(agent_desc, user_agent_desc)
+            return agent_desc
+        raw_agent_desc = cache.get('agent_desc', None, _load_agent_desc)
+        # Only return agent_desc data for agents included in the config file.
+        # Agents are parsed one at a time, so they're cached individually.
+        location = config.get('location', _DEFAULT_LOCATION)
+        agent_desc, agents_errors = {}, {}
+        for agent in config['agents']:
+            parsed, parse_errors = cache.get(
+                'parse_agent_desc', (agent, location),
+                lambda: parse_agent_desc(dict(agents={agent: {}}, location=location),
+                                         model_data['currency_dict'], raw_agent_desc,
+                                         _DEFAULT_LOCATION))
+            parsed, parse_errors = copy.deepcopy((parsed, parse_errors))
+            agent_desc.update(parsed)
+            agents_errors.update(parse_errors)
         errors['agents'] = agents_errors
 
         # 5. AGENT EVENTS
-        agent_events = load_data_file('agent_events.json')
-        if user_agent_events:
-            agent_events = merge_json(agent_events, user_agent_events)
-        agents_events, agents_errors = parse_agent_events(agent_events)
+        def _load_agent_events():
+            agent_events = load_data_file('agent_events.json')
+            if user_agent_events:
+                agent_events = merge_json(agent_events, user_agent_events)
+            return parse_agent_events(agent_events)
+        agents_events, agents_errors = cache.get('agent_events', None, _load_agent_events)
         for agent, errors in agents_errors.items():
             for item, message in errors.items():
                 _agent_error(agent, item, message)
@@ -132,12 +193,15 @@ class AgentModelInitializer():
             else:
                 continue
             for section in ['attributes', 'attribute_details']:
-                agent_data[section] = {**agent_data[section], **events[section]}
+                agent_data[section] = {**agent_data[section], **copy.deepcopy(events[section])}
 
         # 6. AGENT VARIATION
-        agent_variation = load_data_file('agent_variation.json')
-        if user_agent_variation:
-            agent_variation = merge_json(agent_variation, user_agent_variation)
+        def _load_agent_variation():
+            agent_variation = load_data_file('agent_variation.json')
+            if user_agent_variation:
+                agent_variation = merge_json(agent_variation, user_agent_variation)
+            return agent_variation
+        agent_variation = cache.get('agent_variation', None, _load_agent_variation)
         for agent, agent_data in agent_desc.items():
             if agent in agent_variation:
                 variation = agent_variation[agent]['variation']
@@ -149,24 +213,30 @@ class AgentModelInitializer():
             for key, value in variation.items():
                 if key not in ['initial', 'step']:
                     _agent_error(agent, 'variation', f"Unrecognized variation type: {key}")
-                valid_variation[key] = value
+                valid_variation[key] = copy.deepcopy(value)
             if len(valid_variation) == 0:
                 _agent_error(agent, 'variation', f"No valid variation types found")
             else:
                 agent_data['variation'] = valid_variation
 
         # 7. AGENT CONNECTIONS
-        agent_conn = load_data_file('agent_conn.json')
-        if user_agent_conn:
-            # TODO: This approach may fail if trying to *replace* a connection
-            # with user_agent_conn.
-            agent_conn = user_agent_conn + agent_conn
+        def _load_agent_conn():
+            agent_conn = load_data_file('agent_conn.json')
+            if user_agent_conn:
+                # TODO: This approach may fail if trying to *replace* a connection
+                # with user_agent_conn.
+                agent_conn = user_agent_conn + agent_conn
+            return agent_conn
+        agent_conn = cache.get('agent_conn', None, _load_agent_conn)
         active_agents = list(config['agents'].keys())
-        connections, agent_conn_errors = parse_agent_conn(active_agents, agent_conn)
+        connections, agent_conn_errors = cache.get(
+            'parse_agent_conn', tuple(active_agents),
+            lambda: parse_agent_conn(active_agents, agent_conn))
         for agent, error in agent_conn_errors.items():
             _agent_error(agent, 'connection', error)
         for a in active_agents:
-            config['agents'][a]['connections'] = {} if a not in connections else connections[a]
+            config['agents'][a]['connections'] = ({} if a not in connections
+                                                  else copy.deepcopy(connections[a]))
 
         # Build and validate agent instance
         agent_data = {}
@@ -198,6 +268,8 @@ class AgentModelInitializer():
             seed=model.seed,
             global_entropy=model.global_entropy,
             single_agent=model.single_agent,
+            cohorts=model.cohorts,
+            rng_streams=model.rng_streams,
             termination=model.termination,
             priorities=model.priorities,
             location=model.location,
@@ -207,12 +279,16 @@ class AgentModelInitializer():
             random_state=model.random_state.get_state(),
             time=model.time.seconds,  # int of seconds
             steps=model.scheduler.steps,
-            storage_ratios=model.storage_ratios,
+            storage_ratios=model.storage_ratios.flush(),
             step_records_buffer=model.step_records_buffer,
             is_terminated=model.is_terminated,
             termination_reason=model.termination_reason,
         )
 
+        if model.rng_streams:
+            model_data['scheduler_rng'] = model.scheduler_rng.bit_generator.state
+            model_data['agent_streams'] = dict(model.agent_streams)
+
         agent_data = {}
         for agent in model.scheduler.agents:
             agent_data[agent['agent_type']] = cls._from_agent(agent)
@@ -256,14 +332,20 @@ class AgentModelInitializer():
                 grown=agent.grown,
             )
             instance = {**instance, **plant_fields}
+        # CohortAgent
+        if isinstance(agent, CohortAgent):
+            instance['cohort'] = agent._get_cohort_state()
+        # Random streams
+        if agent.random_state is not agent.model.random_state:
+            instance['random_states'] = dict(
+                variation=agent.random_state.bit_generator.state,
+                events=agent.event_random_state.bit_generator.state)
         # Step values
         for currency, step_values in agent.step_values.items():
             instance['step_values'][currency] = step_values
         # Storage balances
-        for item in agent.__dict__.keys():
-            if item in agent.currency_dict:
-                if agent.currency_dict[item]['type'] == 'currency':
-                    instance[item] = agent[item]
+        for currency in agent.ledger_index:
+            instance[currency] = agent[currency]
 
         return dict(agent_desc=agent_desc, instance=instance)
 
@@ -302,3 +384,103 @@ class AgentModelInitializer():
 
         return init
 
+
+    def to_checkpoint(self, file, descs=None):
+        """Write this to a binary checkpoint (npz) file
+
+        NumPy arrays (the random state, step values, etc.) are stored in one
+        flat array per dtype in the npz, and loaded as views of it.
+        Everything else is stored as a json header, in which agent
+        descriptions are replaced by their content hash.
+
+        Args:
+          file: str, path or file-like object, passed to np.savez
+          descs: dict, if given, agent descriptions are added to it by hash
+                 instead of stored in the file, so they can be shared by
+                 many checkpoints. The same dict is passed to from_checkpoint.
+        """
+        arrays = {}  # {<dtype>: ([<array>], <size>)}
+        def _pack(value):
+            if isinstance(value, np.ndarray):
+                dtype = value.dtype.str
+                pool, size = arrays.get(dtype, ([], 0))
+                pool.append(value.ravel())
+                arrays[dtype] = (pool, size + value.size)
+                return {'__array__': [dtype, size, list(value.shape)]}
+            elif isinstance(value, np.generic):
+                return value.item()
+            elif isinstance(value, datetime):
+                return {'__datetime__': value.isoformat()}
+            elif isinstance(value, tuple):
+                return {'__tuple__': [_pack(v) for v in value]}
+            elif isinstance(value, list):
+                return [_pack(v) for v in value]
+            elif isinstance(value, dict):
+                if all(isinstance(k, str) for k in value):
+                    return {k: _pack(v) for k, v in value.items()}
+                return {'__items__': [[_pack(k), _pack(v)] for k, v in value.items()]}
+            return value
+
+        header_descs = {} if descs is None else descs
+        agent_data = {}
+        for agent_type, data in self.agent_data.items():
+            agent_desc = _pack(data['agent_desc'])
+            desc_hash = hashlib.sha1(
+                json.dumps(agent_desc, sort_keys=True).encode()).hexdigest()
+            header_descs[desc_hash] = agent_desc
+            agent_data[agent_type] = dict(agent_desc=desc_hash,
+                                          instance=_pack(data['instance']))
+        header = dict(version=_CHECKPOINT_VERSION,
+                      init_type=self.init_type,
+                      model_data=_pack(self.model_data),
+                      agent_data=agent_data)
+        if descs is None:
+            header['descs'] = header_descs
+        header = np.frombuffer(json.dumps(header).encode(), dtype=np.uint8)
+        pools = {f'pool_{i}': np.concatenate(pool)
+                 for i, (pool, _) in enumerate(arrays.values())}
+        np.savez(file, header=header, **pools)
+
+    @classmethod
+    def from_checkpoint(cls, file, descs=None):
+        """Read a checkpoint written by to_checkpoint
+
+        Args:
+          file: str, path or file-like object, passed to np.load
+          descs: dict, agent descriptions by hash, if they weren't stored in
+                 the file
+        """
+        with np.load(file, allow_pickle=False) as npz:
+            header = json.loads(npz['header'].tobytes())
+            pools = {npz[key].dtype.str: npz[key] for key in npz.files if key != 'header'}
+        if header.get('version') != _CHECKPOINT_VERSION:
+            raise AgentModelInitializationError(
+                f"Unsupported checkpoint version: {header.get('version')}")
+        def _unpack(value):
+            if isinstance(value, list):
+                return [_unpack(v) for v in value]
+            elif isinstance(value, dict):
+                if len(value) == 1:
+                    key, item = next(iter(value.items()))
+                    if key == '__array__':
+                        dtype, offset, shape = item
+                        size = int(np.prod(shape))
+                        return pools[dtype][offset:offset + size].reshape(shape)
+                    elif key == '__datetime__':
+                        return datetime.fromisoformat(item)
+                    elif key == '__tuple__':
+                        return tuple(_unpack(v) for v in item)
+                    elif key == '__items__':
+                        return {_unpack(k): _unpack(v) for k, v in item}
+                return {k: _unpack(v) for k, v in value.items()}
+            return value
+
+        descs = header.get('descs', descs)
+        agent_data = {}
+        for agent_type, data in header['agent_data'].items():
+            if descs is None or data['agent_desc'] not in descs:
+                raise AgentModelInitializationError(
+                    f"Agent description for {agent_type} not found in checkpoint.")
+            agent_data[agent_type] = dict(agent_desc=_unpack(descs[data['agent_desc']]),
+                                          instance=_unpack(data['instance']))
+        return cls(_unpack(header['model_data']), agent_data, header['init_type'])
@@ -0,0 +1,90 @@
+r"""Describes the model-wide storage ledger.
+
+Every storage balance in an :ref:`agent-model` is a cell in one contiguous
+float64 array. Storage agents keep the index of each of their currencies, so
+``agent['co2']`` reads and writes the ledger, and views of currency classes
+are index arrays into it.
+"""
+
+import numpy as np
+
+from agent_model.exceptions import AgentModelError
+
+
+class StorageLedger():
+    """Contiguous array of storage balances for all agents of a model
+
+    ====================== ============== ===============
+          Attribute        Type               Description
+    ====================== ============== ===============
+    ``values``             np.ndarray     float64 balances; only the first ``size`` are in use
+    ``size``               int            Number of registered balances
+    ``frozen``             bool           Whether ``values`` is a row of a :ref:`batched-models` ledger
+    ====================== ============== ===============
+    """
+
+    def __init__(self, capacity=64):
+        self.values = np.zeros(capacity, dtype=np.float64)
+        self.size = 0
+        self.frozen = False
+
+    def register(self, value=0):
+        """Add a balance to the ledger and return its index
+
+        The array is reallocated when full, so callers must keep indices
+        rather than views of ``values``.
+
+        Raises:
+          AgentModelError: if the ledger is frozen, as a reallocated array
+            would no longer be the row of the batch ledger
+        """
+        if self.frozen:
+            raise AgentModelError("Cannot add storage balances to a batched model")
+        if self.size == len(self.values):
+            values = np.zeros(max(2 * len(self.values), 1), dtype=np.float64)
+            values[:self.size] = self.values[:self.size]
+            self.values = values
+        index = self.size
+        self.values[index] = value
+        self.size += 1
+        return index
+
+
+class StorageRatios(dict):
+    """Storage ratios by agent_type, recomputed lazily
+
+    Behaves like the ``{<agent_type>: {<currency>_ratio: float}}`` dict it
+    replaces. When a storage steps after its balances have changed, it is
+    registered in ``pending`` instead of recomputing its ratios right away.
+    Pending ratios are computed when they're read, or by the storage just
+    before its balances change again, so reads see the same values as if
+    they were computed when the storage stepped.
+
+    ====================== ============== ===============
+          Attribute        Type               Description
+    ====================== ============== ===============
+    ``pending``            dict           ``{<agent_type>: <agent>}`` storages with ratios to compute
+    ``writers``            dict           ``{<agent_type>: <agent>}`` agent which last computed the ratios
+    ====================== ============== ===============
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pending = {}
+        self.writers = {}
+
+    def __getitem__(self, storage_id):
+        if storage_id in self.pending:
+            self.pending.pop(storage_id)._calculate_storage_ratios()
+        return super().__getitem__(storage_id)
+
+    def get(self, storage_id, default=None):
+        if storage_id in self.pending:
+            self.pending.pop(storage_id)._calculate_storage_ratios()
+        return super().get(storage_id, default)
+
+    def flush(self):
+        """Compute all pending ratios and return them as a plain dict"""
+        for storage_id in list(self.pending):
+            self[storage_id]
+        return dict(self)
@@ -3,7 +3,7 @@ import random
 from collections import defaultdict
 
 from agent_model.agents import growth_func
-from agent_model.util import location_to_day_length_minutes
+from agent_model.util import location_to_day_length_minutes, resolve_unit
 
 def parse_currency_desc(currency_desc):
     """Converts raw currency_desc into a dictionary of currencies and classes.
@@ -114,6 +114,9 @@ def parse_agent(agent_class, name, data, currencies, location):
                 agent_errors[currency] = "Currency not specified in currency_desc"
         attribute_detail = dict(currency_type=currency,
                                 unit=attr_unit)
+        if currency:
+            unit_base, unit_factor = resolve_unit(attr_unit)
+            attribute_detail.update(unit_base=unit_base, unit_factor=unit_factor)
         agent_data['attribute_details'][attr_name] = attribute_detail
 
     # Parse currency exchanges (inputs & outputs)
@@ -171,6 +174,10 @@ def parse_agent(agent_class, name, data, currencies, location):
                 daily_growth_scale=None if not daily_growth else daily_growth.get('scale', None),
                 daily_growth_steepness=None if not daily_growth else daily_growth.get('steepness', None))
 
+            flow_unit_base, flow_unit_factor = resolve_unit(attribute_detail['flow_unit'])
+            attribute_detail.update(flow_unit_base=flow_unit_base,
+                                    flow_unit_factor=flow_unit_factor)
+
             if attribute_detail['lifetime_growth_type'] in ['norm', 'normal', 'sig', 'sigmoid'] \
                     and attribute_detail['lifetime_growth_scale'] is None:
                 lifetime = agent_data['attributes'].get('char_lifetime', 1)
@@ -0,0 +1,135 @@
+r"""Describes partitioning of an Agent Model into independent components.
+
+Two agents depend on each other within a step if one exchanges with, or
+reads the storage ratios of, the other. The connected components of this
+graph never interact, so each could be stepped on its own, in the same
+activation order, with the same results. Edges are taken from:
+
+  * Connections (``selected_storage``), including those without flows,
+    which are used by custom functions like ``atmosphere_equalizer``
+  * Thresholds, which read the storage ratios of another agent type
+  * Agents of the same type, which share storage ratios
+  * Plants, which share a cached co2 response, and electric lamps, which
+    read the amounts of plants
+
+Agents with other custom functions are assumed to depend on every agent.
+
+The partition is reported, so that configs which could be split (e.g. into
+separate runs) can be found, but the model is always stepped serially:
+agents step in pure Python, so threads gave no speedup, and components
+still share model-level state like the storage ratios cache.
+"""
+
+from agent_model.agents.core import CohortAgent
+
+# Custom functions whose dependencies are covered by the edges above
+_KNOWN_CUSTOM_FUNCTIONS = {'atmosphere_equalizer', 'electric_lamp', 'b2_sun'}
+
+
+def _uses_shared_random(agent):
+    """Return True if the agent draws from model.random_state when it steps"""
+    if agent.random_state is not agent.model.random_state:
+        return False
+    return (agent.step_variation is not None or
+            getattr(agent, 'process_events', False) or
+            isinstance(agent, CohortAgent))
+
+
+def find_components(model):
+    """Return the connected components of the model's agents
+
+    Returns:
+      list: ``[[<agent>]]``, components in order of their first agent in
+        the scheduler, agents in scheduler order
+    """
+    agents = list(model.scheduler.agents)
+    parent = {id(agent): id(agent) for agent in agents}
+    def _find(key):
+        while parent[key] != key:
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+    def _union(a, b):
+        root_a, root_b = _find(id(a)), _find(id(b))
+        if root_a != root_b:
+            parent[root_b] = root_a
+
+    for agent in agents:
+        for storages in agent.selected_storage['in'].values():
+            for storage in storages:
+                _union(agent, storage)
+        for storages in agent.selected_storage['out'].values():
+            for storage in storages:
+                _union(agent, storage)
+        for step_type, step_data in agent.step_plan['prelude']:
+            if step_type == 'threshold':
+                for storage in model.get_agents_by_type(step_data[0]):
+                    _union(agent, storage)
+            elif step_type == 'custom_function':
+                name = step_data.__name__
+                if name == 'electric_lamp':
+                    for plant in model.get_agents_by_class('plants'):
+                        _union(agent, plant)
+                elif name not in _KNOWN_CUSTOM_FUNCTIONS:
+                    for other in agents:
+                        _union(agent, other)
+    for group in [*model.agents_by_type.values(), model.get_agents_by_class('plants')]:
+        for other in group[1:]:
+            _union(group[0], other)
+
+    components = {}
+    for agent in agents:
+        components.setdefault(_find(id(agent)), []).append(agent)
+    return list(components.values())
+
+
+class ModelPartition():
+    """Connected components of an AgentModel, and whether they're independent
+
+    ====================== ============== ===============
+          Attribute        Type               Description
+    ====================== ============== ===============
+    ``components``         list           ``[[<agent>]]`` from ``find_components``
+    ``can_parallelize``    bool           Whether components could be stepped independently
+    ``reason``             str            Why they can't, or None
+    ====================== ============== ===============
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.components = find_components(model)
+        self.component_index = {}
+        for i, component in enumerate(self.components):
+            for agent in component:
+                self.component_index[id(agent)] = i
+        self.reason = None
+        if not model.priorities:
+            self.reason = "agents without priorities are stepped by mesa's RandomActivation"
+        elif model.engine != 'scalar':
+            self.reason = "the vectorized engine steps each agent class at once"
+        elif len(self.components) < 2:
+            self.reason = "all agents are in one connected component"
+        elif any(_uses_shared_random(a) for a in model.scheduler.agents):
+            self.reason = "agents draw from the shared random_state; set rng_streams"
+        self.can_parallelize = self.reason is None
+
+    def get_report(self):
+        """Return the partitioning as a json-serializable dict
+
+        Returns:
+          dict: ``components``: ``[[<agent_type>]]``; ``layers``:
+            ``[[[<agent_type>]]]``, the agent types of each component by
+            priority class, in the order they step; ``can_parallelize`` and
+            ``reason`` as above
+        """
+        components, layers = [], []
+        for component in self.components:
+            components.append(sorted({a.agent_type for a in component}))
+            component_layers = []
+            for agent_class in self.model.priorities:
+                layer = sorted({a.agent_type for a in component if a.agent_class == agent_class})
+                if layer:
+                    component_layers.append(layer)
+            layers.append(component_layers)
+        return dict(components=components, layers=layers,
+                    can_parallelize=self.can_parallelize, reason=self.reason)
@@ -0,0 +1,82 @@
+r"""Records where the time of an Agent Model step is spent.
+
+Profiling is off by default. ``AgentModel.enable_profiling()`` sets
+``model.profiler`` to a StepProfiler, and while it is set, agents time each
+phase of their step. When it is None, each phase costs one attribute check.
+
+  ======================= ===============
+          Phase            Description
+  ======================= ===============
+  ``step``                Everything an agent does when it is activated
+  ``thresholds``          Threshold checks against storage ratios
+  ``custom_functions``    Custom functions, e.g. ``atmosphere_equalizer``
+  ``events``              Event instances and multipliers
+  ``variation``           Step variation
+  ``target``              Step values, criteria, weights and multipliers of a flow
+  ``availability``        Balances of the storages connected to a flow
+  ``deprive``             Required inputs, deficits and deprive
+  ``exchange``            Incrementing storages and logging exchanges
+  ``storage_ratios``      Recomputing the storage ratios of a storage
+  ``co2_response``        ``PlantAgent._calculate_co2_response``
+  ``data_collection``     ``AgentDataCollector.step``
+  ======================= ===============
+
+Phases are timed inclusively: storage ratios are computed when first read,
+so their time is also counted in the phase which read them, and an agent's
+``step`` includes all of its other phases. Flow phases are counted once per
+flow; ``exchange`` only for flows with a non-zero exchange.
+"""
+
+
+class StepProfiler():
+    """Wall time and call counts of the phases of each agent type
+
+    ====================== ============== ===============
+          Attribute        Type               Description
+    ====================== ============== ===============
+    ``steps``              int            Model steps profiled
+    ``time``               float          Seconds spent in ``AgentModel.step``
+    ``records``            dict           ``{(<agent_type>, <phase>): [<calls>, <seconds>]}``
+    ``kernels``            dict           ``{<agent_class>: [<calls>, <seconds>]}`` ExchangeKernel steps
+    ====================== ============== ===============
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Clear all records"""
+        self.steps = 0
+        self.time = 0.0
+        self.records = {}
+        self.kernels = {}
+
+    def add(self, agent_type, phase, seconds):
+        """Add one call of a phase, which took seconds"""
+        record = self.records.get((agent_type, phase))
+        if record is None:
+            self.records[(agent_type, phase)] = [1, seconds]
+        else:
+            record[0] += 1
+            record[1] += seconds
+
+    def add_kernel(self, agent_class, seconds):
+        """Add one step of the ExchangeKernel of an agent class"""
+        record = self.kernels.setdefault(agent_class, [0, 0.0])
+        record[0] += 1
+        record[1] += seconds
+
+    def get_report(self):
+        """Return the records as a json-serializable dict
+
+        Returns:
+          dict: ``steps`` and ``time`` as above; ``agents``: ``{<agent_type>:
+            {<phase>: {'calls': int, 'time': float}}}``; ``kernels``:
+            ``{<agent_class>: {'calls': int, 'time': float}}``
+        """
+        agents = {}
+        for (agent_type, phase), (calls, seconds) in self.records.items():
+            agents.setdefault(agent_type, {})[phase] = dict(calls=calls, time=seconds)
+        kernels = {agent_class: dict(calls=calls, time=seconds)
+                   for agent_class, (calls, seconds) in self.kernels.items()}
+        return dict(steps=self.steps, time=self.time, agents=agents, kernels=kernels)
@@ -0,0 +1,154 @@
+r"""Runs parameter sweeps over variants of a base config.
+
+A sweep applies overrides to a base config, and runs one model per variant in
+a process pool. Overrides are ``{<path>: <value>}`` dicts, where the path is
+a dot-separated key into the config, e.g. ``'agents.human_agent.amount'``
+or ``'location'``; a value of None removes the key.
+
+Initialization is shared between variants. Each stage is cached under a key
+of the inputs it depends on, so an override only invalidates the stages it
+changes:
+
+  ========================= ========================= ===============
+          Stage                    Key                 Invalidated by
+  ========================= ========================= ===============
+  Merged data files         (none)                    Never
+  Parsed agent_desc         agent type, location      ``location``
+  Connections               active agent types        Adding or removing agents
+  Step values               agent type, location,     ``location``, ``minutes_per_step``
+                            minutes_per_step
+  ========================= ========================= ===============
+
+Other overrides (amounts, storage balances, seed, termination, etc.) don't
+invalidate anything. Step values are only shared by agents without initial
+variation or growth noise, which make them different for every run.
+"""
+
+import copy
+import itertools
+
+from concurrent.futures import ProcessPoolExecutor
+
+from agent_model.agent_model import AgentModel
+from agent_model.initializer import AgentModelInitializer, InitializerCache
+from agent_model.exceptions import AgentModelConfigError
+
+_worker_step_values = {}
+
+def apply_overrides(config, overrides):
+    """Return a copy of config with overrides applied"""
+    config = copy.deepcopy(config)
+    for path, value in overrides.items():
+        keys = path.split('.')
+        target = config
+        for key in keys[:-1]:
+            target = target.setdefault(key, {})
+        if value is None:
+            target.pop(keys[-1], None)
+        else:
+            target[keys[-1]] = copy.deepcopy(value)
+    return config
+
+def _has_noise(agent_desc):
+    return any(details.get('lifetime_growth_noise') or details.get('daily_growth_noise')
+               for details in agent_desc['attribute_details'].values())
+
+def _step_values_keys(initializer):
+    """Return {<agent_type>: <key>} for agents whose step values can be shared"""
+    md = initializer.model_data
+    keys = {}
+    for agent_type, agent_data in initializer.agent_data.items():
+        agent_desc = agent_data['agent_desc']
+        if md['global_entropy'] != 0 and 'variation' in agent_desc:
+            continue
+        if _has_noise(agent_desc):
+            continue
+        keys[agent_type] = (agent_type, md['location'], md['minutes_per_step'])
+    return keys
+
+def _run_variant(initializer, n_steps, data_collection, engine, debug, step_values=None):
+    """Run one variant of the sweep and return its data"""
+    if step_values is None:
+        step_values = _worker_step_values
+    keys = _step_values_keys(initializer)
+    for agent_type, key in keys.items():
+        if key in step_values:
+            # GeneralAgent adds to this dict, so each agent gets its own
+            instance = initializer.agent_data[agent_type]['instance']
+            instance['step_values'] = dict(step_values[key])
+    model = AgentModel(initializer, data_collection=data_collection, engine=engine)
+    for agent_type, key in keys.items():
+        if key not in step_values:
+            step_values[key] = dict(model.get_agents_by_type(agent_type)[0].step_values)
+    model.step_to(n_steps=n_steps, termination=True)
+    result = dict(steps=model.step_num,
+                  termination_reason=model.termination_reason)
+    if data_collection:
+        result['data'] = model.get_data(debug=debug)
+    else:
+        result['storages'] = {
+            storage.agent_type: {c: storage[c] for c in storage.ledger_index}
+            for storage in model.get_agents_by_role('storage')}
+    return result
+
+def run_sweep(config, overrides=None, grid=None, n_steps=None, max_workers=None,
+              data_collection=True, debug=False, engine='scalar', cache=None,
+              currency_desc=None, agent_desc=None, agent_conn=None,
+              agent_variation=None, agent_events=None):
+    """Run a model for each variant of config and return their results
+
+    Variants are every combination of one dict from ``overrides`` (or the
+    base config, if not given) with one point of ``grid``.
+
+    Args:
+       * ``config``: :ref:`simoc-config`
+
+    Kwargs:
+        * ``overrides``: list of ``{<path>: <value>}`` dicts, one per variant
+        * ``grid``: ``{<path>: [<value>]}``, every combination of values is run
+        * ``n_steps``: int, steps per run; runs also stop at termination
+        * ``max_workers``: int, passed to ProcessPoolExecutor; with 1, runs
+          are executed in this process
+        * ``data_collection``: bool, if False return storage balances instead of data
+        * ``debug``: bool, passed to ``AgentModel.get_data``
+        * ``engine``: str, 'scalar' or 'vectorized'
+        * ``cache``: InitializerCache, to reuse parsed data files across sweeps
+        * ``currency_desc``, ``agent_desc``, ``agent_conn``,
+          ``agent_variation``, ``agent_events``: as in ``AgentModel.from_config``
+
+    Returns:
+        * ``list``: ``[{'overrides': {}, 'steps': int, 'termination_reason':
+          str, 'data': model data}]`` in the order of the variants; with
+          ``data_collection=False``, ``'storages'`` (``{<agent_type>:
+          {<currency>: float}}``) instead of ``'data'``
+
+    Raises:
+        * ``AgentModelConfigError``: if a variant is invalid; ``message`` is
+          ``{'overrides': {}, 'errors': {}}``
+    """
+    variants = []
+    grid = grid or {}
+    points = [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+    for base in (overrides or [{}]):
+        for point in points:
+            variants.append({**base, **point})
+    if cache is None:
+        cache = InitializerCache()
+    initializers = []
+    for variant in variants:
+        initializer, errors = AgentModelInitializer.from_new(
+            apply_overrides(config, variant), currency_desc, agent_desc, agent_conn,
+            agent_variation, agent_events, cache=cache)
+        if any(len(errors[c]) > 0 for c in ['model', 'agents', 'currencies']):
+            raise AgentModelConfigError(dict(overrides=variant, errors=errors))
+        initializers.append(initializer)
+
+    n = len(variants)
+    args = [initializers, [n_steps] * n, [data_collection] * n, [engine] * n, [debug] * n]
+    if max_workers == 1:
+        step_values = cache.stages.setdefault('step_values', {})
+        results = list(map(_run_variant, *args, [step_values] * n))
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(_run_variant, *args))
+    return [dict(overrides=variant, **result) for variant, result in zip(variants, results)]
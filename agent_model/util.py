@@ -1,6 +1,8 @@
 import datetime
 import importlib
+from collections import OrderedDict
 import numpy as np
+import quantities as pq
 # import matplotlib.pyplot as plt
 
 class NotLoaded(object):
@@ -73,6 +75,35 @@ def subdict_from_list(d, l):
     return {key:d[key] for key in l if key in d}
 
 
+_RESOLVED_UNITS = {}
+
+def resolve_unit(unit):
+    """Resolve a unit string to a base unit and a scale factor
+
+    Units are resolved once, when agent data is parsed, so that the model
+    can work with plain floats while stepping.
+
+    Parameters
+    ----------
+    unit : str
+        a unit recognized by the quantities package, e.g. 'kWh'
+
+    Returns
+    -------
+    tuple
+        (base unit, factor), e.g. ('kg*m**2/s**2', 3600000.0), or
+        (None, None) if the unit is not recognized
+    """
+    if unit not in _RESOLVED_UNITS:
+        try:
+            simplified = pq.Quantity(1.0, unit or '').simplified
+            resolved = (simplified.dimensionality.string, simplified.magnitude.item())
+        except (LookupError, ValueError, TypeError, AttributeError):
+            resolved = (None, None)
+        _RESOLVED_UNITS[unit] = resolved
+    return _RESOLVED_UNITS[unit]
+
+
 def timedelta_to_days(time_d):
     """Get total days from timedelta
 
@@ -202,6 +233,78 @@ def location_to_day_length_minutes(location):
     else:
         raise Exception("Unknown location: {}".format(location))
 
+class LRUCache():
+    """A size-bounded cache of values computed from hashable keys
+
+    The least recently used value is evicted when maxsize is reached.
+    NumPy arrays are made read-only when cached and returned without
+    copying, so callers must copy them before modifying them. None is
+    never cached.
+
+    Attributes:
+      maxsize: int, values kept
+      hits: int, values returned from the cache
+      misses: int, values computed
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._values = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def lookup(self, key):
+        """Return the cached value of key, or None"""
+        value = self._values.get(key)
+        if value is not None:
+            self._values.move_to_end(key)
+            self.hits += 1
+        return value
+
+    def add(self, key, value):
+        """Cache value under key, evicting the least recently used value if full"""
+        if isinstance(value, np.ndarray):
+            value.setflags(write=False)
+        self._values[key] = value
+        self._values.move_to_end(key)
+        if len(self._values) > self.maxsize:
+            self._values.popitem(last=False)
+        return value
+
+    def get(self, key, func):
+        """Return the cached value of key, or compute it with func() and cache it"""
+        value = self.lookup(key)
+        if value is None:
+            self.misses += 1
+            value = self.add(key, func())
+        return value
+
+    def clear(self):
+        """Remove all values and reset the counters"""
+        self._values.clear()
+        self.hits = self.misses = 0
+
+    def get_stats(self):
+        """Return the counters and size as a dict"""
+        return dict(hits=self.hits, misses=self.misses, size=len(self._values),
+                    maxsize=self.maxsize)
+
+def random_generator(state):
+    """Return a np.random.Generator from a Generator, SeedSequence or bit generator state"""
+    if isinstance(state, np.random.Generator):
+        return state
+    if isinstance(state, np.random.SeedSequence):
+        return np.random.Generator(np.random.PCG64(state))
+    bit_generator = getattr(np.random, state['bit_generator'])()
+    bit_generator.state = state
+    return np.random.Generator(bit_generator)
+
 def parse_data(data, path):
     """Recursive function to extract data at path from arbitrary object"""
     if not data and data != 0:
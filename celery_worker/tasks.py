@@ -15,6 +15,9 @@ logger = get_task_logger(__name__)
 sys.path.append("../")
 
 from simoc_abm.agent_model import AgentModel
+from agent_model.agents.data_collector import STATS, ends_period, parse_resolution
+from agent_model.exceptions import AgentModelInitializationError
+from agent_model.util import location_to_day_length_minutes
 from simoc_server.database.db_model import User
 from simoc_server.exceptions import NotFound
 from simoc_server import redis_conn, db
@@ -50,14 +53,122 @@ def get_user(username, num_retries=30, interval=1):
 
 BUFFER_SIZE = 100  # Number of steps to execute between adding records to Redis
 RECORD_EXPIRE = 1800  # Number of seconds to keep records in Redis
+# Fields of each agent's records in simoc_abm, which collection plans select
+RECORD_FIELDS = ['active', 'cause_of_death', 'storage', 'attributes', 'flows']
+SERIES_FIELDS = ['active', 'storage', 'attributes', 'flows']  # Fields with a value per step
+HOURS_PER_STEP = 1  # simoc_abm steps are 1 hour
+
+def filter_records(records, collection_plan):
+    """Return the records of the agents and fields in a collection plan
+
+    The plan is ``{<agent_id>: [<field>]}`` from ``parse_plan``, with fields
+    in ``RECORD_FIELDS``. The 'static' records of collected agents are kept.
+    """
+    if collection_plan is None:
+        return records
+    default = collection_plan.get('default', [])
+    agents = {}
+    for name, agent_records in records['agents'].items():
+        fields = collection_plan.get(name, default)
+        if fields is None:
+            agents[name] = agent_records
+        elif fields:
+            agents[name] = {k: v for k, v in agent_records.items()
+                            if k in fields or k == 'static'}
+    return {**records, 'agents': agents}
+
+def get_resolution(data_resolution, location):
+    """Return ``(<every>, <aggregate>)`` for the data_resolution of a game, or None
+
+    Args:
+      data_resolution: None to send every step; int N to send every Nth
+        step; or 'daily' for min/mean/max/sum aggregates of each day, of
+        the day length at location
+      location: str, the location of the game
+
+    Raises:
+      AgentModelInitializationError: if data_resolution is invalid
+    """
+    if data_resolution is None:
+        return None
+    if isinstance(data_resolution, dict):
+        # time and step_num are shared by every series of a batch
+        raise AgentModelInitializationError("Games take one data resolution for all fields")
+    steps_per_day = location_to_day_length_minutes(location) / 60 / HOURS_PER_STEP
+    return parse_resolution(data_resolution, steps_per_day)['flows']
+
+def _map_series(records, func, step_func=None):
+    """Apply func to each per-step list of agent records, and step_func (or
+    func) to time and step_num; other values are kept"""
+    def _map(value):
+        if isinstance(value, dict):
+            return {k: _map(v) for k, v in value.items()}
+        return func(value) if isinstance(value, list) else value
+    step_func = step_func or func
+    output = {k: step_func(records[k]) for k in ['time', 'step_num']}
+    output['agents'] = {}
+    for name, agent_records in records['agents'].items():
+        output['agents'][name] = {k: _map(v) if k in SERIES_FIELDS else v
+                                  for k, v in agent_records.items()}
+    return {**records, **output}
+
+def _prepend_series(pending, records):
+    """Return records with the per-step lists of pending records before their own"""
+    def _merge(held, value):
+        if isinstance(value, dict):
+            held = held if isinstance(held, dict) else {}
+            return {k: _merge(held.get(k), v) for k, v in value.items()}
+        return held + value if isinstance(value, list) and isinstance(held, list) else value
+    output = {k: pending[k] + records[k] for k in ['time', 'step_num']}
+    output['agents'] = {}
+    for name, agent_records in records['agents'].items():
+        held = pending['agents'].get(name, {})
+        output['agents'][name] = {k: _merge(held.get(k), v) if k in SERIES_FIELDS else v
+                                  for k, v in agent_records.items()}
+    return {**records, **output}
+
+def reduce_records(records, resolution, pending=None, final=False):
+    """Return the records of a batch at a data resolution, and those held back
+
+    Steps are grouped in periods of ``every`` steps (see ``ends_period``),
+    and only complete periods are returned. Each series has the value of
+    the last step of each period, or with ``aggregate``, a dict of the min,
+    mean, max and sum of each period (time and step_num are always of the
+    last step). Steps of an incomplete aggregate period are held back, and
+    passed as ``pending`` with the next batch. The ``final`` batch of a
+    game ends its last period at its last step, so no steps are left out.
+    """
+    if pending is not None:
+        records = _prepend_series(pending, records)
+    every, aggregate = resolution
+    step_nums = records['step_num']
+    ends = [i for i, step_num in enumerate(step_nums) if ends_period(step_num, every)]
+    if final and step_nums and (not ends or ends[-1] != len(step_nums) - 1):
+        ends.append(len(step_nums) - 1)
+    if not aggregate:
+        return _map_series(records, lambda v: [v[i] for i in ends]), None
+    cut = ends[-1] + 1 if ends else 0
+    held = _map_series(records, lambda v: v[cut:])
+    starts = [0] + [i + 1 for i in ends[:-1]]
+    def _aggregate(values):
+        periods = [values[start:end + 1] for start, end in zip(starts, ends)]
+        stats = dict(min=[min(p) for p in periods], max=[max(p) for p in periods],
+                     sum=[sum(p) for p in periods])
+        stats['mean'] = [total / len(p) for total, p in zip(stats['sum'], periods)]
+        return {stat: stats[stat] for stat in STATS}
+    reduced = _map_series(records, _aggregate, lambda v: [v[i] for i in ends])
+    return reduced, held
 
 @app.task
-def new_game(username, game_config, num_steps, expire=3600):
+def new_game(username, game_config, num_steps, expire=3600, collection_plan=None,
+             data_resolution=None):
     logger.info(f'Starting new game for {username=}, {num_steps=}')
     # Initialize model
     user = get_user(username)
     game_id = random.getrandbits(63)
     model = AgentModel.from_config(**game_config, record_initial_state=False)
+    resolution = get_resolution(data_resolution, model.location)
+    pending = None  # Steps of an incomplete period, sent with the next batch
     model.game_id = game_id
     model.user_id = user.id
     # Save complete game config to Redis
@@ -77,6 +188,10 @@ def new_game(username, game_config, num_steps, expire=3600):
             for _ in range(n_steps):
                 model.step()
             records = model.get_records(static=True, clear_cache=True)
+            records = filter_records(records, collection_plan)
+            if resolution is not None:
+                final = model.step_num >= num_steps or model.is_terminated
+                records, pending = reduce_records(records, resolution, pending, final)
             # Include the number of steps so views.py knows when it's finished
             records['n_steps'] = n_steps
             redis_conn.rpush(key, json.dumps(records))
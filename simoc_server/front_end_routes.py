@@ -23,6 +23,7 @@ from werkzeug.security import safe_join
 from simoc_server import app, db, redis_conn
 from simoc_abm.util import load_data_file, get_default_agent_data, get_default_currency_data
 from simoc_abm.agents import SunAgent, ConcreteAgent
+from agent_model.util import LRUCache
 
 @app.route('/simdata/<path:filename>')
 def serve_simdata(filename):
@@ -83,9 +84,10 @@ def get_energy():
 
 monthly_par = SunAgent.monthly_par
 hourly_par_fraction = SunAgent.hourly_par_fraction
-def b2_plant_factor(plant, data, cache={}):
+_b2_plant_factors = LRUCache(maxsize=256)  # {<plant>: <factor>}
+def b2_plant_factor(plant, data):
     """Calculate and return an estimate of the actual:ideal exchange ratios at b2"""
-    if plant not in cache:
+    def _b2_plant_factor():
         # par_factor
         mean_monthly_par = sum(monthly_par) / len(monthly_par)
         available_light = np.array(hourly_par_fraction) * mean_monthly_par
@@ -101,8 +103,8 @@ def b2_plant_factor(plant, data, cache={}):
         par_factor = np.mean(par_factor_hourly[photo_start:photo_end])
         # density_factor
         density_factor = 0.5
-        cache[plant] = par_factor * density_factor
-    return cache[plant]
+        return par_factor * density_factor
+    return _b2_plant_factors.get(plant, _b2_plant_factor)
 
 carbonation_rate = (ConcreteAgent.rate_scale[0] * 
                     ConcreteAgent.density * 
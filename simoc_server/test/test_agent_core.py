@@ -4,11 +4,13 @@ import copy
 import random
 import datetime
 
+import numpy as np
 import pytest
 from pytest import approx
 
 from simoc_server.front_end_routes import convert_configuration
 from agent_model import AgentModel
+from agent_model.agents import growth_func
 
 def test_agent_one_human_radish(one_human_radish, random_seed):
     one_human_radish_converted = convert_configuration(one_human_radish)
@@ -174,6 +176,34 @@ def test_agent_variation(one_human_radish, random_seed):
     assert solar.initial_variable == s_var
     assert solar.attrs['out_kwh'] == s_var * 0.354
 
+def test_agent_daily_growth(random_seed):
+    with open('data_files/config_4hg.json') as f:
+        config = json.load(f)
+    config['seed'] = random_seed
+    model = AgentModel.from_config(config)
+    wheat = model.agents_by_type['wheat'][0]
+    attr = 'out_biomass'
+    lifetime_values = wheat._build_step_values(attr)
+    wheat.attr_details[attr] = dict(wheat.attr_details[attr], daily_growth_type='clipped')
+    step_values = wheat._build_step_values(attr)
+    assert step_values.shape == lifetime_values.shape
+
+    # Each day is a clipped bell curve, which starts at the day's minimum
+    # and has its mean as the agent_value
+    day_length = int(model.day_length_hours)
+    for i in range(0, len(step_values), day_length):
+        day = lifetime_values[i:i+day_length]
+        mean, daily_min = np.mean(day), np.min(day)
+        start_value = daily_min if daily_min < np.max(day) else 0
+        if start_value == mean:
+            expected = np.ones(len(day)) * mean
+        else:
+            expected = growth_func.get_growth_values(
+                agent_value=mean, growth_type='clipped', num_values=len(day),
+                min_value=start_value, min_threshold=0, max_threshold=0, center=None,
+                noise=False, invert=False, scale=0.5, max_value=mean * 1.1)
+        assert step_values[i:i+day_length].tolist() == expected.tolist()
+
 def export_data(model, fname):
     agent_records = model.get_data(debug=True)
     for agent in model.scheduler.agents:
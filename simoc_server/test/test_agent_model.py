@@ -4,10 +4,14 @@ import copy
 import random
 import datetime
 
+import numpy as np
 import pytest
 
 from simoc_server.front_end_routes import convert_configuration
 from agent_model import AgentModel
+from agent_model.agents import CohortAgent, PlantCohortAgent
+from agent_model.agents.data_collector import RecordTable
+from agent_model.exceptions import AgentModelError, AgentModelInitializationError
 
 class AgentModelInstance():
     """An individual instance of an Agent Model
@@ -112,3 +116,315 @@ def test_model_four_humans_garden(four_humans_garden, agent_class_dict, agent_de
     # records = model.all_records()
     # with open('four_humans_garden_records.json', 'w') as f:
     #     json.dump(records, f)
+
+
+def test_model_step_plan(random_seed):
+    with open('data_files/config_1h.json') as f:
+        config = json.load(f)
+    config['seed'] = random_seed
+    model = AgentModel.from_config(config)
+    human = model.get_agents_by_type('human_agent')[0]
+    flows = {f['attr']: f for f in human.step_plan['flows']}
+    assert list(flows) == [f'{prefix}_{currency}'
+                           for prefix in ['in', 'out']
+                           for currency in human.selected_storage[prefix]
+                           if human.attrs[f'{prefix}_{currency}'] != 0]
+    assert flows['out_urine']['requires'] == human.attr_details['out_urine']['requires']
+    assert flows['in_potable']['deprive_value'] > 0
+    # Thresholds are resolved to a storage ratio and comparator
+    step_type, (storage_id, ratio, opp, value, currency) = human.step_plan['prelude'][0]
+    assert step_type == 'threshold'
+    assert ratio in model.storage_ratios[storage_id]
+    co2_removal = model.get_agents_by_type('co2_removal_SAWD')[0]
+    criteria = co2_removal.step_plan['criteria']['in_co2']
+    assert criteria['name'] == co2_removal.attr_details['in_co2']['criteria_name']
+
+def test_model_agent_registry(random_seed):
+    with open('data_files/config_4hg.json') as f:
+        config = json.load(f)
+    config['seed'] = random_seed
+    config['single_agent'] = 0
+    model = AgentModel.from_config(config)
+    agents = model.scheduler.agents
+    for agent_type in {a.agent_type for a in agents}:
+        assert model.get_agents_by_type(agent_type) == \
+            [a for a in agents if a.agent_type == agent_type]
+    for agent_class in {a.agent_class for a in agents}:
+        assert model.get_agents_by_class(agent_class) == \
+            [a for a in agents if a.agent_class == agent_class]
+    assert model.get_agents_by_role('storage') == [a for a in agents if a.has_storage]
+    assert model.get_agents_by_role('flows') == [a for a in agents if a.has_flows]
+    assert model.get_agents_by_type('not_an_agent') == []
+
+    humans = model.get_agents_by_type('human_agent')
+    assert len(humans) == 4
+    human = humans[-1]
+    assert model.agent_by_uid(human.unique_id) is human
+    model.remove(human)
+    assert human not in model.get_agents_by_type('human_agent')
+    assert human not in model.get_agents_by_class('inhabitants')
+    assert human not in model.get_agents_by_role('flows')
+    assert model.agent_by_uid(human.unique_id) is None
+    model.step()
+    model.add_agent(human)
+    assert model.get_agents_by_type('human_agent')[-1] is human
+    assert human in model.scheduler.agents_by_class['inhabitants']
+
+def test_model_cohorts(random_seed):
+    with open('data_files/config_4hg.json') as f:
+        config = json.load(f)
+    config['seed'] = random_seed
+    config['single_agent'] = 0
+    config['cohorts'] = True
+    config['global_entropy'] = 1
+    model = AgentModel.from_config(copy.deepcopy(config))
+    for agent_type, instance in config['agents'].items():
+        agents = model.get_agents_by_type(agent_type)
+        if agent_type == 'concrete':
+            continue
+        assert len(agents) == 1
+        assert agents[0].amount == agents[0].cohort_size == instance.get('amount', 1)
+    humans = model.get_agents_by_type('human_agent')[0]
+    assert isinstance(humans, CohortAgent)
+    assert isinstance(model.get_agents_by_class('plants')[0], PlantCohortAgent)
+    # Individuals vary
+    assert len(set(humans.flow_variables['in_o2'].tolist())) == humans.cohort_size
+    model.step_to(n_steps=10)
+    assert len(set(humans.step_variables.tolist())) == humans.cohort_size
+    assert humans.deprive['in_potable'] == \
+        sum(humans.individual_deprive['in_potable'].tolist())
+
+    # Killing individuals updates the mask and aggregate fields
+    humans.alive[0] = False
+    humans.kill(1, 'test')
+    assert humans.amount == 3
+    assert humans.alive.tolist() == [False, True, True, True]
+    assert humans.deprive['in_potable'] == \
+        sum(humans.individual_deprive['in_potable'][1:].tolist())
+    humans.kill(1, 'test')
+    assert humans.alive.tolist() == [False, True, True, False]
+
+    # Data has the same fields as single agents
+    config['single_agent'] = 1
+    single = AgentModel.from_config(copy.deepcopy(config))
+    single.step_to(n_steps=10)
+    data = model.get_data(debug=True)
+    for agent_type, agent_data in single.get_data(debug=True).items():
+        if isinstance(agent_data, dict):
+            assert agent_data.keys() == data[agent_type].keys()
+
+    # Individual state is saved
+    loaded = AgentModel.load(model.save())
+    loaded_humans = loaded.get_agents_by_type('human_agent')[0]
+    assert loaded_humans.alive.tolist() == humans.alive.tolist()
+    assert loaded_humans.step_variables.tolist() == humans.step_variables.tolist()
+    loaded.step()
+
+def test_model_fork(random_seed):
+    with open('data_files/config_4hg.json') as f:
+        config = json.load(f)
+    config['seed'] = random_seed
+    config['global_entropy'] = 1
+    model = AgentModel.from_config(copy.deepcopy(config))
+    model.step_to(n_steps=10)
+    fork = model.fork()
+
+    # Immutable structures are shared, mutable state is copied
+    sawd = model.get_agents_by_type('co2_removal_SAWD')[0]
+    fork_sawd = fork.get_agents_by_type('co2_removal_SAWD')[0]
+    assert fork_sawd is not sawd
+    assert fork_sawd.attr_details is sawd.attr_details
+    assert fork_sawd.step_values['in_co2'] is sawd.step_values['in_co2']
+    assert fork.currency_dict is model.currency_dict
+    assert fork.ledger.values is not model.ledger.values
+
+    # Branches are independent, and the original is unaffected
+    fork_sawd.kill(fork_sawd.amount, 'what if')
+    fork.step_to(n_steps=10)
+    model.step_to(n_steps=10)
+    reference = AgentModel.from_config(copy.deepcopy(config))
+    reference.step_to(n_steps=20)
+    assert model.get_data(debug=True) == reference.get_data(debug=True)
+    assert fork.get_data()['co2_removal_SAWD']['amount'][-1] == 0
+    assert sawd.amount > 0
+
+def test_model_rng_streams(random_seed):
+    with open('data_files/config_4hg.json') as f:
+        config = json.load(f)
+    config['seed'] = random_seed
+    config['global_entropy'] = 1
+    config['rng_streams'] = True
+    model = AgentModel.from_config(copy.deepcopy(config))
+    model.step_to(n_steps=20)
+    human = model.get_agents_by_type('human_agent')[0]
+    assert human.random_state is not model.random_state
+    assert human.event_random_state is not human.random_state
+    assert model.agent_streams['human_agent'] == 1
+
+    # Runs are reproducible
+    again = AgentModel.from_config(copy.deepcopy(config))
+    again.step_to(n_steps=20)
+    assert again.get_data(debug=True) == model.get_data(debug=True)
+
+    # An agent's draws don't depend on other agents
+    other = copy.deepcopy(config)
+    other['agents']['wheat']['amount'] += 10
+    other['agents']['co2_removal_SAWD']['amount'] += 1
+    other_model = AgentModel.from_config(other)
+    other_model.step_to(n_steps=20)
+    other_human = other_model.get_agents_by_type('human_agent')[0]
+    assert other_human.initial_variable == human.initial_variable
+    assert (other_human.data_collector.get_data()['step_variable'] ==
+            human.data_collector.get_data()['step_variable'])
+
+    # Stream states are saved
+    loaded = AgentModel.load(copy.deepcopy(model.save()))
+    loaded_human = loaded.get_agents_by_type('human_agent')[0]
+    model.step()
+    loaded.step()
+    assert loaded_human.step_variable == human.step_variable
+
+def test_model_profiling(random_seed):
+    with open('data_files/config_4hg.json') as f:
+        config = json.load(f)
+    config['seed'] = random_seed
+    model = AgentModel.from_config(copy.deepcopy(config))
+    assert model.profiler is None
+    assert model.get_profile() is None
+    model.enable_profiling()
+    model.step_to(n_steps=5)
+    profile = model.get_profile()
+    assert profile['steps'] == 5
+    human = profile['agents']['human_agent']
+    assert human['step']['calls'] == 5
+    assert human['thresholds']['calls'] == 10
+    assert human['target']['calls'] == 5 * 7
+    assert human['data_collection']['calls'] == 5
+    assert profile['agents']['wheat']['co2_response']['calls'] == 5
+    assert profile['agents']['atmosphere_equalizer']['custom_functions']['calls'] == 5
+    assert 'storage_ratios' in profile['agents']['crew_habitat_medium']
+    assert 0 < human['target']['time'] < human['step']['time'] < profile['time']
+
+    # Records are kept while disabled, and don't change the results
+    model.disable_profiling()
+    model.step_to(n_steps=5)
+    assert model.get_profile(reset=True)['steps'] == 5
+    assert model.get_profile()['steps'] == 0
+    reference = AgentModel.from_config(copy.deepcopy(config))
+    reference.step_to(n_steps=10)
+    assert model.get_data(debug=True) == reference.get_data(debug=True)
+
+def test_model_data_collector_buffers(random_seed):
+    with open('data_files/config_4hg.json') as f:
+        config = json.load(f)
+    config['seed'] = random_seed
+    config['termination'] = [dict(condition='time', value=2, unit='day')]
+    model = AgentModel.from_config(config)
+    human = model.get_agents_by_type('human_agent')[0].data_collector
+    assert human.expected_steps == 51
+    table = human.tables[(1, False)]
+    assert table.table.shape[0] == 51
+
+    # Tables grow past the expected steps
+    model.is_terminated = False
+    model.termination = []
+    model.step_to(n_steps=60)
+    assert table.size == 60 and table.table.shape[0] == 102
+    data = model.get_data(debug=True)
+    arrays = model.get_data(debug=True, arrays=True)
+    assert data['human_agent']['amount'] == [4] * 60
+    assert isinstance(data['wheat']['growth']['grown'][0], bool)
+    assert arrays['human_agent']['age'].tolist() == data['human_agent']['age']
+    o2 = arrays['human_agent']['flows']['in']['o2']['crew_habitat_medium']
+    assert o2.tolist() == data['human_agent']['flows']['in']['o2']['crew_habitat_medium']
+    assert human.get_data(step_range=(10, 20))['age'] == data['human_agent']['age'][10:20]
+
+    # Cleared tables are reused from the first row
+    model.get_data(clear_cache=True)
+    assert table.size == 0
+    model.step()
+    assert model.get_data()['human_agent']['age'] == [data['human_agent']['age'][-1] + 1]
+
+def test_record_table_kinds():
+    # Columns start as int, None and bool, and later hold floats and ints
+    table = RecordTable(3)
+    for step_num, row in enumerate([[1, None, True], [2, 0.5, False], [2.5, None, 3]], 1):
+        table.add(row, step_num)
+    assert table.kinds == [float, float, int]
+    assert table.get_column(0) == [1.0, 2.0, 2.5]
+    assert table.get_column(1) == [None, 0.5, None]
+    assert table.get_column(2) == [1, 0, 3]
+    assert np.isnan(table.get_column(1, arrays=True)[0])
+
+    # None values are left out of aggregates
+    table = RecordTable(2, every=3, aggregate=True)
+    for step_num, row in enumerate([[None, None], [1, None], [4, None]], 1):
+        table.add(row, step_num)
+    assert table.get_column(0) == dict(min=[1], mean=[2.5], max=[4], sum=[5])
+    assert table.get_column(1) == dict(min=[None], mean=[None], max=[None], sum=[None])
+
+def test_model_data_resolution(random_seed):
+    with open('data_files/config_4hg.json') as f:
+        config = json.load(f)
+    config['seed'] = random_seed
+    reference = AgentModel.from_config(copy.deepcopy(config))
+    reference.step_to(n_steps=60)
+    expected = reference.get_data(debug=True)['human_agent']
+    model = AgentModel.from_config(copy.deepcopy(config),
+                                   data_resolution={'default': 12, 'flows': 'daily'})
+    model.step_to(n_steps=60)
+    human = model.get_data(debug=True)['human_agent']
+    assert human['age'] == expected['age'][11::12]
+    assert human['amount'] == [4] * 5
+    assert human['deprive']['in_food'] == expected['deprive']['in_food'][11::12]
+
+    # Daily aggregates, of complete sols only. Sols are 24.65 hours, so the
+    # step which crosses the end of a sol ends it: steps 1-25 and 26-50.
+    assert model.location == 'mars'
+    o2 = human['flows']['in']['o2']['crew_habitat_medium']
+    o2_expected = expected['flows']['in']['o2']['crew_habitat_medium']
+    days = [np.array(o2_expected[:25]), np.array(o2_expected[25:50])]
+    assert o2['sum'] == [day.sum() for day in days]
+    assert o2['min'] == [day.min() for day in days]
+    assert o2['max'] == [day.max() for day in days]
+    assert o2['mean'] == pytest.approx([day.mean() for day in days])
+
+    # Batches don't split days
+    model.get_data(clear_cache=True)
+    model.step_to(n_steps=24)
+    human = model.get_data(debug=True)['human_agent']
+    assert len(human['flows']['in']['o2']['crew_habitat_medium']['sum']) == 1
+
+    with pytest.raises(AgentModelError):
+        model.get_columns()
+    with pytest.raises(AgentModelInitializationError):
+        AgentModel.from_config(copy.deepcopy(config), data_resolution={'flow': 2})
+    with pytest.raises(AgentModelInitializationError):
+        AgentModel.from_config(copy.deepcopy(config), data_resolution=0)
+
+def test_model_collection_plan(random_seed):
+    with open('data_files/config_4hg.json') as f:
+        config = json.load(f)
+    config['seed'] = random_seed
+    reference = AgentModel.from_config(copy.deepcopy(config))
+    reference.step_to(n_steps=10)
+    expected = reference.get_data(debug=True)
+    plan = {'human_agent': ['amount', 'flows'], 'wheat': None}
+    model = AgentModel.from_config(copy.deepcopy(config), collection_plan=plan)
+    model.step_to(n_steps=10)
+    data = model.get_data(debug=True)
+    assert set(data) == {'game_id', 'step_num', 'human_agent', 'wheat'}
+    assert data['human_agent'] == {f: expected['human_agent'][f]
+                                   for f in ['name', 'amount', 'flows']}
+    assert data['wheat'] == expected['wheat']
+    assert model.agents_by_type['crew_habitat_medium'][0].data_collector is None
+    # Requested fields are a subset of the collected fields
+    human = model.get_data(fields=['flows', 'storage'])['human_agent']
+    assert human == {'flows': expected['human_agent']['flows']}
+
+    model = AgentModel.from_config(copy.deepcopy(config), collection_plan=['storage'])
+    model.step_to(n_steps=10)
+    habitat = model.get_data(debug=True)['crew_habitat_medium']
+    assert habitat == {f: expected['crew_habitat_medium'][f] for f in ['name', 'storage']}
+    with pytest.raises(AgentModelInitializationError):
+        AgentModel.from_config(copy.deepcopy(config), collection_plan={'human_agent': ['flow']})
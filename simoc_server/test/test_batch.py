@@ -0,0 +1,66 @@
+import copy
+import json
+
+import pytest
+
+from agent_model import AgentModel, BatchedAgentModel
+from agent_model.exceptions import AgentModelError, AgentModelInitializationError
+
+@pytest.fixture()
+def configs(random_seed):
+    with open('data_files/config_1h.json') as f:
+        config = json.load(f)
+    config['seed'] = random_seed
+    configs = []
+    for amount, ration in [(1, 100), (2, 100), (3, 10)]:
+        variant = copy.deepcopy(config)
+        variant['agents']['co2_removal_SAWD']['amount'] = amount
+        variant['agents']['oxygen_generation_SFWE']['amount'] = amount
+        variant['agents']['ration_storage']['ration'] = ration
+        configs.append(variant)
+    return configs
+
+def test_batch_matches_separate_runs(configs):
+    batch = BatchedAgentModel.from_configs(configs, data_collection=True)
+    assert 'human_agent' in batch.kernels
+    batch.step_to(n_steps=50)
+    data = batch.get_data(debug=True)
+    for k, config in enumerate(configs):
+        model = AgentModel.from_config(copy.deepcopy(config), data_collection=True)
+        model.step_to(n_steps=50)
+        assert data[k] == model.get_data(debug=True)
+        assert list(batch.ledger[k]) == list(model.ledger.values[:model.ledger.size])
+
+def test_batch_termination(configs):
+    configs[1]['termination'] = [{'condition': 'time', 'value': 10, 'unit': 'hour'}]
+    batch = BatchedAgentModel.from_configs(configs)
+    batch.step_to(n_steps=20)
+    assert list(batch.is_terminated) == [False, True, False]
+    assert [m.step_num for m in batch.models] == [20, 10, 20]
+
+def test_batch_topology_mismatch(configs):
+    del configs[1]['agents']['dehumidifier']
+    with pytest.raises(AgentModelInitializationError):
+        BatchedAgentModel.from_configs(configs)
+
+def test_batch_variant_state(configs):
+    batch = BatchedAgentModel.from_configs(configs)
+    batch.step_to(n_steps=10)
+    model = AgentModel.from_config(copy.deepcopy(configs[0]))
+    model.step_to(n_steps=10)
+    assert batch.models[0].agents_by_type['human_agent'][0].age == 10
+    saved, expected = batch.models[0].save(), model.save()
+    for agent_type, agent_data in expected['agent_data'].items():
+        instance = saved['agent_data'][agent_type]['instance']
+        del instance['unique_id'], agent_data['instance']['unique_id']
+        assert instance == agent_data['instance']
+
+def test_batch_ledger_frozen(configs):
+    batch = BatchedAgentModel.from_configs(configs)
+    ledger = batch.models[1].ledger
+    with pytest.raises(AgentModelError):
+        ledger.register(5)
+    assert ledger.values.base is batch.ledger
+    assert ledger.size == batch.ledger.shape[1]
+    batch.models[1].ledger.values[0] = 42
+    assert batch.ledger[1, 0] == 42
@@ -0,0 +1,24 @@
+import copy
+
+from agent_model.benchmark import find_presets, run_benchmarks, compare_results
+
+def test_benchmark_presets():
+    presets = find_presets()
+    assert '1h' in presets and 'b2_mission1a' in presets
+    results = run_benchmarks(['1h'], n_steps=5, repeat=1)
+    result = results['results']['1h']
+    assert result['steps'] == 5
+    assert result['init_time'] > 0 and result['steps_per_sec'] > 0
+    assert result['peak_memory'] > 0 and result['data_size'] > 0
+    assert results['settings'] == dict(n_steps=5, repeat=1, data_collection=True)
+    assert compare_results(results, results) == []
+
+    baseline = copy.deepcopy(results)
+    baseline['results']['1h']['steps_per_sec'] *= 2
+    baseline['results']['1h']['data_size'] *= 1.05
+    regressions = compare_results(results, baseline, tolerance=0.1)
+    assert [(r['preset'], r['field']) for r in regressions] == [('1h', 'steps_per_sec')]
+    assert regressions[0]['change'] == 0.5
+
+    results['results']['1h'] = dict(error='AgentInitializationError')
+    assert compare_results(results, baseline)[0]['field'] == 'error'
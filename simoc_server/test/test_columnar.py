@@ -0,0 +1,56 @@
+import json
+
+import numpy as np
+import pytest
+
+from agent_model import AgentModel
+from agent_model.columnar import to_columns, save_columns, load_columns, select
+
+@pytest.fixture()
+def model(random_seed):
+    with open('data_files/config_4hg.json') as f:
+        config = json.load(f)
+    config['seed'] = random_seed
+    model = AgentModel.from_config(config)
+    model.step_to(n_steps=20)
+    return model
+
+def test_columns_match_data(model):
+    data = model.get_data(debug=True)
+    columns = model.get_columns()
+    assert columns['step'].tolist() == list(range(1, 21))
+    flows = columns['flows']
+    o2, mask = select(flows, agent_type='human_agent', direction='in', currency='o2')
+    assert o2.tolist() == [data['human_agent']['flows']['in']['o2']['crew_habitat_medium']]
+    assert flows['connection'][mask].tolist() == ['crew_habitat_medium']
+    amount, _ = select(columns['agents'], agent_type='wheat', field='amount')
+    assert amount[0].tolist() == data['wheat']['amount']
+    n_storages = sum(len(d.get('storage', {})) for d in data.values() if isinstance(d, dict))
+    assert columns['storage']['values'].shape == (n_storages, 20)
+
+    partial = model.get_columns(step_range=(5, 10))
+    assert partial['step'].tolist() == [6, 7, 8, 9, 10]
+    assert np.array_equal(partial['storage']['values'], columns['storage']['values'][:, 5:10])
+
+def test_columns_shorter_series():
+    data = dict(step_num=12, a={'amount': [1, 2, 3]}, b={'amount': [4, 5]})
+    columns = to_columns(data)
+    assert columns['step'].tolist() == [10, 11, 12]
+    assert np.isnan(columns['agents']['values'][1, 0])
+    assert columns['agents']['values'][1, 1:].tolist() == [4, 5]
+
+@pytest.mark.parametrize('filename', ['columns.npz', 'columns'])
+def test_save_load_columns(model, tmp_path, filename):
+    columns = model.get_columns()
+    path = str(tmp_path / filename)
+    save_columns(path, columns)
+    loaded = load_columns(path, mmap_mode='r')
+    if filename == 'columns':
+        assert isinstance(loaded['flows']['values'], np.memmap)
+    assert np.array_equal(loaded['step'], columns['step'])
+    for family, table in columns.items():
+        if family == 'step':
+            continue
+        assert loaded[family].keys() == table.keys()
+        for key, array in table.items():
+            assert np.array_equal(loaded[family][key], array, equal_nan=key == 'values')
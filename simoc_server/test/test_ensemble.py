@@ -0,0 +1,53 @@
+import copy
+import json
+
+import numpy as np
+import pytest
+from pytest import approx
+
+from agent_model import AgentModel, run_ensemble
+
+@pytest.fixture()
+def config(random_seed):
+    with open('data_files/config_1h.json') as f:
+        config = json.load(f)
+    config['seed'] = random_seed
+    config['global_entropy'] = 1
+    return config
+
+def test_run_ensemble(config):
+    seeds = [config['seed'], config['seed'] + 1, config['seed'] + 2]
+    result = run_ensemble(config, seeds=seeds, n_steps=20, max_workers=2)
+    assert result['seeds'] == seeds
+    assert list(result['data']) == seeds
+
+    # Runs match the model run on its own
+    model = AgentModel.from_config(copy.deepcopy(config))
+    model.step_to(n_steps=20)
+    expected = model.get_data()['human_agent']['flows']['in']['o2']
+    assert result['data'][seeds[0]]['human_agent']['flows']['in']['o2'] == expected
+
+    # Statistics are calculated for each series
+    series = [result['data'][s]['human_agent']['step_variable'] for s in seeds]
+    stats = result['stats']['human_agent']['step_variable']
+    assert stats['mean'] == approx(np.mean(series, axis=0).tolist())
+    assert stats['p50'] == approx(np.median(series, axis=0).tolist())
+    assert set(stats) == {'mean', 'p5', 'p50', 'p95'}
+    assert result['survival'] == dict(steps={s: None for s in seeds}, survived=1,
+                                      mean=None)
+
+    # Running in-process gives the same results
+    serial = run_ensemble(config, n_runs=3, n_steps=20, max_workers=1)
+    assert serial['seeds'] == seeds
+    assert serial['stats'] == result['stats']
+
+def test_run_ensemble_survival(config):
+    config['agents']['ration_storage']['ration'] = 0
+    config['termination'] = []
+    result = run_ensemble(config, n_runs=2, n_steps=500, max_workers=1)
+    for seed, steps in result['survival']['steps'].items():
+        amounts = result['data'][seed]['human_agent']['amount']
+        assert amounts[steps - 2] == 1 and amounts[steps - 1] == 0
+    assert result['survival']['survived'] == 0
+    assert result['survival']['mean'] == approx(
+        np.mean(list(result['survival']['steps'].values())))
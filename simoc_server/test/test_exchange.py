@@ -0,0 +1,50 @@
+import copy
+import json
+
+import numpy as np
+import pytest
+
+from agent_model import AgentModel
+from agent_model.exceptions import AgentModelInitializationError
+
+def load_config(name, seed):
+    with open(f'data_files/{name}') as f:
+        config = json.load(f)
+    config['seed'] = seed
+    return config
+
+def compare_records(a, b, path=()):
+    """Assert that two get_data() outputs match to floating-point rounding"""
+    if isinstance(a, dict):
+        assert a.keys() == b.keys(), path
+        for k in a:
+            compare_records(a[k], b[k], path + (k,))
+    elif isinstance(a, list) and a and isinstance(a[0], (int, float)):
+        assert np.allclose(a, b, rtol=1e-9, atol=1e-12), path
+    else:
+        assert a == b, path
+
+@pytest.mark.parametrize('preset', ['config_1h.json', 'config_1hrad.json', 'config_4h.json'])
+def test_vectorized_engine_matches_scalar(preset, random_seed):
+    config = load_config(preset, random_seed)
+    records = {}
+    for engine in ['scalar', 'vectorized']:
+        model = AgentModel.from_config(copy.deepcopy(config), data_collection=True,
+                                       engine=engine)
+        model.step_to(n_steps=100)
+        records[engine] = model.get_data(debug=True)
+    compare_records(records['scalar'], records['vectorized'])
+
+def test_vectorized_engine_compiles_classes(random_seed):
+    config = load_config('config_1hrad.json', random_seed)
+    model = AgentModel.from_config(copy.deepcopy(config), engine='vectorized')
+    assert 'inhabitants' in model.exchange_kernels
+    assert 'eclss' in model.exchange_kernels
+    # Plants are weighted by growth, so they're stepped by the scalar engine
+    assert 'plants' not in model.exchange_kernels
+    scalar = AgentModel.from_config(config)
+    assert scalar.exchange_kernels == {}
+
+def test_unknown_engine(random_seed):
+    with pytest.raises(AgentModelInitializationError):
+        AgentModel.from_config(load_config('config_1h.json', random_seed), engine='gpu')
@@ -0,0 +1,56 @@
+import copy
+import io
+import json
+
+import numpy as np
+import pytest
+
+from agent_model import AgentModel
+from agent_model.growth_cache import GrowthCurveCache, growth_cache
+
+def test_cache_lru():
+    cache = GrowthCurveCache(maxsize=2)
+    a = cache.get('a', lambda: [1, 2, 3])
+    assert cache.get('a', lambda: [0]) is a
+    assert not a.flags.writeable
+    cache.get('b', lambda: [4])
+    cache.get('c', lambda: [5])  # Evicts 'a'
+    assert cache.get('a', lambda: [6]).tolist() == [6]
+    assert cache.get_stats()['size'] == 2
+    assert (cache.hits, cache.disk_hits, cache.misses) == (1, 0, 4)
+
+def test_cache_disk(tmp_path):
+    key = GrowthCurveCache.make_key(1.5, {'lifetime_growth_type': 'norm'}, 600, 1, 24)
+    cache = GrowthCurveCache(directory=str(tmp_path))
+    values = cache.get(key, lambda: np.linspace(0, 1, 10))
+    assert (tmp_path / f'{key}.npy').exists()
+    other = GrowthCurveCache(directory=str(tmp_path))
+    loaded = other.get(key, lambda: pytest.fail('computed a cached curve'))
+    assert other.disk_hits == 1
+    assert loaded.tolist() == values.tolist()
+    assert type(loaded) is np.ndarray
+    assert GrowthCurveCache.make_key(1.5, {'lifetime_growth_type': 'norm'}, 600, 0.5, 24) != key
+
+def test_model_shares_step_values(random_seed):
+    with open('data_files/config_4hg.json') as f:
+        config = json.load(f)
+    config['seed'] = random_seed
+    growth_cache.clear()
+    model = AgentModel.from_config(copy.deepcopy(config))
+    misses = growth_cache.misses
+    assert misses > 0
+    other = AgentModel.from_config(copy.deepcopy(config))
+    assert growth_cache.misses == misses
+    wheat, other_wheat = model.agents_by_type['wheat'][0], other.agents_by_type['wheat'][0]
+    assert wheat.step_values['out_biomass'] is other_wheat.step_values['out_biomass']
+    # Flows without growth aren't cached
+    human, other_human = model.agents_by_type['human_agent'][0], other.agents_by_type['human_agent'][0]
+    assert human.step_values['in_o2'] is not other_human.step_values['in_o2']
+
+    model.step_to(n_steps=10)
+    f = io.BytesIO()
+    model.save_checkpoint(f)
+    f.seek(0)
+    loaded = AgentModel.load(f)
+    assert loaded.agents_by_type['wheat'][0].step_values['out_biomass'].tolist() == \
+        wheat.step_values['out_biomass'].tolist()
@@ -1,5 +1,6 @@
 from operator import invert
 from agent_model.agents.growth_func import *
+from agent_model.util import LRUCache
 from pytest import approx
 
 
@@ -13,7 +14,13 @@ def test_optimize_bell_curve_mean(agent_desc):
                                       min_value=0,
                                       invert=False,
                                       noise=False)
-    assert result['max_value'] == 0.005027526800753942
+    assert result['max_value'] == approx(0.005027526800753942, rel=1e-5)
+    curve = get_bell_curve(num_values=lifetime, min_value=0, max_value=result['max_value'])
+    assert curve.mean() == approx(value, rel=1e-9)
+    # Inverted curves start and end at max_value, so the mean can't be matched
+    result = optimize_bell_curve_mean(mean_value=value, num_values=lifetime,
+                                      center=None, min_value=0, invert=True, noise=False)
+    assert result['max_value'] == value
 
 def test_get_bell_curve():
     # based on rice.out_biomass
@@ -42,8 +49,35 @@ def test_optimize_sigmoid_curve_mean():
                                          min_value=0,
                                          noise=False,
                                          noise_factor=10.0)
-    assert result['steepness'] == approx(1020)
-    assert result['max_value'] == 0.01587611172150995
+    # scipy stopped at the upper bound (1020, 0.01587611172150995); the
+    # minimum of its loss is at the lower bound
+    assert result['steepness'] == approx(0.01)
+    assert result['max_value'] == approx(0.01586834628262295, rel=1e-9)
+    curve = get_sigmoid_curve(num_values=lifetime, min_value=0, max_value=result['max_value'],
+                              steepness=result['steepness'], center=int(lifetime/2))
+    assert curve.mean() == approx(value, rel=1e-9)
+
+def _sigmoid_loss(mean_value, num_values, center, min_value, steepness, max_value):
+    """The loss minimized by scipy in optimize_sigmoid_curve_mean before"""
+    curve = get_sigmoid_curve(num_values=num_values, min_value=min_value,
+                              max_value=max_value, steepness=steepness, center=center)
+    return abs(mean_value - curve.mean()) / mean_value + steepness / num_values
+
+def test_optimize_sigmoid_curve_baseline():
+    # (mean_value, num_values, center, min_value): (steepness, max_value) from scipy
+    baseline = {(0.5, 100, None, 0.0): (0.01, 1.0000166441459613),
+                (0.5, 100, 20, 0.0): (0.6788124146742152, 0.6432628395381065),
+                (2.0, 480, 100, 0.1): (1.075193106218234, 2.511896722949687),
+                (0.01, 600, 200, 0.0): (0.6656594104815483, 0.0151253654807351)}
+    for args, (steepness, max_value) in baseline.items():
+        result = optimize_sigmoid_curve_mean(*args, noise=False)
+        loss = _sigmoid_loss(*args, result['steepness'], result['max_value'])
+        assert loss <= _sigmoid_loss(*args, steepness, max_value)
+        assert loss == approx(result['steepness'] / args[1], abs=1e-12)  # Mean is matched
+    # Where scipy reached the minimum, the result is the same
+    result = optimize_sigmoid_curve_mean(0.5, 100, None, 0.0, noise=False)
+    assert result['steepness'] == approx(0.01)
+    assert result['max_value'] == approx(1.0000166441459613, rel=1e-8)
 
 def test_get_sigmoid_curve():
     # based on rice.in_potb
@@ -62,3 +96,35 @@ def test_get_sigmoid_curve():
 
     assert len(result) == lifetime
     assert sum(result) == approx(value * lifetime)
+
+def test_get_growth_values_batch():
+    # based on the daily growth of plants under lamps
+    min_values = np.array([0.0, 0.0002, 0.0004])
+    max_values = np.array([0.0011, 0.0012, 0.0013])
+    batch = get_growth_values(agent_value=0.001, growth_type='clipped', num_values=24,
+                              min_value=min_values, max_value=max_values, scale=0.5)
+    assert batch.shape == (3, 24)
+    for row, min_value, max_value in zip(batch, min_values, max_values):
+        single = get_growth_values(agent_value=0.001, growth_type='clipped', num_values=24,
+                                   min_value=min_value, max_value=max_value, scale=0.5)
+        assert row.tolist() == single.tolist()
+    switch = get_growth_values(agent_value=np.array([1.0, 2.0]), growth_type='switch',
+                               num_values=6, min_value=0.0, min_threshold=2, max_threshold=4)
+    assert switch.tolist() == [[0, 0, 1, 1, 0, 0], [0, 0, 2, 2, 0, 0]]
+
+def test_growth_func_caches():
+    unit_curves.clear()
+    y = norm_pdf(24, 0.5, None)
+    assert norm_pdf(24, 0.5, 12) is y
+    assert not y.flags.writeable
+    assert (unit_curves.hits, unit_curves.misses) == (1, 1)
+    # Curves are built in new buffers, so the cached unit curve is unchanged
+    curve = get_bell_curve(num_values=24, min_value=0, max_value=1, scale=0.5)
+    curve += 1
+    assert norm_pdf(24, 0.5, None).tolist() == y.tolist()
+
+    cache = LRUCache(maxsize=2)
+    for key in ['a', 'b', 'a', 'c']:
+        cache.get(key, lambda: key.upper())
+    assert 'b' not in cache and 'a' in cache and 'c' in cache
+    assert cache.get_stats() == dict(hits=1, misses=3, size=2, maxsize=2)
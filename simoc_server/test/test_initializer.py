@@ -1,9 +1,11 @@
 import json
 
+import numpy as np
 import pytest
 from pytest import approx
 
 from agent_model import AgentModel, AgentModelInitializer
+from agent_model.exceptions import AgentModelInitializationError
 from simoc_server.front_end_routes import convert_configuration
 
 def test_initializer_from_new(one_human):
@@ -81,3 +83,33 @@ def test_initializer_user_agent_desc(one_human, user_agent_desc):
     co2_makeup_valve = model.get_agents_by_type('co2_makeup_valve')[0]
     assert co2_makeup_valve.attr_details['in_co2']['criteria_value'] == 0.001
     assert co2_makeup_valve.attr_details['in_co2']['criteria_buffer'] == 2
+
+def test_initializer_checkpoint(random_seed, tmp_path):
+    with open('data_files/config_4hg.json') as f:
+        config = json.load(f)
+    config['seed'] = random_seed
+    config['global_entropy'] = 1
+    model = AgentModel.from_config(config)
+    model.step_to(n_steps=4)
+    path = tmp_path / 'checkpoint.npz'
+    model.save_checkpoint(path)
+    from_checkpoint = AgentModel.load(path)
+    from_dict = AgentModel.load(model.save())
+    plant = from_checkpoint.get_agents_by_class('plants')[0]
+    assert all(isinstance(v, np.ndarray) for v in plant.step_values.values())
+    assert from_checkpoint.start_time == model.start_time
+
+    # Loads the same model as the json-serializable save
+    from_checkpoint.step_to(n_steps=10)
+    from_dict.step_to(n_steps=10)
+    assert from_checkpoint.get_data(debug=True) == from_dict.get_data(debug=True)
+
+    # Agent descriptions can be stored outside the checkpoint
+    descs = {}
+    model.save_checkpoint(tmp_path / 'shared.npz', descs=descs)
+    assert len(descs) == len(model.agents_by_type)
+    assert (tmp_path / 'shared.npz').stat().st_size < path.stat().st_size
+    loaded = AgentModel.load(tmp_path / 'shared.npz', descs=descs)
+    assert loaded.step_num == model.step_num
+    with pytest.raises(AgentModelInitializationError):
+        AgentModel.load(tmp_path / 'shared.npz')
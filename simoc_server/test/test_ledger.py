@@ -0,0 +1,93 @@
+import json
+
+import pytest
+from pytest import approx
+
+from agent_model import AgentModel
+from agent_model.ledger import StorageLedger
+from agent_model.agents import StorageAgent
+
+@pytest.fixture()
+def model(random_seed):
+    with open('data_files/config_1h.json') as f:
+        config = json.load(f)
+    config['seed'] = random_seed
+    return AgentModel.from_config(config, data_collection=False)
+
+def test_ledger_register():
+    ledger = StorageLedger(capacity=1)
+    assert ledger.register(5) == 0
+    assert ledger.register(7) == 1
+    assert ledger.size == 2
+    assert list(ledger.values[:ledger.size]) == [5, 7]
+
+def test_storage_balances_are_ledger_views(model):
+    water_storage = model.get_agents_by_type('water_storage')[0]
+    index = water_storage.ledger_index['potable']
+    assert water_storage['potable'] == model.ledger.values[index]
+    water_storage['potable'] = 100
+    assert model.ledger.values[index] == 100
+    assert water_storage.potable == 100
+    water_storage.potable = 50
+    assert water_storage['potable'] == 50
+    assert 'potable' in water_storage
+    assert 'potable' not in water_storage.__dict__
+
+def test_storage_view_and_increment(model):
+    water_storage = model.get_agents_by_type('water_storage')[0]
+    view = water_storage.view('water')
+    assert list(view) == [c for c in model.currency_dict['water']['currencies']
+                          if c in water_storage.ledger_index]
+    total = sum(view.values())
+    flow = water_storage.increment('water', -10)
+    assert sum(flow.values()) == approx(10)
+    assert sum(water_storage.view('water').values()) == approx(total - 10)
+    for currency, value in view.items():
+        assert flow[currency] == approx(10 * value / total)
+    capacity = water_storage['char_capacity_potable'] * water_storage.amount
+    flow = water_storage.increment('potable', capacity * 2)
+    assert water_storage['potable'] == capacity
+
+def test_storage_ratios(model):
+    model.step()
+    for storage in model.get_agents_by_role('storage'):
+        ratios = model.storage_ratios[storage.agent_type]
+        if sum(storage[c] for c in storage.ledger_index) > 0:
+            assert sum(ratios.values()) == approx(1)
+
+def test_save_load_balances(model):
+    model.step_to(n_steps=5)
+    saved = model.save()
+    loaded = AgentModel.load(saved)
+    for storage in model.get_agents_by_role('storage'):
+        loaded_storage = loaded.get_agents_by_type(storage.agent_type)[0]
+        for currency in storage.ledger_index:
+            assert loaded_storage[currency] == storage[currency]
+
+def test_storage_ratios_are_lazy(model):
+    model.step()
+    water_storage = model.get_agents_by_type('water_storage')[0]
+    storage_ratios = model.storage_ratios
+    StorageAgent.step(water_storage)
+    storage_ratios.flush()
+    assert 'water_storage' not in storage_ratios.pending
+
+    # Unchanged storages aren't recalculated
+    StorageAgent.step(water_storage)
+    assert 'water_storage' not in storage_ratios.pending
+
+    # Changed storages are scheduled, and calculated when read
+    water_storage.increment('potable', -10)
+    StorageAgent.step(water_storage)
+    assert storage_ratios.pending['water_storage'] is water_storage
+    total = sum(water_storage.view('water').values())
+    expected = water_storage['potable'] / total
+    assert storage_ratios['water_storage']['potable_ratio'] == approx(expected)
+    assert 'water_storage' not in storage_ratios.pending
+
+    # Ratios are a snapshot from when the storage stepped
+    water_storage.increment('potable', -10)
+    StorageAgent.step(water_storage)
+    expected = water_storage['potable'] / sum(water_storage.view('water').values())
+    water_storage.increment('potable', -10)
+    assert storage_ratios['water_storage']['potable_ratio'] == approx(expected)
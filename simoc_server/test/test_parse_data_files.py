@@ -5,7 +5,8 @@ from pytest import approx
 
 from simoc_server.front_end_routes import convert_configuration
 from agent_model.parse_data_files import parse_currency_desc, parse_agent_desc, \
-                                         parse_agent_conn, merge_json
+                                         parse_agent, parse_agent_conn, merge_json
+from agent_model.util import resolve_unit
 
 def test_parse_currency_desc(currency_desc):
     currencies, currency_errors = parse_currency_desc(currency_desc)
@@ -28,6 +29,27 @@ def test_parse_currency_desc(currency_desc):
     assert o2['class'] == 'atmosphere'
     assert o2['label'] == 'Oxygen'
 
+def test_resolve_unit():
+    assert resolve_unit('kg') == ('kg', 1.0)
+    assert resolve_unit('kilogram') == ('kg', 1.0)
+    assert resolve_unit('g') == ('kg', approx(0.001))
+    base, factor = resolve_unit('kWh')
+    assert factor == approx(3.6e6)
+    assert resolve_unit('not_a_unit') == (None, None)
+
+def test_parse_agent_units(currency_dict, agent_desc):
+    data = agent_desc['structures']['crew_habitat_small']
+    agent, agent_errors = parse_agent('structures', 'crew_habitat_small', data,
+                                      currency_dict, 'mars')
+    details = agent['attribute_details']['char_capacity_o2']
+    assert details['unit_base'] == 'kg'
+    assert details['unit_factor'] == 1.0
+    data = agent_desc['power_generation']['solar_pv_array_mars']
+    agent, agent_errors = parse_agent('power_generation', 'solar_pv_array_mars', data,
+                                      currency_dict, 'mars')
+    details = agent['attribute_details']['out_kwh']
+    assert details['flow_unit_factor'] == approx(3.6e6)
+
 def test_parse_agent_desc(four_humans_garden, currency_dict, agent_desc):
     config = convert_configuration(four_humans_garden)
     agents, agent_errors = parse_agent_desc(config, currency_dict, agent_desc, 'mars')
@@ -0,0 +1,47 @@
+import copy
+import json
+
+import pytest
+
+from agent_model import AgentModel
+
+@pytest.fixture()
+def config(random_seed):
+    with open('data_files/config_1h.json') as f:
+        config = json.load(f)
+    config['seed'] = random_seed
+    return config
+
+@pytest.fixture()
+def split_config(config):
+    # Storages without any connected agents are components of their own
+    keep = ['human_agent', 'crew_habitat_small', 'water_storage', 'ration_storage',
+            'solar_pv_array_mars', 'power_storage', 'co2_storage', 'nutrient_storage']
+    config['agents'] = {k: v for k, v in config['agents'].items() if k in keep}
+    config['global_entropy'] = 1
+    config['rng_streams'] = True
+    return config
+
+def test_partition_one_component(config):
+    model = AgentModel.from_config(config)
+    report = model.get_partition()
+    assert len(report['components']) == 1
+    assert report['components'][0] == sorted(config['agents'])
+    assert report['can_parallelize'] is False
+    assert 'one connected component' in report['reason']
+
+def test_partition_components(split_config):
+    model = AgentModel.from_config(copy.deepcopy(split_config))
+    report = model.get_partition()
+    assert ['co2_storage'] in report['components']
+    assert ['nutrient_storage'] in report['components']
+    assert report['layers'][0][0] == ['crew_habitat_small']
+    assert report['can_parallelize'] is True
+    assert report['reason'] is None
+
+def test_partition_shared_random_state(split_config):
+    split_config['rng_streams'] = False
+    model = AgentModel.from_config(split_config)
+    report = model.get_partition()
+    assert report['can_parallelize'] is False
+    assert 'rng_streams' in report['reason']
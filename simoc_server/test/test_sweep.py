@@ -0,0 +1,50 @@
+import json
+
+import pytest
+
+from agent_model import AgentModel, run_sweep
+from agent_model.initializer import InitializerCache
+from agent_model.sweep import apply_overrides
+from agent_model.exceptions import AgentModelConfigError
+
+@pytest.fixture()
+def config(random_seed):
+    with open('data_files/config_1h.json') as f:
+        config = json.load(f)
+    config['seed'] = random_seed
+    return config
+
+def test_apply_overrides(config):
+    overrides = {'agents.human_agent.amount': 3, 'minutes_per_step': 30,
+                 'agents.dehumidifier': None}
+    variant = apply_overrides(config, overrides)
+    assert variant['agents']['human_agent']['amount'] == 3
+    assert variant['minutes_per_step'] == 30
+    assert 'dehumidifier' not in variant['agents']
+    assert config['agents']['human_agent']['amount'] == 1
+
+def test_run_sweep(config):
+    cache = InitializerCache()
+    grid = {'agents.human_agent.amount': [1, 2], 'minutes_per_step': [60, 30]}
+    overrides = [{}, {'agents.dehumidifier': None}]
+    results = run_sweep(config, overrides=overrides, grid=grid, n_steps=20,
+                        max_workers=1, cache=cache)
+    assert len(results) == 8
+    assert results[3]['overrides'] == {'agents.human_agent.amount': 2, 'minutes_per_step': 30}
+
+    # Runs match the model run on its own
+    for result in [results[0], results[3], results[6]]:
+        model = AgentModel.from_config(apply_overrides(config, result['overrides']))
+        model.step_to(n_steps=20)
+        assert result['data'] == model.get_data()
+
+    # Agents are parsed once; connections once per set of agents
+    assert cache.misses['parse_agent_desc'] == len(config['agents'])
+    assert cache.misses['parse_agent_conn'] == 2
+    assert cache.hits['agent_desc'] == 7
+    step_values = cache.stages['step_values']
+    assert ('human_agent', 'mars', 30) in step_values
+
+def test_run_sweep_errors(config):
+    with pytest.raises(AgentModelConfigError):
+        run_sweep(config, overrides=[{'not_a_field': 1}], n_steps=1, max_workers=1)
@@ -0,0 +1,104 @@
+import pytest
+
+import simoc_server  # Imports the views before the tasks they import
+from agent_model.agents.data_collector import parse_plan
+from agent_model.exceptions import AgentModelInitializationError
+from celery_worker.tasks import RECORD_FIELDS, filter_records, get_resolution, reduce_records
+from simoc_abm.agent_model import AgentModel
+from simoc_abm.util import load_preset_configuration
+
+@pytest.fixture()
+def records():
+    model = AgentModel.from_config(**load_preset_configuration('1h'),
+                                   record_initial_state=False)
+    for _ in range(3):
+        model.step()
+    return model.get_records(static=True, clear_cache=True)
+
+def test_filter_records(records):
+    human = records['agents']['human']
+    assert set(human) - {'static'} <= set(RECORD_FIELDS)
+    assert filter_records(records, None) is records
+
+    plan = parse_plan({'human': ['attributes', 'flows'], 'solar_pv_array_mars': None,
+                       'default': ['storage']}, RECORD_FIELDS)
+    filtered = filter_records(records, plan)
+    assert filtered['step_num'] == [1, 2, 3]
+    assert filtered['static'] == records['static']
+    assert filtered['agents']['human'] == {k: human[k] for k in ['attributes', 'flows', 'static']}
+    assert filtered['agents']['human']['attributes']['age'] == [1, 2, 3]
+    assert filtered['agents']['solar_pv_array_mars'] == records['agents']['solar_pv_array_mars']
+    storage = filtered['agents']['water_storage']
+    assert storage['storage'] == records['agents']['water_storage']['storage']
+    assert set(storage) == {'storage', 'static'}
+
+    # Agents without a list aren't collected
+    filtered = filter_records(records, parse_plan({'human': ['active']}, RECORD_FIELDS))
+    assert list(filtered['agents']) == ['human']
+
+def test_worker_plan_fields():
+    with pytest.raises(AgentModelInitializationError):
+        parse_plan(['age', 'amount'], RECORD_FIELDS)
+    assert parse_plan(['attributes'], RECORD_FIELDS) == {'default': ['attributes']}
+
+def test_reduce_records():
+    model = AgentModel.from_config(**load_preset_configuration('1h'),
+                                   record_initial_state=False)
+    batches = []
+    for n_steps in [30, 40]:
+        for _ in range(n_steps):
+            model.step()
+        batches.append(model.get_records(static=True, clear_cache=True))
+    o2 = [v for batch in batches
+          for v in batch['agents']['human']['flows']['in']['o2']['crew_habitat_small']]
+
+    reduced, pending = reduce_records(batches[0], get_resolution(12, 'mars'))
+    assert pending is None
+    assert reduced['step_num'] == [12, 24]
+    assert reduced['agents']['human']['attributes']['age'] == [12, 24]
+    assert reduced['static'] == batches[0]['static']
+
+    # Sols are 24.65 hours, so the step which crosses the end of a sol ends it
+    resolution = get_resolution('daily', 'mars')
+    first, pending = reduce_records(batches[0], resolution)
+    assert first['step_num'] == [25]
+    assert pending['step_num'] == list(range(26, 31))
+    second, pending = reduce_records(batches[1], resolution, pending)
+    assert second['step_num'] == [50]
+    assert pending['step_num'] == list(range(51, 71))
+    daily = [first, second]
+    for day, (start, end) in zip(daily, [(0, 25), (25, 50)]):
+        flow = day['agents']['human']['flows']['in']['o2']['crew_habitat_small']
+        assert flow['sum'] == [sum(o2[start:end])]
+        assert flow['max'] == [max(o2[start:end])]
+        assert flow['mean'] == [pytest.approx(sum(o2[start:end]) / (end - start))]
+    human = second['agents']['human']
+    assert human['cause_of_death'] == batches[1]['agents']['human']['cause_of_death']
+
+def test_reduce_records_final():
+    # Games whose length isn't a multiple of the period end with a short one
+    model = AgentModel.from_config(**load_preset_configuration('1h'),
+                                   record_initial_state=False)
+    for _ in range(10):
+        model.step()
+    records = model.get_records(static=True, clear_cache=True)
+    age = records['agents']['human']['attributes']['age']
+    reduced, _ = reduce_records(records, get_resolution(4, 'mars'), final=True)
+    assert reduced['step_num'] == [4, 8, 10]
+    assert reduced['agents']['human']['attributes']['age'] == [4, 8, 10]
+
+    resolution = get_resolution('daily', 'mars')
+    first, pending = reduce_records(records, resolution)
+    assert first['step_num'] == [] and pending['step_num'] == list(range(1, 11))
+    # The last batch of a game may have no steps of its own
+    empty = model.get_records(static=True, clear_cache=True)
+    last, pending = reduce_records(empty, resolution, pending, final=True)
+    assert last['step_num'] == [10]
+    assert pending['step_num'] == []
+    assert last['agents']['human']['attributes']['age'] == \
+        {'min': [1], 'mean': [sum(age) / 10], 'max': [10], 'sum': [sum(age)]}
+
+    with pytest.raises(AgentModelInitializationError):
+        get_resolution({'flows': 'daily'}, 'mars')
+    with pytest.raises(AgentModelInitializationError):
+        get_resolution('hourly', 'mars')
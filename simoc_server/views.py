@@ -20,6 +20,8 @@ from simoc_server.exceptions import GenericError, InvalidLogin, BadRequest, BadR
 from simoc_server.serialize import serialize_response
 from simoc_server.front_end_routes import convert_configuration
 from simoc_abm.util import load_data_file
+from agent_model.agents.data_collector import parse_plan
+from agent_model.exceptions import AgentModelInitializationError
 
 from celery_worker import tasks
 from celery_worker.tasks import app as celery_app, BUFFER_SIZE
@@ -286,9 +288,22 @@ def new_game():
         raise BadRequest(f"Cannot retrieve game config. Reason: {e}")
     if step_num >= MAX_STEP_NUMBER:
         raise BadRequest("Too many steps requested.")
+    # Optional {<agent_id>: [<field>]} of the series the client needs
+    try:
+        collection_plan = parse_plan(input.get("collection_plan"), tasks.RECORD_FIELDS)
+    except AgentModelInitializationError as e:
+        raise BadRequest(f"Invalid collection_plan. Reason: {e}")
+    # Optional resolution of the records, e.g. 24 or 'daily'
+    data_resolution = input.get("data_resolution")
+    try:
+        tasks.get_resolution(data_resolution, game_config.get('location', 'mars'))
+    except AgentModelInitializationError as e:
+        raise BadRequest(f"Invalid data_resolution. Reason: {e}")
     user = get_standard_user_obj()
     user_cleanup(user)
-    tasks.new_game.apply_async(args=[user.username, game_config, step_num])
+    tasks.new_game.apply_async(args=[user.username, game_config, step_num],
+                               kwargs=dict(collection_plan=collection_plan,
+                                           data_resolution=data_resolution))
     while True:
         time.sleep(0.5)
         game_id = get_user_game_id(user)